@@ -5,9 +5,14 @@ from keras.models import load_model
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 from scipy.io import loadmat, savemat
+from impute_folds import read_shared_array, share_array
+from incremental import is_exported, load_incremental
+from rollout import ContextWindow
+from runtime import as_runtime
 from utils import load_dataset, get_ids
 
 
@@ -28,17 +33,24 @@ def plot_history(history, save_path):
 
 
 def predict_markers(model, X, markers_to_predict, num_frames=True,
-                    outlier_thresh=3, return_member_data=False):
+                    outlier_thresh=3, return_member_data=False,
+                    batch_size=32):
     """Predicts the position of particular markers.
 
     :param model: model to use for prediction
     :param X: data struct covering
     :param markers_to_predict: logical vector of shape (X.shape[2],) that is
                                True for markers that you would like to predict
-                               and false otherwise
+                               and false otherwise, or logical matrix of shape
+                               (X.shape[0], X.shape[2]) to predict different
+                               markers in each sample.
     :param num_frames: number of frames into future you would like to predict.
                        Cannot be > X.shape[1] default is the difference between
                        X.shape[1] and the model input shape.
+    :param batch_size: Number of samples per model batch.
+
+    Incremental models (see incremental.py) are stepped with the frames
+    appended to each sample rather than rerun on the whole window.
     """
     if num_frames:
         num_frames = X.shape[1] - model.input.shape.as_list()[1]
@@ -57,8 +69,20 @@ def predict_markers(model, X, markers_to_predict, num_frames=True,
 
     # Get the input lengths and preallocate
     input_length = model.input.shape.as_list()[1]
-    X_start = X[:, :input_length, :]
+    window = ContextWindow(X.shape[0], input_length, X.shape[2])
+    window.fill(X[:, :input_length, :])
     count = 0
+    incremental = hasattr(model, 'predict_windows')
+    if incremental:
+        model.reset(X.shape[0])
+        keys = np.arange(X.shape[0])
+
+    def predict(windows):
+        if incremental:
+            output = model.predict_windows(windows, keys, window.shift)
+            window.shift[:] = 0
+            return output
+        return model.predict(windows, batch_size=batch_size)
     preds = np.zeros((X.shape[0], num_frames, X.shape[2]))
 
     if return_member_data:
@@ -71,15 +95,15 @@ def predict_markers(model, X, markers_to_predict, num_frames=True,
         # markers you do not want to predict with the ground truth, and
         # append the resulting vector to the end of the next input chunk.
         for i in range(num_frames):
-            pred, member_pred = model.predict(X_start)
-            pred[:, 0, ~markers_to_predict] = \
-                X[:, input_length + count, ~markers_to_predict]
-            preds[:, i, :] = np.squeeze(pred)
+            pred, member_pred = predict(window.view())
+            pred[:, 0, :] = np.where(markers_to_predict, pred[:, 0, :],
+                                     X[:, input_length + count, :])
+            preds[:, i, :] = pred[:, 0, :]
             # member_preds[:, :, i, :] = member_pred
 
             member_std = np.nanstd(member_pred, axis=1)
             member_stds[:, i, :] = member_std
-            X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
+            window.append(pred[:, 0, :])
             count += 1
         return preds, member_stds
     else:
@@ -87,11 +111,11 @@ def predict_markers(model, X, markers_to_predict, num_frames=True,
         # markers you do not want to predict with the ground truth, and
         # append the resulting vector to the end of the next input chunk.
         for i in range(num_frames):
-            pred = model.predict(X_start)
-            pred[:, 0, ~markers_to_predict] = \
-                X[:, input_length + count, ~markers_to_predict]
-            preds[:, i, :] = np.squeeze(pred)
-            X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
+            pred = predict(window.view())
+            pred[:, 0, :] = np.where(markers_to_predict, pred[:, 0, :],
+                                     X[:, input_length + count, :])
+            preds[:, i, :] = pred[:, 0, :]
+            window.append(pred[:, 0, :])
             count += 1
         return preds
 
@@ -154,9 +178,12 @@ def plot_error_distribution_over_time(delta, delta_marker,
 
 def analyze_marker_predictions(model, total, totalR, Y, marker_means,
                                marker_stds, viz_directory,
-                               plot_distribution=False):
+                               plot_distribution=False, batch_size=10000):
     """Analyzes the performance of an mbi model on ground truth data.
 
+    Every marker is predicted separately in both directions. The samples of
+    all markers and both directions are stacked into the batch, so each step
+    of the rollout is a single model call.
     :param model: model to use for predictions
     :param total: Marker data over time interval you wish to predict, including
                   the input frames
@@ -167,103 +194,197 @@ def analyze_marker_predictions(model, total, totalR, Y, marker_means,
                          markers.
     :param marker_stds: Standard deviation in RWC of all markers
     :param viz_directory: Directory in which to save images.
+    :param batch_size: Maximum number of stacked samples per model call.
     """
-    n_markers = total.shape[2]
-    delta_markers = np.zeros((Y.shape[0], Y.shape[1], np.int32(n_markers / 3)))
-    total_member_stds = np.zeros((Y.shape[0], Y.shape[1], n_markers))
-    predictions = np.zeros((Y.shape[0], Y.shape[1], n_markers))
+    n_samples, n_frames, n_markers = Y.shape
+    n_bad_markers = np.int32(n_markers / 3)
+    delta_markers = np.zeros((n_samples, n_frames, n_bad_markers))
+    total_member_stds = np.zeros((n_samples, n_frames, n_markers))
+    predictions = np.zeros((n_samples, n_frames, n_markers))
 
     # Check how many outputs the model has, and how many members if returning
     # member data.
     n_outputs = len(model.output_shape)
-    if n_outputs == 2:
-        return_member_data = True
-    else:
-        return_member_data = False
-        # member_predsF = [None]
-        # member_predsR = [None]
-        member_stdsF = [None]
-        member_stdsR = [None]
-
-    # For each marker, predict position over all gaps and make plots.
-    for marker_id in range(np.int32(n_markers / 3)):
-        # Pick the markers you would like to predict
-        predict_ids = marker_id * 3 + np.array([0, 1, 2])
-        markers_to_predict = np.zeros((n_markers)) > 1
-        markers_to_predict[predict_ids] = True
-
-        # Predict markers
-        print('Predicting marker ', (marker_id))
-        start = datetime.datetime.now()
+    return_member_data = n_outputs == 2
+
+    # Each copy of the data predicts a single marker.
+    masks = (np.arange(n_markers)[None, :] // 3) == \
+        np.arange(n_bad_markers)[:, None]
+    own = np.arange(n_bad_markers)[:, None] * 3 + np.arange(3)
+
+    # Convert to Real world coordinates
+    Y_world = Y * marker_stds[0, :] + marker_means[0, :]
+
+    # Compute the weighted average using a logistic function
+    # k = .2335 # value determined empirically by minimizing MSE
+    k = 1
+    weightR = sigmoid(np.arange(0, n_frames), n_frames / 2, k)[:, None, None]
+    weight = 1 - weightR
+
+    # Predict chunks of samples for all markers in both directions at once.
+    chunk_size = max(1, batch_size // (2 * n_bad_markers))
+    for start in range(0, n_samples, chunk_size):
+        ids = slice(start, min(start + chunk_size, n_samples))
+        n_chunk = ids.stop - ids.start
+        print('Predicting samples %d to %d' % (ids.start, ids.stop))
+        t0 = datetime.datetime.now()
+        stacked = np.concatenate(
+            (np.tile(total[ids], (n_bad_markers, 1, 1)),
+             np.tile(totalR[ids], (n_bad_markers, 1, 1))), axis=0)
+        stacked_masks = np.repeat(np.concatenate((masks, masks)), n_chunk,
+                                  axis=0)
         if return_member_data:
-            # Multi predict forward
-            preds, member_stdsF = \
-                predict_markers(model, total, markers_to_predict,
-                                return_member_data=return_member_data)
-            # Multi predict reverse
-            predsR, member_stdsR = \
-                predict_markers(model, totalR, markers_to_predict,
-                                return_member_data=return_member_data)
-            member_stdsR = member_stdsR[:, ::-1, :]
+            preds, member_stds = \
+                predict_markers(model, stacked, stacked_masks,
+                                return_member_data=return_member_data,
+                                batch_size=batch_size)
         else:
-            # Multi predict forward
-            preds = \
-                predict_markers(model, total, markers_to_predict,
-                                return_member_data=return_member_data)
-            # Multi predict reverse
-            predsR = \
-                predict_markers(model, totalR, markers_to_predict,
-                                return_member_data=return_member_data)
-        elapsed = datetime.datetime.now() - start
-        s = 'Finished predictions of marker %d in %f seconds' % \
-            (marker_id, elapsed.total_seconds())
-        print(s)
-
-        # Convert to Real world coordinates
-        Y_world = np.zeros((Y.shape))
-        preds_world = np.zeros((preds.shape))
-        predsR_world = np.zeros((predsR.shape))
-        for i in range(Y_world.shape[2]):
-            Y_world[:, :, i] = \
-                Y[:, :, i] * marker_stds[0, i] + marker_means[0, i]
-            preds_world[:, :, i] = \
-                preds[:, :, i] * marker_stds[0, i] + marker_means[0, i]
-            predsR_world[:, :, i] = \
-                predsR[:, :, i] * marker_stds[0, i] + marker_means[0, i]
-
-        predsR_world = predsR_world[:, ::-1, :]
-
-        # Compute the weighted average
-        # k = .2335 # value determined empirically by minimizing MSE
-        k = 1
-        weightR = sigmoid(np.arange(0, preds_world.shape[1]),
-                          preds_world.shape[1] / 2, k)
-        weight = 1 - weightR
-        preds_world_weighted_average = np.zeros((preds_world.shape))
-        member_stds = np.zeros((preds_world.shape))
-        for i in range(preds_world.shape[0]):
-            for j in range(preds_world.shape[2]):
-                preds_world_weighted_average[i, :, j] = \
-                    preds_world[i, :, j] * weight + predsR_world[i, :, j] * weightR
-                member_stds[i, :, j] = \
-                    np.sqrt(((member_stdsF[i, :, j]**2) * weight) +
-                            ((member_stdsR[i, :, j]**2) * weightR))
-        delta = np.abs(Y_world - preds_world_weighted_average)
-        delta_marker = np.sqrt(np.sum(delta[:, :, predict_ids]**2, axis=2))
-
-        # Plot the distribution
-        if plot_distribution:
-            plot_error_distribution_over_time(delta, delta_marker,
+            preds = predict_markers(model, stacked, stacked_masks,
+                                    return_member_data=return_member_data,
+                                    batch_size=batch_size)
+        elapsed = datetime.datetime.now() - t0
+        print('Finished predictions in %f seconds' % (elapsed.total_seconds()))
+
+        def own_markers(data):
+            # Keep the coordinates of the predicted marker of each copy as
+            # (direction, sample, frame, marker, coordinate).
+            data = data.reshape((2, n_bad_markers, n_chunk, n_frames,
+                                 n_bad_markers, 3))
+            marker_ids = np.arange(n_bad_markers)
+            return np.transpose(data[:, marker_ids, :, :, marker_ids, :],
+                                (1, 2, 3, 0, 4))
+
+        # Convert to Real world coordinates, with the reverse predictions in
+        # forward order.
+        preds = own_markers(preds) * marker_stds[0, own] + \
+            marker_means[0, own]
+        predsF = preds[0]
+        predsR = preds[1][:, ::-1, :, :]
+        preds_weighted = predsF * weight + predsR * weightR
+        delta = np.abs(Y_world[ids].reshape(preds_weighted.shape) -
+                       preds_weighted)
+        delta_markers[ids] = np.sqrt(np.sum(delta**2, axis=3))
+        predictions[ids] = preds_weighted.reshape((n_chunk, n_frames,
+                                                   n_markers))
+        if return_member_data:
+            member_stds = own_markers(member_stds)
+            member_stds = np.sqrt(((member_stds[0]**2) * weight) +
+                                  ((member_stds[1][:, ::-1]**2) * weightR))
+            total_member_stds[ids] = member_stds.reshape((n_chunk, n_frames,
+                                                          n_markers))
+
+    # Plot the distribution
+    if plot_distribution:
+        for marker_id in range(n_bad_markers):
+            plot_error_distribution_over_time(delta_markers,
+                                              delta_markers[:, :, marker_id],
                                               marker_id, viz_directory)
 
-        delta_markers[:, :, marker_id] = delta_marker
-        total_member_stds[:, :, predict_ids] = member_stds[:, :, predict_ids]
-        predictions[:, :, predict_ids] = \
-            preds_world_weighted_average[:, :, predict_ids]
-
     return delta_markers, total_member_stds, predictions
 
 
+def analyze_gap_length(model, markers, bad_frames, marker_means,
+                       marker_stds, input_length, length, skip,
+                       save_directory, plot_distribution=False,
+                       batch_size=10000):
+    """Analyze the predictions over gaps of a single length.
+
+    The results are saved to errors.mat in save_directory. If that file
+    already exists, it is loaded instead, so that an interrupted sweep
+    resumes where it stopped.
+    :param model: model to use for predictions
+    :param markers: Z-scored marker data (n_frames x n_markers)
+    :param bad_frames: Logical matrix denoting frames with marker errors.
+    :param marker_means: Mean position in real-world-coordinates (RWC) of all
+                         markers.
+    :param marker_stds: Standard deviation in RWC of all markers
+    :param input_length: Number of frames input to the model.
+    :param length: Gap length (frames)
+    :param skip: Only take every skip-th example trace to save time.
+    :param save_directory: Directory in which to save the results and images.
+    :param plot_distribution: Plots the error distribution over the gap.
+    :param batch_size: Maximum number of samples per model call.
+    :return: Dictionary of the results.
+    """
+    results_path = os.path.join(save_directory, 'errors.mat')
+    if os.path.exists(results_path):
+        print('Loading saved results for length %d' % (length), flush=True)
+        return loadmat(results_path)
+    if not os.path.exists(save_directory):
+        os.makedirs(save_directory)
+
+    # Get Ids
+    print('Getting indices for length %d' % (length), flush=True)
+    input_ids, target_ids = get_ids(bad_frames, input_length,
+                                    input_length + length, True, True)
+
+    # Get the data corresponding to the indices
+    print('Indexing into data')
+    X = markers[input_ids[::skip, :], :]
+    Y = markers[target_ids[::skip, :length], :]
+    XR = markers[target_ids[::skip, :(length - 1):-1], :]
+    YR = Y[:, ::-1, :]
+
+    # Concatenate for use in the multiple prediction function
+    total = np.concatenate((X, Y), axis=1)
+    totalR = np.concatenate((XR, YR), axis=1)
+
+    # Analyze marker predictions over time
+    delta_markers, member_stds, predictions = \
+        analyze_marker_predictions(model, total, totalR, Y, marker_means,
+                                   marker_stds, save_directory,
+                                   plot_distribution=plot_distribution,
+                                   batch_size=batch_size)
+    results = {'delta_markers': delta_markers, 'member_stds': member_stds,
+               'predictions': predictions, 'input': X, 'target': Y,
+               'input_ids': input_ids, 'target_ids': target_ids,
+               'total': total}
+
+    # Write to a temporary file first so that an interrupted save is not
+    # mistaken for a finished length.
+    temp_path = os.path.join(save_directory, 'errors_partial.mat')
+    savemat(temp_path, results)
+    os.replace(temp_path, results_path)
+    return results
+
+
+# State of each worker process, set once by init_worker.
+worker = {}
+
+
+def load_predictor(model_path, incremental=False):
+    """Load a model for inference.
+
+    :param model_path: Path to model to use for predictions.
+    :param incremental: If True, wrap the model for incremental inference
+                        (see incremental.py). Otherwise, in an
+                        InferenceRuntime.
+    """
+    if incremental or is_exported(model_path):
+        return load_incremental(model_path)
+    return as_runtime(load_model(model_path))
+
+
+def init_worker(model_path, shared_arrays, incremental=False):
+    """Load the model and attach the shared data once per worker.
+
+    :param model_path: Path to model to use for predictions.
+    :param shared_arrays: markers, bad_frames, marker_means and marker_stds
+                          as returned by impute_folds.share_array.
+    :param incremental: If True, use incremental inference.
+    """
+    worker['data'] = [read_shared_array(*shared) for shared in shared_arrays]
+    worker['model'] = load_predictor(model_path, incremental)
+
+
+def analyze_gap_length_worker(kwargs):
+    """Run analyze_gap_length with the worker's model and data."""
+    markers, bad_frames, marker_means, marker_stds = worker['data']
+    analyze_gap_length(worker['model'], markers, bad_frames, marker_means,
+                       marker_stds, **kwargs)
+    return kwargs['length']
+
+
 def analyze_performance(model_base_path, data_path, *, run_name=None,
                         viz_directory=None, model_name='best_model.h5',
                         default_input_length=9, testing_set_only=False,
@@ -271,8 +392,8 @@ def analyze_performance(model_base_path, data_path, *, run_name=None,
                         analyze_multi_prediction=True,
                         load_training_info=True, min_gap_length=10,
                         max_gap_length=100, stride=1, skip=500,
-                        save_path=None
-                        ):
+                        save_path=None, batch_size=10000, n_workers=1,
+                        incremental=False):
     """Analyzes model performance using a variety of methods.
 
     :param model_base_path: Base path of model to be analyzed
@@ -296,6 +417,15 @@ def analyze_performance(model_base_path, data_path, *, run_name=None,
     :param stride: Temporal downsampling rate
     :param skip: When calculating the error distribution over time, only take
                  every skip-th example trace to save time.
+    :param batch_size: Maximum number of samples per model call when
+                       predicting all markers at once.
+    :param n_workers: Number of processes across which to spread the gap
+                      lengths. Each length is saved to its folder of the run
+                      when finished, and rerunning with the same run_name
+                      skips the lengths already saved.
+    :param incremental: If True, step WaveNet and LSTM models incrementally
+                        through each gap (see incremental.py). Approximate
+                        for LSTMs.
     """
     if run_name is None:
         run_name = datetime.datetime.now().strftime('%y_%m_%d_%H_%M_%S_%f')
@@ -312,7 +442,7 @@ def analyze_performance(model_base_path, data_path, *, run_name=None,
     try:
         model_info = \
             loadmat(os.path.join(model_base_path, 'training_info.mat'))
-        input_length = model_info['input_length'][:]
+        input_length = int(np.squeeze(model_info['input_length']))
     except KeyError:
         input_length = default_input_length
 
@@ -321,10 +451,6 @@ def analyze_performance(model_base_path, data_path, *, run_name=None,
         history = loadmat(os.path.join(model_base_path, 'history.mat'))
         plot_history(history, os.path.join(model_base_path, 'history.png'))
 
-    # Load the model
-    print('Loading model')
-    model = load_model(os.path.join(model_base_path, model_name))
-
     print('Loading data')
     markers, marker_means, marker_stds, bad_frames, moving_frames = \
         load_dataset(data_path)
@@ -332,58 +458,46 @@ def analyze_performance(model_base_path, data_path, *, run_name=None,
     bad_frames = bad_frames[::stride, :]
 
     lengths = np.arange(min_gap_length, max_gap_length + 1, 10)
-
-    # Set up variables to save to matlab cells.
-    delta_markers = np.zeros((lengths.shape[0],), dtype=np.object)
-    member_stds = np.zeros((lengths.shape[0],), dtype=np.object)
-    predictions = np.zeros((lengths.shape[0],), dtype=np.object)
-    X = np.zeros((lengths.shape[0],), dtype=np.object)
-    Y = np.zeros((lengths.shape[0],), dtype=np.object)
-    input_ids = np.zeros((lengths.shape[0],), dtype=np.object)
-    target_ids = np.zeros((lengths.shape[0],), dtype=np.object)
-    total = np.zeros((lengths.shape[0],), dtype=np.object)
-
-    for i in range(lengths.shape[0]):
-        # Get Ids
-        print('Getting indices %d' % (i), flush=True)
-        [input_ids[i], target_ids[i]] = get_ids(bad_frames, input_length,
-                                                input_length + lengths[i],
-                                                True, True)
-
-        # Get the data corresponding to the indices
-        print('Indexing into data')
-        X[i] = markers[input_ids[i][::skip, :], :]
-        Y[i] = markers[target_ids[i][::skip, :lengths[i]], :]
-        XR = markers[target_ids[i][::skip, :(lengths[i] - 1):-1], :]
-        YR = Y[i][:, ::-1, :]
-
-        # Concatenate for use in the multiple prediction function
-        total[i] = np.concatenate((X[i], Y[i]), axis=1)
-        totalR = np.concatenate((XR, YR), axis=1)
-
-        run_folder = 'length_%d' % (lengths[i])
-        save_directory = os.path.join(viz_directory, run_folder)
-        if not os.path.exists(save_directory):
-            os.makedirs(save_directory)
-
-        # Analyze marker predictions over time
-        delta_markers[i], member_stds[i], predictions[i] = \
-            analyze_marker_predictions(model, total[i], totalR, Y[i],
-                                       marker_means, marker_stds,
-                                       save_directory,
-                                       plot_distribution=plot_distribution)
+    tasks = [dict(input_length=input_length, length=length, skip=skip,
+                  save_directory=os.path.join(viz_directory,
+                                              'length_%d' % (length)),
+                  plot_distribution=plot_distribution, batch_size=batch_size)
+             for length in lengths]
+    model_path = os.path.join(model_base_path, model_name)
+
+    # Analyze each gap length, saving the results of each as it finishes.
+    if n_workers > 1:
+        shared_arrays = [share_array(markers), share_array(bad_frames),
+                         share_array(marker_means), share_array(marker_stds)]
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(n_workers, initializer=init_worker,
+                          initargs=(model_path, shared_arrays,
+                                    incremental)) as pool:
+            for length in pool.imap_unordered(analyze_gap_length_worker,
+                                              tasks):
+                print('Finished length %d' % (length), flush=True)
+    else:
+        print('Loading model')
+        model = load_predictor(model_path, incremental)
+        for task in tasks:
+            analyze_gap_length(model, markers, bad_frames, marker_means,
+                               marker_stds, **task)
+        model.report()
+
+    # Collect the saved results into matlab cells.
+    names = ['delta_markers', 'member_stds', 'predictions', 'input',
+             'target', 'input_ids', 'target_ids', 'total']
+    cells = {name: np.zeros((lengths.shape[0],), dtype=object)
+             for name in names}
+    for i, task in enumerate(tasks):
+        results = loadmat(os.path.join(task['save_directory'], 'errors.mat'))
+        for name in names:
+            cells[name][i] = results[name]
 
     print('Saving predictions')
-    savemat(os.path.join(viz_directory, 'errors.mat'),
-            {'delta_markers': delta_markers, 'member_stds': member_stds,
-             'input': X, 'target': Y, 'input_ids': input_ids,
-             'skip': skip, 'stride': stride, 'target_ids': target_ids,
-             'markers': markers, 'total': total, 'marker_stds': marker_stds,
-<<<<<<< HEAD
-             'marker_means': marker_means, 'predictions': predictions})
-=======
-             'marker_means': marker_means})
->>>>>>> f3a986bb7c84eaa4badc22b96f1ee4a88df0b8d9
+    cells.update({'skip': skip, 'stride': stride, 'markers': markers,
+                  'marker_stds': marker_stds, 'marker_means': marker_means})
+    savemat(os.path.join(viz_directory, 'errors.mat'), cells)
 
 
 if __name__ == "__main__":
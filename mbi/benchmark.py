@@ -0,0 +1,522 @@
+"""Benchmark the throughput of mbi imputation."""
+import clize
+import h5py
+import json
+import keras
+from keras.layers import Input
+from keras.models import load_model
+import multiprocessing
+import numpy as np
+import os
+import platform
+import tempfile
+import tensorflow as tf
+import time
+import tracemalloc
+from build_ensemble import ensemble
+from incremental import IncrementalEnsemble, incremental_ensemble, \
+    incremental_model
+import models
+from rollout import ContextWindow, predict_gaps
+from runtime import InferenceRuntime
+
+
+def synthetic_markers(n_frames, n_markers, gap_rate, mean_gap_length,
+                      seed=0):
+    """Generate smooth z-scored marker trajectories with dropped markers.
+
+    :param n_frames: Number of frames to generate.
+    :param n_markers: Number of marker coordinates per frame.
+    :param gap_rate: Probability that a gap begins on any frame of a marker.
+    :param mean_gap_length: Mean length of the gaps (frames).
+    :param seed: Seed of the random number generator.
+    :return: markers, bad_frames
+    """
+    rng = np.random.RandomState(seed)
+    markers = np.cumsum(rng.randn(n_frames, n_markers), axis=0)
+    markers = (markers - np.mean(markers, axis=0)) / np.std(markers, axis=0)
+
+    bad_frames = np.zeros((n_frames, n_markers // 3))
+    for i in range(bad_frames.shape[1]):
+        gap_starts = np.where(rng.rand(n_frames) < gap_rate)[0]
+        gap_lengths = rng.geometric(1 / mean_gap_length, gap_starts.shape)
+        for start, length in zip(gap_starts, gap_lengths):
+            bad_frames[start:(start + length), i] = 1
+    return markers, bad_frames
+
+
+def sequential_predict_markers(model, X, bad_frames, markers_to_fix=None,
+                               error_diff_thresh=.25, outlier_thresh=3):
+    """Imputes markers one frame at a time.
+
+    Reference implementation of the frame by frame rollout that predict_gaps
+    replaces.
+    :param model: model to use for prediction
+    :param X: marker data (n_frames x n_markers)
+    :param bad_frames: logical matrix of shape (n_frames, n_markers/3)
+    :param markers_to_fix: boolean vector of length n_markers.
+    :param error_diff_thresh: z-scored distance at which predictions override
+                              marker measurements.
+    :param outlier_thresh: Threshold at which to ignore model predictions.
+    :return: preds, bad_frames
+    """
+    input_length = model.input.shape.as_list()[1]
+    bad_frames = np.repeat(bad_frames, 3, axis=1) > .5
+    fix_errors = np.any(markers_to_fix)
+
+    X = X[None, ...]
+    X_start = X[:, :input_length, :]
+    preds = np.zeros((X.shape))
+    preds[:, :input_length, :] = X_start
+    pred = np.zeros((1, 1, X.shape[2]))
+    for i in range(X.shape[1] - input_length):
+        next_frame_id = input_length + i
+        if fix_errors:
+            diff = pred[:, 0, :] - X[:, next_frame_id, :]
+            errors = np.squeeze(np.abs(diff) > error_diff_thresh)
+            errors[~markers_to_fix] = False
+            bad_frames[next_frame_id, errors] = True
+        if np.any(bad_frames[next_frame_id, :]):
+            pred = model.predict(X_start)
+        outliers = np.squeeze(np.abs(pred) > outlier_thresh)
+        pred[:, 0, outliers] = X[:, next_frame_id, outliers]
+        pred[:, 0, ~bad_frames[next_frame_id, :]] = \
+            X[:, next_frame_id, ~bad_frames[next_frame_id, :]]
+        preds[:, next_frame_id, :] = np.squeeze(pred)
+        X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
+    return np.squeeze(preds), bad_frames
+
+
+def build_test_model(input_length, n_markers, n_filters=32):
+    """Build a small untrained wave_net for benchmarking.
+
+    :param input_length: Model input length (frames)
+    :param n_markers: Number of markers per frame
+    :param n_filters: Number of filters per convolutional block
+    """
+    return models.wave_net('mean_squared_error', 1e-4, input_length, 1,
+                           n_markers, n_filters, 2, 1,
+                           int(np.floor(np.log2(input_length))))
+
+
+def benchmark_rollout(model_path=None, *, n_frames=20000, n_markers=60,
+                      input_length=9, gap_rate=.0002, mean_gap_length=20,
+                      dense_gap_rate=.01, dense_mean_gap_length=5,
+                      fix_errors=False, error_diff_thresh=.25,
+                      batch_size=1000, seed=0):
+    """Compare predict_gaps to the frame by frame rollout.
+
+    Both rollouts are timed on a session of sparse gaps, then compared on a
+    session of dense gaps. Suspicious measurements are always overridden in
+    the dense session, which carries rollouts on into the gaps that follow
+    them and exercises the merging of gaps.
+    :param model_path: Path to model to use for prediction. If None, uses a
+                       small untrained wave_net.
+    :param n_frames: Number of synthetic frames to impute.
+    :param n_markers: Number of marker coordinates per frame.
+    :param input_length: Model input length if building a test model.
+    :param gap_rate: Probability that a gap begins on any frame of a marker.
+    :param mean_gap_length: Mean length of the gaps (frames).
+    :param dense_gap_rate: Gap rate of the dense session.
+    :param dense_mean_gap_length: Mean length of the gaps of the dense
+                                  session.
+    :param fix_errors: Override suspicious measurements of the second half of
+                       the markers in the sparse session. Untrained models
+                       will flag most frames.
+    :param error_diff_thresh: Z-scored difference threshold marking suspicious
+                              frames
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param seed: Seed of the random number generator.
+    """
+    if model_path is None:
+        model = build_test_model(input_length, n_markers)
+    else:
+        model = load_model(model_path)
+        n_markers = model.input.shape.as_list()[2]
+    for name, session_gap_rate, session_gap_length, session_fix_errors in \
+            [('Sparse', gap_rate, mean_gap_length, fix_errors),
+             ('Dense', dense_gap_rate, dense_mean_gap_length, True)]:
+        markers_to_fix = np.zeros((n_markers)) > 1
+        if session_fix_errors:
+            markers_to_fix[(n_markers // 2):] = True
+        markers, bad_frames = synthetic_markers(n_frames, n_markers,
+                                                session_gap_rate,
+                                                session_gap_length, seed)
+        print('%s gaps: %.1f%% of frames have missing markers' %
+              (name, 100 * np.mean(np.any(bad_frames, axis=1))))
+
+        start = time.time()
+        preds_seq, bad_frames_seq = \
+            sequential_predict_markers(model, markers, bad_frames,
+                                       markers_to_fix=markers_to_fix,
+                                       error_diff_thresh=error_diff_thresh)
+        elapsed_seq = time.time() - start
+
+        start = time.time()
+        preds, bad_frames = \
+            predict_gaps(model, markers, bad_frames,
+                         markers_to_fix=markers_to_fix,
+                         error_diff_thresh=error_diff_thresh,
+                         batch_size=batch_size)
+        elapsed = time.time() - start
+
+        print('Sequential rollout: %.1f frames/sec' %
+              (n_frames / elapsed_seq))
+        print('Batched rollout: %.1f frames/sec' % (n_frames / elapsed))
+        print('Speedup: %.1fx' % (elapsed_seq / elapsed))
+        print('Max absolute difference: %g' %
+              (np.max(np.abs(preds - preds_seq))))
+        print('Bad frames match: %s' % (np.array_equal(bad_frames,
+                                                       bad_frames_seq)))
+
+
+def benchmark_context_window(*, n_windows=1000, input_length=9, n_markers=60,
+                             n_steps=1000):
+    """Compare ContextWindow to rebuilding the window with np.concatenate.
+
+    Reports the time per step and the peak memory allocated by the steps.
+    :param n_windows: Number of windows advanced at each step.
+    :param input_length: Number of frames per window.
+    :param n_markers: Number of marker coordinates per frame.
+    :param n_steps: Number of steps to time.
+    """
+    frames = np.random.RandomState(0).randn(n_windows, input_length,
+                                            n_markers)
+    frame = frames[:, 0, :].copy()
+
+    def concatenate_steps(X_start):
+        for i in range(n_steps):
+            X_start = np.concatenate((X_start[:, 1:, :], frame[:, None, :]),
+                                     axis=1)
+        return X_start
+
+    def context_window_steps(window):
+        for i in range(n_steps):
+            window.append(frame)
+        return window.view()
+
+    def concatenate_setup():
+        return frames.copy()
+
+    def context_window_setup():
+        window = ContextWindow(n_windows, input_length, n_markers)
+        window.fill(frames)
+        return window
+
+    results = {}
+    for name, setup, steps in [
+            ('concatenate', concatenate_setup, concatenate_steps),
+            ('ContextWindow', context_window_setup, context_window_steps)]:
+        state = setup()
+        start = time.time()
+        steps(state)
+        elapsed = time.time() - start
+
+        state = setup()
+        tracemalloc.start()
+        results[name] = steps(state)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%s: %.2f us/step, %d bytes peak allocation' %
+              (name, 1e6 * elapsed / n_steps, peak))
+    print('Windows match: %s' % (np.array_equal(results['concatenate'],
+                                                results['ContextWindow'])))
+
+
+def benchmark_runtime(model_path=None, *, n_windows=100, input_length=9,
+                      n_markers=60, n_calls=100, batch_size=1000):
+    """Compare InferenceRuntime to Model.predict on rollout sized batches.
+
+    :param model_path: Path to model to use for prediction. If None, uses a
+                       small untrained wave_net.
+    :param n_windows: Number of windows per call.
+    :param input_length: Model input length if building a test model.
+    :param n_markers: Number of marker coordinates per frame.
+    :param n_calls: Number of calls to time.
+    :param batch_size: Batch size of both predict functions.
+    """
+    if model_path is None:
+        model = build_test_model(input_length, n_markers)
+    else:
+        model = load_model(model_path)
+        input_length, n_markers = model.input.shape.as_list()[1:]
+    runtime = InferenceRuntime(model)
+    X = np.random.RandomState(0).randn(n_windows, input_length, n_markers)
+
+    # Warm up both functions before timing.
+    preds = model.predict(X, batch_size=batch_size)
+    preds_runtime = runtime.predict(X, batch_size=batch_size)
+    for name, predict in [('Model.predict', model.predict),
+                          ('InferenceRuntime', runtime.predict)]:
+        start = time.time()
+        for i in range(n_calls):
+            predict(X, batch_size=batch_size)
+        elapsed = time.time() - start
+        print('%s: %.3f ms/call' % (name, 1e3 * elapsed / n_calls))
+    runtime.report()
+    if not isinstance(preds, list):
+        preds, preds_runtime = [preds], [preds_runtime]
+    print('Predictions match: %s' %
+          (all(np.array_equal(a, b) for a, b in zip(preds, preds_runtime))))
+
+
+def benchmark_incremental(model_path=None, *, n_frames=20000, n_markers=60,
+                          input_length=9, gap_rate=.0002, mean_gap_length=20,
+                          batch_size=1000, net_name='wave_net', seed=0):
+    """Compare incremental inference to full-window prediction.
+
+    For LSTMs, the difference measures the approximation of step mode.
+    :param model_path: Path to model to use for prediction. If None, uses a
+                       small untrained wave_net or lstm_model.
+    :param n_frames: Number of synthetic frames to impute.
+    :param n_markers: Number of marker coordinates per frame.
+    :param input_length: Model input length if building a test model.
+    :param gap_rate: Probability that a gap begins on any frame of a marker.
+    :param mean_gap_length: Mean length of the gaps (frames).
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param net_name: Test model to build if model_path is None. Can be
+                     'wave_net' or 'lstm_model'.
+    :param seed: Seed of the random number generator.
+    """
+    if model_path is None and net_name == 'lstm_model':
+        model = models.lstm_model('mean_squared_error', 1e-4, input_length,
+                                  n_markers, 32)
+    elif model_path is None:
+        model = build_test_model(input_length, n_markers)
+    else:
+        model = load_model(model_path)
+        n_markers = model.input.shape.as_list()[2]
+    markers, bad_frames = synthetic_markers(n_frames, n_markers, gap_rate,
+                                            mean_gap_length, seed)
+
+    results = []
+    for name, predictor in [('Full-window', InferenceRuntime(model)),
+                            ('Incremental', incremental_model(model))]:
+        start = time.time()
+        results.append(predict_gaps(predictor, markers, bad_frames,
+                                    batch_size=batch_size)[0])
+        print('%s rollout: %.1f frames/sec' %
+              (name, n_frames / (time.time() - start)))
+        predictor.report()
+    print('Max abs difference: %g' % (np.max(np.abs(results[0] -
+                                                     results[1]))))
+
+
+def benchmark_ensemble(*, max_members=8, n_windows=1000, input_length=9,
+                       n_markers=60, n_filters=32, n_calls=20):
+    """Compare fused ensembles to running their members one by one.
+
+    :param max_members: Largest number of members. Ensembles of 1, 2, 4...
+                        members are timed.
+    :param n_windows: Number of windows per call.
+    :param input_length: Model input length.
+    :param n_markers: Number of marker coordinates per frame.
+    :param n_filters: Number of filters per convolutional block.
+    :param n_calls: Number of calls to time.
+    """
+    X = np.random.RandomState(0).randn(n_windows, input_length, n_markers)
+    members = [build_test_model(input_length, n_markers, n_filters)
+               for i in range(max_members)]
+    n_members = 1
+    while n_members <= max_members:
+        separate = IncrementalEnsemble(members[:n_members], True)
+        fused = incremental_ensemble(members[:n_members], True)
+        timings = []
+        for ensemble in [separate, fused]:
+            start = time.time()
+            for i in range(n_calls):
+                preds, member_preds = ensemble.predict(X, batch_size=n_windows)
+            timings.append(1e3 * (time.time() - start) / n_calls)
+        print('%d members: %.2f ms/call separate, %.2f ms/call fused' %
+              (n_members, timings[0], timings[1]), flush=True)
+        n_members *= 2
+
+
+def write_synthetic_dataset(data_path, *, n_frames=100000, n_markers=60,
+                            gap_rate=.0002, mean_gap_length=20,
+                            chunk_size=1000, seed=0):
+    """Write synthetic markers in the mbi .h5 layout.
+
+    Markers and bad_frames are stored frames-last and chunked, as convert
+    writes them, so they are read through the same loaders as a session.
+    :param data_path: Path to the .h5 file.
+    :param n_frames: Number of frames to generate.
+    :param n_markers: Number of marker coordinates per frame.
+    :param gap_rate: Probability that a gap begins on any frame of a marker.
+    :param mean_gap_length: Mean length of the gaps (frames).
+    :param chunk_size: Number of frames per chunk.
+    :param seed: Seed of the random number generator.
+    :return: Fraction of frames with missing markers.
+    """
+    markers, bad_frames = synthetic_markers(n_frames, n_markers, gap_rate,
+                                            mean_gap_length, seed)
+    rng = np.random.RandomState(seed)
+    marker_means = rng.uniform(-200, 200, (n_markers, 1))
+    marker_stds = rng.uniform(10, 50, (n_markers, 1))
+    chunk_size = min(int(chunk_size), n_frames)
+    with h5py.File(data_path, 'w') as f:
+        f.create_dataset('markers', data=markers.T,
+                         chunks=(n_markers, chunk_size))
+        f.create_dataset('bad_frames', data=bad_frames.T.astype('uint8'),
+                         chunks=(bad_frames.shape[1], chunk_size))
+        f.create_dataset('marker_means', data=marker_means)
+        f.create_dataset('marker_stds', data=marker_stds)
+    return np.mean(np.any(bad_frames, axis=1))
+
+
+def build_benchmark_model(net_name, input_length, n_markers, n_filters=32,
+                          n_members=3):
+    """Build a small untrained model of the given architecture.
+
+    :param net_name: 'wave_net', 'lstm_model' or 'ensemble', an ensemble of
+                     wave_nets that also returns member predictions.
+    :param input_length: Model input length (frames)
+    :param n_markers: Number of markers per frame
+    :param n_filters: Number of filters per convolutional block, or latent
+                      dimensions of the LSTM.
+    :param n_members: Number of members of the ensemble.
+    """
+    if net_name == 'wave_net':
+        return build_test_model(input_length, n_markers, n_filters)
+    if net_name == 'lstm_model':
+        return models.lstm_model('mean_squared_error', 1e-4, input_length,
+                                 n_markers, n_filters)
+    if net_name == 'ensemble':
+        members = [build_test_model(input_length, n_markers, n_filters)
+                   for i in range(n_members)]
+        for i, member in enumerate(members):
+            member.name = 'model_%d' % (i)
+        return ensemble(members, Input(batch_shape=members[0].input_shape),
+                        True)
+    raise ValueError('Unknown net_name %s.' % (net_name))
+
+
+def run_pipeline(model_path, data_path, save_path, kwargs):
+    """Run impute_markers and return its stages.
+
+    :param model_path: Path to model to use for prediction.
+    :param data_path: Path to marker and bad_frames data.
+    :param save_path: Path to .mat file where predictions will be saved.
+    :param kwargs: Other arguments of impute_markers.
+    :return: List of stages recorded by a StageTimer.
+    """
+    from impute_markers import impute_markers
+    from utils import StageTimer
+    timer = StageTimer()
+    impute_markers(model_path, data_path, save_path=save_path, timer=timer,
+                   **kwargs)
+    return timer.stages
+
+
+def benchmark_pipeline(*, save_path='benchmark_report.json', work_dir=None,
+                       net_names='wave_net,lstm_model,ensemble',
+                       n_frames=100000, n_markers=60, input_length=9,
+                       gap_rate=.0002, mean_gap_length=20, n_filters=32,
+                       n_members=3, batch_size=1000, fuse_passes=False,
+                       incremental=False, fix_errors=False, seed=0):
+    """Time each stage of impute_markers on a synthetic session.
+
+    A synthetic session with the requested gap statistics is written in the
+    mbi .h5 layout, and small untrained models are saved next to it. Each
+    model then imputes the session with impute_markers in a fresh process,
+    which records the duration and peak resident memory of the load,
+    load_model, forward, reverse, blend and save stages. Nothing requires a
+    GPU. Set CUDA_VISIBLE_DEVICES= to keep one out of the comparison.
+    :param save_path: Path to the .json report.
+    :param work_dir: Folder in which to write the session, models and
+                     predictions. Defaults to a temporary folder that is
+                     removed afterwards.
+    :param net_names: Comma separated test models: 'wave_net', 'lstm_model'
+                      and 'ensemble'.
+    :param n_frames: Number of synthetic frames to impute.
+    :param n_markers: Number of marker coordinates per frame.
+    :param input_length: Model input length (frames)
+    :param gap_rate: Probability that a gap begins on any frame of a marker.
+    :param mean_gap_length: Mean length of the gaps (frames).
+    :param n_filters: Number of filters per convolutional block, or latent
+                      dimensions of the LSTM.
+    :param n_members: Number of members of the ensemble.
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param fuse_passes: If True, run the forward and reverse passes together
+                        (see impute_markers).
+    :param incremental: If True, evaluate the models incrementally (see
+                        impute_markers).
+    :param fix_errors: Override suspicious measurements of the second half of
+                       the markers. Untrained models will flag most frames.
+    :param seed: Seed of the random number generator.
+    :return: Report
+    """
+    if work_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        work_dir = temp_dir.name
+    else:
+        temp_dir = None
+        os.makedirs(work_dir, exist_ok=True)
+
+    print('Writing synthetic session')
+    data_path = os.path.join(work_dir, 'synthetic_session.h5')
+    missing_fraction = write_synthetic_dataset(
+        data_path, n_frames=n_frames, n_markers=n_markers, gap_rate=gap_rate,
+        mean_gap_length=mean_gap_length, seed=seed)
+    print('%.1f%% of frames have missing markers' % (100 * missing_fraction))
+    markers_to_fix = np.zeros((n_markers)) > 1
+    if fix_errors:
+        markers_to_fix[(n_markers // 2):] = True
+    kwargs = dict(markers_to_fix=markers_to_fix, batch_size=batch_size,
+                  fuse_passes=fuse_passes, incremental=incremental)
+
+    report = {'config': dict(n_frames=n_frames, n_markers=n_markers,
+                             input_length=input_length, gap_rate=gap_rate,
+                             mean_gap_length=mean_gap_length,
+                             n_filters=n_filters, n_members=n_members,
+                             batch_size=batch_size, fuse_passes=fuse_passes,
+                             incremental=incremental, fix_errors=fix_errors,
+                             seed=seed,
+                             missing_fraction=float(missing_fraction)),
+              'platform': dict(machine=platform.platform(),
+                               cpu_count=os.cpu_count(),
+                               python=platform.python_version(),
+                               numpy=np.__version__,
+                               keras=keras.__version__,
+                               tensorflow=tf.__version__),
+              'runs': []}
+    context = multiprocessing.get_context('spawn')
+    for net_name in net_names.split(','):
+        model_path = os.path.join(work_dir, '%s.h5' % (net_name))
+        build_benchmark_model(net_name, input_length, n_markers, n_filters,
+                              n_members).save(model_path)
+        preds_path = os.path.join(work_dir, '%s_preds.mat' % (net_name))
+
+        # Each model runs in its own process, so that peak memory is its own.
+        print('Imputing with %s' % (net_name), flush=True)
+        with context.Pool(1) as pool:
+            stages = pool.apply(run_pipeline, (model_path, data_path,
+                                               preds_path, kwargs))
+        for stage in stages:
+            stage['frames_per_sec'] = n_frames / stage['seconds']
+            stage['peak_rss_mb'] = stage.pop('peak_rss') / 2**20
+        total = sum(stage['seconds'] for stage in stages)
+        report['runs'].append({
+            'net_name': net_name, 'stages': stages, 'seconds': total,
+            'frames_per_sec': n_frames / total,
+            'peak_rss_mb': max(stage['peak_rss_mb'] for stage in stages)})
+
+    if temp_dir is not None:
+        temp_dir.cleanup()
+
+    for run in report['runs']:
+        print('%s: %.1f frames/sec, %.1f MB peak RSS' %
+              (run['net_name'], run['frames_per_sec'], run['peak_rss_mb']))
+        for stage in run['stages']:
+            print('  %s: %.2f s, %.1f frames/sec, %.1f MB peak RSS' %
+                  (stage['name'], stage['seconds'], stage['frames_per_sec'],
+                   stage['peak_rss_mb']))
+    print('Saving to %s' % (save_path))
+    with open(save_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+if __name__ == "__main__":
+    # Wrapper for running from commandline
+    clize.run(benchmark_rollout, benchmark_context_window, benchmark_runtime,
+              benchmark_incremental, benchmark_ensemble, benchmark_pipeline)
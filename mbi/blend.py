@@ -0,0 +1,71 @@
+"""Blend forward and reverse marker predictions."""
+import numpy as np
+from rollout import find_runs
+
+
+def sigmoid(x, x_0, k):
+    """Sigmoid function.
+
+    For use in weighted averaging of marker predictions from
+    the forward and reverse passes.
+    :param x: domain
+    :param x_0: midpoint
+    :parak k: exponent constant.
+    """
+    return 1 / (1 + np.exp(-k*(x-x_0)))
+
+
+def reverse_weights(bad_frames, k=1):
+    """Compute the weight of the reverse pass at every frame of every gap.
+
+    Within a gap of length n, the weight of the reverse pass follows a
+    sigmoid centered on round(n/2). Gaps of all markers are found in a single
+    pass by laying the markers end to end, separated by a tracked frame.
+    :param bad_frames: Logical matrix (n_frames x n_markers) denoting frames
+                       in which a marker was imputed.
+    :param k: Exponent constant of the sigmoid.
+    :return: Weights (n_frames x n_markers), 0 outside of gaps.
+    """
+    n_frames, n_markers = bad_frames.shape
+    is_bad = np.zeros((n_markers, n_frames + 1), bool)
+    is_bad[:, :n_frames] = bad_frames.T > .5
+    is_bad = is_bad.ravel()
+    starts, lengths = find_runs(is_bad)
+
+    # Position of every bad frame within its gap.
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.arange(offsets.shape[0]) - offsets
+    midpoints = np.repeat(np.round(lengths / 2), lengths)
+
+    weights = np.zeros(is_bad.shape)
+    weights[is_bad] = sigmoid(positions, midpoints, k)
+    return weights.reshape((n_markers, n_frames + 1))[:, :n_frames].T
+
+
+def blend(predsF, predsR, bad_frames, k=1, member_stdsF=None,
+          member_stdsR=None):
+    """Compute the weighted average of the forward and reverse predictions.
+
+    :param predsF: Forward predictions (n_frames x n_markers*3)
+    :param predsR: Reverse predictions, in forward order.
+    :param bad_frames: Logical matrix (n_frames x n_markers) denoting frames
+                       in which a marker was imputed.
+    :param k: Exponent constant of the sigmoid.
+    :param member_stdsF: Optional std of the ensemble members of the forward
+                         pass, blended as variances.
+    :param member_stdsR: Optional std of the ensemble members of the reverse
+                         pass.
+    :return: preds(, member_stds). Forward predictions outside of gaps, and
+             member_stds of 0 outside of gaps.
+    """
+    is_bad = np.repeat(bad_frames > .5, 3, axis=1)
+    weightR = np.repeat(reverse_weights(bad_frames, k), 3, axis=1)
+    weightF = 1 - weightR
+    preds = np.where(is_bad, (predsF*weightF) + (predsR*weightR), predsF)
+    if member_stdsF is None:
+        return preds
+
+    member_stds = np.where(is_bad,
+                           np.sqrt(((member_stdsF**2)*weightF) +
+                                   ((member_stdsR**2)*weightR)), 0)
+    return preds, member_stds
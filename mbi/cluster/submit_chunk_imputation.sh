@@ -13,5 +13,5 @@ srun -l -n1 hostname
 srun -l -n1 echo $CUDA_VISIBLE_DEVICES
 
 PREDFUNC="/n/holylfs02/LABS/olveczky_lab/Diego/code/MarkerBasedImputation/mbi/predict_single_pass.py"
-srun -l --gres=gpu:1 -n1 cluster/py.sh $PREDFUNC $1 $2 $3 --save-path=$4 --stride=$5 --n-folds=$6 --fold-id=$7 --error-diff-thresh=.5 &
+srun -l --gres=gpu:1 -n1 cluster/py.sh $PREDFUNC $1 $2 $3 --save-path=$4 --stride=$5 --n-folds=$6 --fold-id=$7 --error-diff-thresh=.5 --checkpoint-interval=1800 &
 wait
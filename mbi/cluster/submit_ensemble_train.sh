@@ -0,0 +1,26 @@
+#!/bin/bash
+#SBATCH -J EnsembleTrain
+#SBATCH -p gpu_requeue      # partition (queue)
+#SBATCH -N 1                # number of nodes
+#SBATCH -n 1              # number of tasks
+#SBATCH --gres=gpu:1        # number of total gpus
+#SBATCH --mem 90000        # memory for all cores
+#SBATCH -t 0-24:00          # time (D-HH:MM)
+#SBATCH --export=ALL
+#SBATCH -o logs/ensembleTrain.Job.%N.%j.out    # STDOUT
+#SBATCH -e logs/ensembleTrain.Job.%N.%j.err    # STDERR
+
+srun -l -n1 hostname
+srun -l -n1 echo $CUDA_VISIBLE_DEVICES
+
+# Trains all members of the ensemble together in a single job, and builds the
+# ensemble in BASEOUTPUTPATH/model_ensemble. This replaces
+# submit_batch_train.sh followed by submit_build_ensemble.sh.
+FUNC="/n/holylfs02/LABS/olveczky_lab/Diego/code/MarkerBasedImputation/mbi/training.py"
+DATAPATH="/n/holylfs02/LABS/olveczky_lab/Diego/data/JDM27/20171208/JDM27_fullDay.h5"
+BASEOUTPUTPATH="/n/holylfs02/LABS/olveczky_lab/Diego/data/JDM27/20171208/models/stride_5"
+NMODELS=10
+
+srun -l --gres=gpu:1 -n1 -N1 cluster/py.sh $FUNC $DATAPATH --base-output-path=$BASEOUTPUTPATH --epochs=30 --stride=5 --n-members=$NMODELS
+
+wait
@@ -0,0 +1,226 @@
+"""Lazy readers of mbi marker datasets."""
+import clize
+import h5py
+import numpy as np
+import os
+
+
+class FrameView(object):
+    """Frame-major view of an HDF5 dataset stored frames-last.
+
+    MATLAB writes matrices column-major, so the datasets of mbi files hold
+    frames along their last axis. Indexing a FrameView with a frame slice,
+    e.g. view[start:end:stride], reads only those frames from disk and
+    returns them frame-major, as np.array(dset[:]).T[start:end:stride] would.
+    """
+
+    def __init__(self, dset):
+        """Initialize the view.
+
+        :param dset: HDF5 dataset of shape (n_columns, n_frames) or
+                     (n_frames,).
+        """
+        self.dset = dset
+        self.shape = dset.shape[::-1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, frames):
+        """Read a range of frames.
+
+        :param frames: Slice of frames with a positive step.
+        :return: Array of shape (n_selected_frames, n_columns)
+        """
+        if len(self.dset.shape) == 1:
+            return np.array(self.dset[frames])
+        return np.array(self.dset[:, frames]).T
+
+
+class MarkerDataset(object):
+    """Lazily read marker, marker_means, marker_stds, and bad_frames.
+
+    Marker means and stds are small and are read on opening. markers,
+    bad_frames, and any other frames-last dataset of the file are exposed as
+    FrameViews, so a job only reads the frames it imputes.
+
+    Usage:
+    with MarkerDataset(data_path) as dataset:
+        markers = dataset.markers[start_frame:end_frame:stride]
+        bad_frames = dataset.bad_frames[start_frame:end_frame:stride]
+    """
+
+    def __init__(self, data_path):
+        """Open the dataset.
+
+        :param data_path: Path to .h5 file
+        """
+        self.file = h5py.File(data_path, 'r')
+        self.markers = self['markers']
+        self.bad_frames = self['bad_frames']
+        self.marker_means = np.array(self.file['marker_means'][:]).T
+        self.marker_stds = np.array(self.file['marker_stds'][:]).T
+        self.n_frames = self.markers.shape[0]
+
+    def __getitem__(self, name):
+        return FrameView(self.file[name])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the underlying file."""
+        self.file.close()
+
+
+class ArrayDataset(object):
+    """Marker dataset held in memory.
+
+    Has the interface of MarkerDataset, with arrays in place of FrameViews.
+    """
+
+    def __init__(self, markers, marker_means, marker_stds, bad_frames):
+        """Initialize the dataset.
+
+        :param markers: Z-scored marker data (n_frames x n_markers)
+        :param marker_means: Mean of markers in real world coordinates
+        :param marker_stds: Std of markers in real world coordinates
+        :param bad_frames: Matrix (n_frames x n_markers/3) denoting frames in
+                           which there were marker errors.
+        """
+        self.markers = markers
+        self.marker_means = marker_means
+        self.marker_stds = marker_stds
+        self.bad_frames = bad_frames
+        self.n_frames = self.markers.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Nothing to release."""
+        pass
+
+
+def open_session(data_path):
+    """Open the marker data of a session.
+
+    .h5 files are read lazily. .mat sessions are read from their converted
+    .h5 file when it is up to date, and are otherwise loaded in memory.
+    :param data_path: Path to marker and bad_frames data. Can be hdf5 or
+                      mat -v7.3.
+    :return: MarkerDataset or ArrayDataset
+    """
+    filename, file_extension = os.path.splitext(data_path)
+    accepted_extensions = {'.h5', '.hdf5', '.mat'}
+    if file_extension not in accepted_extensions:
+        raise ValueError('Improper extension: hdf5 or \
+                         mat -v7.3 file required.')
+
+    if file_extension == '.mat':
+        converted = find_converted(data_path)
+        if converted is None:
+            # Convert the session once to skip this on later runs.
+            return ArrayDataset(*read_mat_session(data_path))
+        data_path = converted
+        print('Using converted session %s' % (data_path))
+    return MarkerDataset(data_path)
+
+
+def converted_path(data_path):
+    """Path of the canonical .h5 conversion of a .mat session.
+
+    :param data_path: Path to .mat -v7.3 session.
+    """
+    return os.path.splitext(data_path)[0] + '_mbi.h5'
+
+
+def find_converted(data_path):
+    """Find an up to date conversion of a .mat session.
+
+    :param data_path: Path to .mat -v7.3 session.
+    :return: Path to the converted .h5 file, or None if it does not exist or
+             is older than the session.
+    """
+    path = converted_path(data_path)
+    if os.path.exists(path) and \
+            os.path.getmtime(path) >= os.path.getmtime(data_path):
+        return path
+    return None
+
+
+def read_mat_session(data_path, frames_last=False):
+    """Read and z-score the markers and bad frames of a .mat session.
+
+    Each marker of the markers_aligned_preproc struct and each cell of
+    bad_frames_agg is read once, in bulk.
+    :param data_path: Path to .mat -v7.3 session.
+    :param frames_last: If True, return markers and bad_frames in the
+                        frames-last layout of mbi .h5 files.
+    :return: markers, marker_means, marker_stds, bad_frames
+    """
+    with h5py.File(data_path, 'r') as f:
+        # Markers are stored (n_dims, n_frames), so stacking them gives the
+        # frames-last layout.
+        struct = f['markers_aligned_preproc']
+        markers = np.concatenate([struct[name][:] for name in struct.keys()],
+                                 axis=0).astype('float64')
+
+        # Express bad_frames_agg as a logical matrix rather than indices.
+        references = f['bad_frames_agg'][:]
+        bad_frames = np.zeros((references.shape[0], markers.shape[1]),
+                              'uint8')
+        for i in range(references.shape[0]):
+            cell = f[references[i, 0]]
+            if cell.attrs.get('MATLAB_empty', 0):
+                continue
+            bad_frames[i, np.squeeze(cell[:]).astype('int32') - 1] = 1
+
+    # Z-score the marker data in place.
+    marker_means = np.mean(markers, axis=1)[:, None]
+    marker_stds = np.std(markers, axis=1)[:, None]
+    markers -= marker_means
+    markers /= marker_stds
+    if frames_last:
+        return markers, marker_means, marker_stds, bad_frames
+    return markers.T, marker_means.T, marker_stds.T, bad_frames.T
+
+
+def convert(data_path, *, save_path=None, chunk_size=1000):
+    """Convert a .mat session to the canonical mbi .h5 layout.
+
+    The conversion is done once per session. impute_markers and
+    predict_single_pass then read the converted file in place of the .mat
+    whenever it is up to date.
+    :param data_path: Path to .mat -v7.3 session with markers_aligned_preproc
+                      and bad_frames_agg.
+    :param save_path: Path to the converted .h5 file. Defaults to the session
+                      path with the extension replaced by _mbi.h5, where the
+                      loaders look for it.
+    :param chunk_size: Number of frames per chunk.
+    """
+    if save_path is None:
+        save_path = converted_path(data_path)
+    print('Reading %s' % (data_path))
+    markers, marker_means, marker_stds, bad_frames = \
+        read_mat_session(data_path, frames_last=True)
+    chunk_size = min(int(chunk_size), markers.shape[1])
+
+    print('Saving to %s' % (save_path))
+    with h5py.File(save_path, 'w') as f:
+        f.create_dataset('markers', data=markers,
+                         chunks=(markers.shape[0], chunk_size))
+        f.create_dataset('bad_frames', data=bad_frames,
+                         chunks=(bad_frames.shape[0], chunk_size))
+        f.create_dataset('marker_means', data=marker_means)
+        f.create_dataset('marker_stds', data=marker_stds)
+
+if __name__ == "__main__":
+    # Wrapper for running from commandline
+    clize.run(convert)
@@ -0,0 +1,110 @@
+"""Export WaveNets and ensembles at reduced precision for CPU inference."""
+import clize
+import numpy as np
+import os
+from scipy.io import savemat
+import time
+from dataset import open_session
+from incremental import IncrementalWaveNet, load_incremental
+from rollout import predict_gaps
+
+
+def export_model(model_path, save_path, *, precision='float16'):
+    """Export a WaveNet or ensemble of WaveNets to an .npz file.
+
+    The exported model runs in the numpy engine of incremental.py, and can be
+    passed as model_path to impute_markers, predict_single_pass and
+    impute_folds. Check its accuracy with validate_export before use.
+    :param model_path: Path to model or ensemble.
+    :param save_path: Path to the exported .npz file.
+    :param precision: Precision of the kernels: 'float32', 'float16' or
+                      'int8'.
+    """
+    print('Loading model')
+    model = load_incremental(model_path, precision)
+    if not isinstance(model, IncrementalWaveNet):
+        raise ValueError('Only WaveNets and ensembles of identical WaveNets '
+                         'can be exported.')
+    print('Saving to %s' % (save_path))
+    model.save(save_path)
+    print('Exported %d members in %s: %.1f MB' %
+          (model.n_members, precision, os.path.getsize(save_path) / 1e6))
+
+
+def marker_errors(preds, preds_ref, bad_frames, marker_means, marker_stds):
+    """Distance between two imputations of the same markers, in mm.
+
+    :param preds: Z-scored predictions (n_frames x n_markers*3)
+    :param preds_ref: Z-scored reference predictions.
+    :param bad_frames: Logical matrix (n_frames x n_markers*3) of imputed
+                       coordinates.
+    :param marker_means: Mean of markers in real world coordinates
+    :param marker_stds: Std of markers in real world coordinates
+    :return: Distance of each imputed marker (n_imputed,)
+    """
+    delta = (preds - preds_ref) * marker_stds
+    delta = np.reshape(delta, (delta.shape[0], -1, 3))
+    is_bad = np.reshape(bad_frames, (bad_frames.shape[0], -1, 3))
+    return np.sqrt(np.sum(delta**2, axis=2))[np.any(is_bad, axis=2)]
+
+
+def validate_export(model_path, export_path, data_path, *, start_frame=0,
+                    n_frames=None, stride=1, batch_size=1000,
+                    save_path=None):
+    """Compare the imputation of an exported model to the float32 model.
+
+    Imputes the frames with both models and reports the distance between
+    their imputed marker positions in mm, after applying marker_stds and
+    marker_means, along with the imputation speed of each.
+    :param model_path: Path to the float32 model or ensemble.
+    :param export_path: Path to the exported .npz model.
+    :param data_path: Path to marker and bad_frames data. Can be hdf5 or
+                      mat -v7.3.
+    :param start_frame: Frame at which to begin imputation.
+    :param n_frames: Number of frames to impute. Defaults to all frames.
+    :param stride: stride length between frames for faster imputation.
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param save_path: Optional .mat file in which to save the errors.
+    :return: Distances of the imputed markers (mm)
+    """
+    print('Loading data')
+    with open_session(data_path) as dataset:
+        if n_frames is None:
+            n_frames = dataset.n_frames - start_frame
+        frames = slice(start_frame, start_frame + n_frames, stride)
+        markers = dataset.markers[frames]
+        bad_frames = dataset.bad_frames[frames]
+        marker_means = dataset.marker_means
+        marker_stds = dataset.marker_stds
+
+    results = []
+    for name, path in [('float32', model_path), ('exported', export_path)]:
+        model = load_incremental(path)
+        start = time.time()
+        results.append(predict_gaps(model, markers, bad_frames,
+                                    batch_size=batch_size))
+        elapsed = time.time() - start
+        print('%s model: %.1f frames/sec' %
+              (name, markers.shape[0] / elapsed), flush=True)
+        model.report()
+
+    (preds_ref, bad_ref), (preds, bad) = results
+    errors = marker_errors(preds, preds_ref, bad_ref | bad, marker_means,
+                           marker_stds)
+    if errors.size == 0:
+        print('No imputed markers')
+        return errors
+    print('Distance to the float32 imputation over %d imputed markers: '
+          'mean %.3f mm, median %.3f mm, 99th percentile %.3f mm, '
+          'max %.3f mm' %
+          (errors.size, np.mean(errors), np.median(errors),
+           np.percentile(errors, 99), np.max(errors)))
+    if save_path is not None:
+        print('Saving to %s' % (save_path))
+        savemat(save_path, {'errors': errors, 'model_path': model_path,
+                            'export_path': export_path})
+    return errors
+
+if __name__ == "__main__":
+    # Wrapper for running from commandline
+    clize.run(export_model, validate_export)
@@ -0,0 +1,147 @@
+"""Impute all folds of a session in a local process pool."""
+import clize
+import multiprocessing
+import numpy as np
+import os
+import time
+from dataset import ArrayDataset, open_session
+from merge import merge
+
+# State of each worker process, set once by init_worker.
+worker = {}
+
+
+def share_array(array):
+    """Copy an array into shared memory.
+
+    :param array: Array to share.
+    :return: (buffer, dtype, shape), to be passed to worker processes on
+             creation and read with np.frombuffer.
+    """
+    array = np.ascontiguousarray(array)
+    buffer = multiprocessing.RawArray('b', max(array.nbytes, 1))
+    shared = np.frombuffer(buffer, array.dtype, array.size)
+    shared[:] = array.ravel()
+    return buffer, array.dtype.str, array.shape
+
+
+def read_shared_array(buffer, dtype, shape):
+    """Read-only view of an array shared with share_array."""
+    array = np.frombuffer(buffer, dtype, int(np.prod(shape))).reshape(shape)
+    array.flags.writeable = False
+    return array
+
+
+def init_worker(model_path, shared_arrays, incremental=False):
+    """Load the model and attach the shared dataset once per worker.
+
+    :param model_path: Path to model to use for prediction.
+    :param shared_arrays: markers, marker_means, marker_stds and bad_frames
+                          as returned by share_array.
+    :param incremental: If True, evaluate the model incrementally.
+    """
+    from keras.models import load_model
+    from incremental import is_exported, load_incremental
+    from runtime import InferenceRuntime
+    arrays = [read_shared_array(*shared) for shared in shared_arrays]
+    worker['dataset'] = ArrayDataset(*arrays)
+    if incremental or is_exported(model_path):
+        worker['model'] = load_incremental(model_path)
+    else:
+        worker['model'] = InferenceRuntime(load_model(model_path))
+
+
+def impute_fold(task):
+    """Impute a single fold with the worker's model and dataset.
+
+    :param task: (pass_direction, fold_id, kwargs of predict_single_pass)
+    :return: pass_direction, fold_id, elapsed time (s)
+    """
+    from predict_single_pass import predict_single_pass
+    pass_direction, fold_id, kwargs = task
+    start = time.time()
+    predict_single_pass(None, None, pass_direction, fold_id=fold_id,
+                        model=worker['model'], dataset=worker['dataset'],
+                        **kwargs)
+    return pass_direction, fold_id, time.time() - start
+
+
+def impute_folds(model_path, data_path, save_path, *, merged_path=None,
+                 stride=1, n_folds=10, n_workers=None, markers_to_fix=None,
+                 error_diff_thresh=.25, batch_size=1000, halo=0, stream=True,
+                 incremental=False):
+    """Impute the forward and reverse passes of all folds, then merge them.
+
+    The session is read once and shared with the workers through shared
+    memory. Each worker loads the model once and imputes folds until none
+    are left. Fold files are identical to those of predict_single_pass.
+    :param model_path: Path to model to use for prediction.
+    :param data_path: Path to marker and bad_frames data. Can be hdf5 or
+                      mat -v7.3.
+    :param save_path: Path to a folder in which to store the prediction chunks.
+    :param merged_path: Path to .h5 file where merged predictions will be
+                        saved. If None, folds are not merged.
+    :param stride: stride length between frames for faster imputation.
+    :param n_folds: Number of folds across which to divide data for faster
+                    imputation.
+    :param n_workers: Number of worker processes. Defaults to the number of
+                      cpus, up to the number of folds of both passes.
+    :param markers_to_fix: Markers for which to override suspicious MoCap
+                           measurements
+    :param error_diff_thresh: Z-scored difference threshold marking suspicious
+                              frames
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param halo: Number of frames of context read around each fold (see
+                 predict_single_pass).
+    :param stream: If True, merge folds one at a time (see merge).
+    :param incremental: If True, evaluate WaveNet models incrementally and
+                        step LSTM models one frame at a time (see
+                        incremental.py).
+    """
+    tasks = [(pass_direction, fold_id) for fold_id in range(n_folds)
+             for pass_direction in ['forward', 'reverse']]
+    if n_workers is None:
+        n_workers = min(os.cpu_count(), len(tasks))
+
+    # Read the session once. Only the strided frames are shared, so folds
+    # are imputed with a stride of 1 over them.
+    print('Loading data')
+    with open_session(data_path) as dataset:
+        shared_arrays = [share_array(dataset.markers[::stride]),
+                         share_array(dataset.marker_means),
+                         share_array(dataset.marker_stds),
+                         share_array(dataset.bad_frames[::stride])]
+    # Exported models are loaded incrementally by the workers, which
+    # predict_single_pass must be told.
+    from incremental import is_exported
+    incremental = incremental or is_exported(model_path)
+    kwargs = dict(save_path=save_path, stride=1, n_folds=n_folds,
+                  markers_to_fix=markers_to_fix,
+                  error_diff_thresh=error_diff_thresh, batch_size=batch_size,
+                  halo=halo, incremental=incremental)
+
+    # Workers are spawned so that each starts its own tensorflow session.
+    print('Imputing %d folds with %d workers' % (len(tasks), n_workers),
+          flush=True)
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    initargs = (model_path, shared_arrays, incremental)
+    with context.Pool(n_workers, initializer=init_worker,
+                      initargs=initargs) as pool:
+        tasks = [(pass_direction, fold_id, kwargs)
+                 for pass_direction, fold_id in tasks]
+        for pass_direction, fold_id, elapsed in \
+                pool.imap_unordered(impute_fold, tasks):
+            print('Imputed %s fold %d in %.1f s' %
+                  (pass_direction, fold_id, elapsed), flush=True)
+    print('Imputed all folds in %.1f s' % (time.time() - start), flush=True)
+
+    if merged_path is not None:
+        fold_paths = [os.path.join(save_path, '%s_fold_id_%d.mat' %
+                                   (pass_direction, fold_id))
+                      for pass_direction, fold_id, _ in tasks]
+        merge(merged_path, *fold_paths, stream=stream)
+
+if __name__ == "__main__":
+    # Wrapper for running from commandline
+    clize.run(impute_folds)
@@ -1,29 +1,19 @@
 """Imputes markers with mbi models."""
 import clize
-import h5py
 from keras.models import load_model
 import numpy as np
-import os
-from scipy.io import savemat
-from scipy import stats
-from skimage import measure
-
-
-def sigmoid(x, x_0, k):
-    """Sigmoid function.
-
-    For use in weighted averaging of marker predictions from
-    the forward and reverse passes.
-    :param x: domain
-    :param x_0: midpoint
-    :parak k: exponent constant.
-    """
-    return 1 / (1 + np.exp(-k*(x-x_0)))
+from dataset import open_session
+from blend import blend
+from incremental import incremental_model, is_exported, load_incremental
+from runtime import as_runtime
+from rollout import predict_gaps, predict_passes
+from store import PredictionStore
+from utils import StageTimer
 
 
 def predict_markers(model, X, bad_frames, markers_to_fix=None,
                     error_diff_thresh=.25, outlier_thresh=3,
-                    return_member_data=False):
+                    return_member_data=False, batch_size=1000):
     """Imputes the position of missing markers.
 
     :param model: model to use for prediction
@@ -39,108 +29,25 @@ def predict_markers(model, X, bad_frames, markers_to_fix=None,
     :param return_member_data: If true, also return the predictions of each
                                ensemble member in a matrix of size
                                n_members x n_frames x n_markers. The
+    :param batch_size: Maximum number of gaps imputed in a single model call.
     :return: preds, bad_frames
     """
-    # Get the input lengths and find the first instance of all good frames.
-    input_length = model.input.shape.as_list()[1]
-    bad_frames = np.repeat(bad_frames, 3, axis=1) > .5
-    num_bad_markers = np.sum(bad_frames, axis=1)
-    startpoint = 0
-    for i in range(X.shape[0]):
-
-        if np.any(num_bad_markers[startpoint:(startpoint+input_length)]):
-            startpoint += startpoint
-        else:
-            break
-
-    # See whether you should fix errors
-    fix_errors = np.any(markers_to_fix)
-
-    # Reshape and get the starting seed.
-    X = X[None, ...]
-    X_start = X[:, startpoint:(startpoint+input_length), :]
-
-    # Preallocate
-    preds = np.zeros((X.shape))
-    pred = np.zeros((1, 1, X.shape[2]))
-
     if return_member_data:
-        n_members = model.output_shape[1][1]
-        member_preds = np.zeros((n_members, X.shape[1], X.shape[2]))
-        member_pred = np.zeros((1, n_members, X.shape[2]))
-
-        # At each step, generate a prediction, replace the predictions of
-        # markers you do not want to predict with the ground truth, and append
-        # the resulting vector to the end of the next input chunk.
-        for i in range(startpoint, X.shape[1]-input_length-startpoint):
-            if np.mod(i, 10000) == 0:
-                print('Predicting frame: ', i)
-            next_frame_id = (startpoint+input_length)+i
-
-            # If there is a marker prediction that is greater than the
-            # difference threshold above, mark it as a bad frame.
-            # These are likely just jumps or identity swaps from MoCap that
-            # were not picked up by preprocessing.
-            if fix_errors:
-                diff = pred[:, 0, :] - X[:, next_frame_id, :]
-                errors = np.squeeze(np.abs(diff) > error_diff_thresh)
-                errors[~markers_to_fix] = False
-                bad_frames[next_frame_id, errors] = True
-            if np.any(bad_frames[next_frame_id, :]):
-                pred, member_pred = model.predict(X_start)
-
-            # Detect anomalous predictions.
-            outliers = np.squeeze(np.abs(pred) > outlier_thresh)
-            pred[:, 0, outliers] = X[:, next_frame_id, outliers]
-
-            # Only use the predictions for the bad markers. Take the
-            # predictions and append to the end of X_start for future
-            # prediction.
-            pred[:, 0, ~bad_frames[next_frame_id, :]] = \
-                X[:, next_frame_id, ~bad_frames[next_frame_id, :]]
-            member_pred[:, 0, ~bad_frames[next_frame_id, :]] = 0
-            preds[:, next_frame_id, :] = np.squeeze(pred)
-            member_preds[:, next_frame_id, :] = np.squeeze(member_pred)
-            X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
-        return np.squeeze(preds), bad_frames, member_preds
-    else:
-        # At each step, generate a prediction, replace the predictions of
-        # markers you do not want to predict with the ground truth, and append
-        # the resulting vector to the end of the next input chunk.
-        for i in range(startpoint, X.shape[1]-input_length-startpoint):
-            if np.mod(i, 10000) == 0:
-                print('Predicting frame: ', i)
-            next_frame_id = (startpoint+input_length)+i
-
-            # If there is a marker prediction that is greater than the
-            # difference threshold above, mark it as a bad frame.
-            # These are likely just jumps or identity swaps from MoCap that
-            # were not picked up by preprocessing.
-            if fix_errors:
-                diff = pred[:, 0, :] - X[:, next_frame_id, :]
-                errors = np.squeeze(np.abs(diff) > error_diff_thresh)
-                errors[~markers_to_fix] = False
-                bad_frames[next_frame_id, errors] = True
-            if np.any(bad_frames[next_frame_id, :]):
-                pred = model.predict(X_start)
-
-            # Detect anomalous predictions.
-            outliers = np.squeeze(np.abs(pred) > outlier_thresh)
-            pred[:, 0, outliers] = X[:, next_frame_id, outliers]
-
-            # Only use the predictions for the bad markers. Take the
-            # predictions and append to the end of X_start for future
-            # prediction.
-            pred[:, 0, ~bad_frames[next_frame_id, :]] = \
-                X[:, next_frame_id, ~bad_frames[next_frame_id, :]]
-            preds[:, next_frame_id, :] = np.squeeze(pred)
-            X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
-        return np.squeeze(preds), bad_frames
+        return predict_gaps(model, X, bad_frames,
+                            markers_to_fix=markers_to_fix,
+                            error_diff_thresh=error_diff_thresh,
+                            outlier_thresh=outlier_thresh,
+                            member_data='preds', batch_size=batch_size)
+    return predict_gaps(model, X, bad_frames, markers_to_fix=markers_to_fix,
+                        error_diff_thresh=error_diff_thresh,
+                        outlier_thresh=outlier_thresh, batch_size=batch_size)
 
 
 def impute_markers(model_path, data_path, *, save_path=None, start_frame=None,
                    n_frames=None, stride=1, markers_to_fix=None,
-                   error_diff_thresh=.25, model=None):
+                   error_diff_thresh=.25, model=None, batch_size=1000,
+                   fuse_passes=False, incremental=False, timer=None,
+                   save_dtype='float32', compression='gzip'):
     """Imputes the position of missing markers.
 
     :param model_path: Path to model to use for prediction.
@@ -155,52 +62,31 @@ def impute_markers(model_path, data_path, *, save_path=None, start_frame=None,
     :param error_diff_thresh: Z-scored difference threshold marking suspicious
                               frames
     :param model: Model to be used in prediction. Overrides model_path.
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param fuse_passes: If True, run the forward and reverse passes together,
+                        stacking the gaps of both directions into each model
+                        call. Batches are up to twice as large.
+    :param incremental: If True, evaluate WaveNet models incrementally,
+                        reusing the activations of the previous frame, and
+                        step LSTM models one frame at a time, which is
+                        approximate (see incremental.py).
+    :param timer: Optional StageTimer in which to record the load,
+                  load_model, forward, reverse (or passes when fused), blend
+                  and save stages.
+    :param save_dtype: Dtype of the saved predictions and markers.
+    :param compression: HDF5 compression of the saved frames, or 'none'.
     :return: preds
     """
-    # Check data extensions
-    filename, file_extension = os.path.splitext(data_path)
-    accepted_extensions = {'.h5', '.hdf5', '.mat'}
-    if file_extension not in accepted_extensions:
-        raise ValueError('Improper extension: hdf5 or \
-                         mat -v7.3 file required.')
+    if timer is None:
+        timer = StageTimer()
 
-    # Load data
+    # Load data. Only the frames to impute are read below.
     print('Loading data')
-    f = h5py.File(data_path, 'r')
-    if file_extension in {'.h5', '.hdf5'}:
-        markers = np.array(f['markers'][:]).T
-        marker_means = np.array(f['marker_means'][:]).T
-        marker_stds = np.array(f['marker_stds'][:]).T
-        bad_frames = np.array(f['bad_frames'][:]).T
-    else:
-        # Get the markers data from the struct
-        dset = 'markers_aligned_preproc'
-        marker_names = list(f[dset].keys())
-        n_frames_tot = f[dset][marker_names[0]][:].T.shape[0]
-        n_dims = f[dset][marker_names[0]][:].T.shape[1]
-
-        markers = np.zeros((n_frames_tot, len(marker_names)*n_dims))
-        for i in range(len(marker_names)):
-            marker = f[dset][marker_names[i]][:].T
-            for j in range(n_dims):
-                markers[:, i*n_dims + j] = marker[:, j]
-
-        # Z-score the marker data
-        marker_means = np.mean(markers, axis=0)
-        marker_means = marker_means[None, ...]
-        marker_stds = np.std(markers, axis=0)
-        marker_stds = marker_stds[None, ...]
-        print(marker_means)
-        print(marker_stds)
-        markers = stats.zscore(markers)
-
-        # Get the bad_frames data from the cell
-        dset = 'bad_frames_agg'
-        n_markers = f[dset][:].shape[0]
-        bad_frames = np.zeros((markers.shape[0], n_markers))
-        for i in range(n_markers):
-            reference = f[dset][i][0]
-            bad_frames[np.squeeze(f[reference][:]).astype('int32') - 1, i] = 1
+    dataset = open_session(data_path)
+    markers = dataset.markers
+    marker_means = dataset.marker_means
+    marker_stds = dataset.marker_stds
+    bad_frames = dataset.bad_frames
 
     # Set number of frames to impute
     if n_frames is None:
@@ -224,13 +110,28 @@ def impute_markers(model_path, data_path, *, save_path=None, start_frame=None,
         raise ValueError("Improper n_frames to predict: likely asked to " +
                          "predict zero frames.")
 
-    markers = markers[start_frame:(start_frame + n_frames):stride, :]
-    bad_frames = bad_frames[start_frame:(start_frame + n_frames):stride, :]
-
-    # Load model
-    if model is None:
+    markers = markers[start_frame:(start_frame + n_frames):stride]
+    bad_frames = bad_frames[start_frame:(start_frame + n_frames):stride]
+    dataset.close()
+    timer.stop('load')
+
+    # Load model. Exported models only run in the numpy engine.
+    if model is None and is_exported(model_path):
+        incremental = True
+    # Models passed already wrapped for incremental inference stay so.
+    if model is not None and hasattr(model, 'predict_windows'):
+        incremental = True
+    if model is None and incremental:
+        print('Loading model')
+        model = load_incremental(model_path)
+    elif model is None:
         print('Loading model')
         model = load_model(model_path)
+    if incremental:
+        model = incremental_model(model)
+    else:
+        model = as_runtime(model)
+    timer.stop('load_model')
 
     # Check how many outputs the model has, and how many members if returning
     # member data.
@@ -239,8 +140,6 @@ def impute_markers(model_path, data_path, *, save_path=None, start_frame=None,
         return_member_data = True
     else:
         return_member_data = False
-        member_predsF = [None]
-        member_predsR = [None]
 
     # Set Markers to fix
     if markers_to_fix is None:
@@ -250,21 +149,39 @@ def impute_markers(model_path, data_path, *, save_path=None, start_frame=None,
         markers_to_fix[42:] = True
 
     # If the model can return the member predictions, do so.
-    if return_member_data:
+    if fuse_passes:
+        print('Imputing markers: forward and reverse passes')
+        passes = predict_passes(model, [markers, markers[::-1, :]],
+                                [bad_frames, bad_frames[::-1, :]],
+                                markers_to_fix=markers_to_fix,
+                                error_diff_thresh=error_diff_thresh,
+                                member_data='preds' if return_member_data
+                                else None, batch_size=batch_size)
+        if return_member_data:
+            (predsF, bad_framesF, member_predsF), \
+                (predsR, bad_framesR, member_predsR) = passes
+        else:
+            (predsF, bad_framesF), (predsR, bad_framesR) = passes
+        timer.stop('passes')
+    elif return_member_data:
         # Forward predict
         print('Imputing markers: forward pass')
         predsF, bad_framesF, member_predsF = \
             predict_markers(model, markers, bad_frames,
                             markers_to_fix=markers_to_fix,
                             error_diff_thresh=error_diff_thresh,
-                            return_member_data=return_member_data)
+                            return_member_data=return_member_data,
+                            batch_size=batch_size)
+        timer.stop('forward')
         # Reverse Predict
         print('Imputing markers: reverse pass')
         predsR, bad_framesR, member_predsR = \
             predict_markers(model, markers[::-1, :], bad_frames[::-1, :],
                             markers_to_fix=markers_to_fix,
                             error_diff_thresh=error_diff_thresh,
-                            return_member_data=return_member_data)
+                            return_member_data=return_member_data,
+                            batch_size=batch_size)
+        timer.stop('reverse')
     else:
         # Forward predict
         print('Imputing markers: forward pass')
@@ -272,14 +189,18 @@ def impute_markers(model_path, data_path, *, save_path=None, start_frame=None,
             predict_markers(model, markers, bad_frames,
                             markers_to_fix=markers_to_fix,
                             error_diff_thresh=error_diff_thresh,
-                            return_member_data=return_member_data)
+                            return_member_data=return_member_data,
+                            batch_size=batch_size)
+        timer.stop('forward')
         # Reverse Predict
         print('Imputing markers: reverse pass')
         predsR, bad_framesR = \
             predict_markers(model, markers[::-1, :], bad_frames[::-1, :],
                             markers_to_fix=markers_to_fix,
                             error_diff_thresh=error_diff_thresh,
-                            return_member_data=return_member_data)
+                            return_member_data=return_member_data,
+                            batch_size=batch_size)
+        timer.stop('reverse')
 
     # Convert to real world coordinates
     markers_world = np.zeros((markers.shape))
@@ -306,30 +227,26 @@ def impute_markers(model_path, data_path, *, save_path=None, start_frame=None,
     # Compute the weighted average of the forward and reverse predictions using
     # a logistic function
     print('Computing weighted average')
-    preds_world = np.zeros(predsF_world.shape)
-    for i in range(bad_frames.shape[1]*3):
-        is_bad = bad_frames[:, np.floor(i/3).astype('int32')]
-        CC = measure.label(is_bad, background=0)
-        num_CC = len(np.unique(CC))-1
-        preds_world[:, i] = predsF_world[:, i]
-        for j in range(num_CC):
-            length_CC = np.sum(CC == (j+1))
-            x_0 = np.round(length_CC/2)
-            k = 1
-            weightR = sigmoid(np.arange(length_CC), x_0, k)
-            weightF = 1-weightR
-            preds_world[CC == (j+1), i] = \
-                (predsF_world[CC == (j+1), i]*weightF) +\
-                (predsR_world[CC == (j+1), i]*weightR)
+    preds_world = blend(predsF_world, predsR_world, bad_frames, k=1)
+    timer.stop('blend')
+
+    model.report()
 
-    # Save predictions to a matlab file.
+    # Save predictions to a MATLAB v7.3 file.
     if save_path is not None:
         s = 'Saving to %s' % (save_path)
         print(s)
-        savemat(save_path, {'preds': preds_world, 'markers': markers_world,
-                            'badFrames': bad_frames,
-                            'member_predsF': member_predsF,
-                            'member_predsR': member_predsR})
+        with PredictionStore(save_path, 'w', dtype=save_dtype,
+                             compression=compression) as store:
+            store.write('preds', preds_world, store_dtype=True)
+            store.write('markers', markers_world, store_dtype=True)
+            store.write('badFrames', bad_frames)
+            if return_member_data:
+                store.write('member_predsF', member_predsF,
+                            store_dtype=True)
+                store.write('member_predsR', member_predsR,
+                            store_dtype=True)
+        timer.stop('save')
 
     return preds_world
 
@@ -0,0 +1,725 @@
+"""Incremental inference of WaveNet and LSTM models in rollouts."""
+from keras.layers import Input
+from keras.models import Model, load_model
+import json
+import numpy as np
+import os
+from scipy.io import loadmat
+import time
+
+ACTIVATIONS = {'linear': lambda x: x,
+               'relu': lambda x: np.maximum(x, 0),
+               'tanh': np.tanh,
+               'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+               'hard_sigmoid': lambda x: np.clip(.2 * x + .5, 0, 1)}
+
+
+def ensemble_median(member_preds):
+    """Median of the member predictions, as computed by build_ensemble.
+
+    Matches tf.contrib.distributions.percentile(x, 50, axis=1) with its
+    default nearest interpolation: members are sorted in descending order
+    and the one at round((n_members - 1) / 2) is taken, rounding half to
+    even.
+    :param member_preds: Member predictions (n_windows x n_members x
+                         n_markers)
+    :return: Ensemble predictions (n_windows x n_markers)
+    """
+    n_members = member_preds.shape[1]
+    index = int(np.round(.5 * (n_members - 1)))
+    return -np.partition(-member_preds, index, axis=1)[:, index, :]
+
+
+def quantize(kernel, precision):
+    """Round a kernel to a lower precision.
+
+    int8 kernels are scaled symmetrically, with one scale per member and
+    output channel.
+    :param kernel: Kernel (n_members x ... x n_outputs)
+    :param precision: 'float32', 'float16' or 'int8'
+    :return: Rounded kernel, and its scales if int8, else None.
+    """
+    if precision == 'float32':
+        return kernel.astype('float32'), None
+    if precision == 'float16':
+        return kernel.astype('float16'), None
+    if precision == 'int8':
+        axes = tuple(range(1, kernel.ndim - 1))
+        scale = np.max(np.abs(kernel), axis=axes, keepdims=True) / 127
+        scale[scale == 0] = 1
+        return np.round(kernel / scale).astype('int8'), \
+            scale.astype('float32')
+    raise ValueError('precision must be float32, float16 or int8')
+
+
+def dequantize(kernel, scale=None):
+    """Restore a kernel rounded by quantize to float32."""
+    if scale is None:
+        return kernel.astype('float32')
+    return kernel.astype('float32') * scale
+
+
+class IncrementalWaveNet(object):
+    """Evaluate a WaveNet in numpy, reusing the activations of the last step.
+
+    Between two predictions of the same rollout, a context window drops its
+    oldest frames and appends new ones. The output of a causal convolution at
+    a position of the window only depends on the frames preceding it, so the
+    activations of the previous step remain valid one position earlier. The
+    exception is the first positions of each layer, whose receptive field
+    reaches the zero padding before the window: they see different frames
+    once the window moves and are recomputed along with the new positions.
+    Predictions then match the full-window forward pass, up to the rounding
+    of numpy and the model's backend.
+
+    The layers whose receptive field spans the whole window, and the dense
+    layers mixing all time steps after the Permute, are recomputed every
+    step, so the savings depend on the receptive field of the model relative
+    to input_length.
+
+    The members of an ensemble with identical architectures are fused into
+    a single network: their weights are stacked along a leading member axis,
+    every layer runs as one batched matrix product over all members, and the
+    ensemble output is taken with ensemble_median. Windows are run in chunks
+    of max_rows / n_members so that the activations of all members stay
+    in cache.
+
+    Supports models made of Conv1D (causal, or of width 1), Dense, Add,
+    Activation and Permute layers, such as wave_net and wave_net_res_skip.
+    """
+
+    def __init__(self, model, members=None, return_member_data=False,
+                 max_rows=64, precision='float32'):
+        """Copy the weights and graph of a model.
+
+        :param model: Keras WaveNet model, or any model with the input of
+                      the ensemble. Can also be a graph read by
+                      load_exported.
+        :param members: Members of an ensemble, with identical
+                        architectures. If None, model is a single WaveNet.
+        :param return_member_data: If True, the ensemble has two outputs: the
+                                   ensemble prediction and all member
+                                   predictions.
+        :param max_rows: Number of windows times members run at once.
+        :param precision: Precision of the kernels, 'float32', 'float16' or
+                          'int8' (see quantize). Computations are float32.
+        """
+        if isinstance(model, dict):
+            graph = model
+        else:
+            graph = self.build_graph(model, members, return_member_data)
+        self.input_length = graph['input_length']
+        self.n_markers = graph['n_markers']
+        self.n_members = graph['n_members']
+        self.is_ensemble = graph['is_ensemble']
+        self.return_member_data = graph['return_member_data']
+        self.output_name = graph['output_name']
+        self.ops = graph['ops']
+        self.pad = {-1: 0}
+        for op in self.ops:
+            self.pad[op['name']] = op['pad']
+            op['activation'] = ACTIVATIONS[op['activation_name']]
+        self.input = Input(shape=(self.input_length, self.n_markers))
+        self.output_shape = (None, 1, self.n_markers)
+        if self.return_member_data:
+            self.output_shape = [self.output_shape,
+                                 (None, self.n_members, self.n_markers)]
+        self.chunk_size = max(max_rows // self.n_members, 1)
+        self.dtype = np.dtype('float32')
+
+        # Round the kernels to the requested precision.
+        self.precision = precision
+        for op in self.ops:
+            if op['weights']:
+                op['weights'][0] = \
+                    dequantize(*quantize(op['weights'][0], precision))
+
+        self.caches = {}
+        self.n_calls = 0
+        self.n_positions = 0
+        self.n_windows = 0
+        self.total_time = 0.
+
+    def build_graph(self, model, members, return_member_data):
+        """Read the graph of a model, stacking the weights of its members.
+
+        :param model: Keras WaveNet model
+        :param members: Members of an ensemble, or None.
+        :param return_member_data: If True, the ensemble has two outputs.
+        :return: Graph (see IncrementalWaveNet)
+        """
+        graph = {'is_ensemble': members is not None,
+                 'return_member_data': return_member_data}
+        if members is None:
+            members = [model]
+        graph['input_length'], graph['n_markers'] = \
+            model.input.shape.as_list()[1:]
+        graphs = [self.parse(member, graph['input_length'])
+                  for member in members]
+        for member_graph in graphs[1:]:
+            if [self.signature(op) for op in member_graph[0]] != \
+                    [self.signature(op) for op in graphs[0][0]]:
+                raise ValueError('Members have different architectures')
+        graph['ops'], graph['output_name'] = graphs[0]
+        for i, op in enumerate(graph['ops']):
+            op['weights'] = [np.stack(weights).astype('float32')
+                             for weights in zip(*[member_graph[0][i]['weights']
+                                                  for member_graph in graphs])]
+        graph['n_members'] = len(members)
+        return graph
+
+    def parse(self, model, input_length):
+        """Read the layers of a model in topological order.
+
+        Layers are referred to by their position in the model, so that
+        members with different layer names line up.
+        :param model: Keras WaveNet model
+        :param input_length: Number of frames input to the model.
+        :return: List of layers, name of the output layer
+        """
+        config = model.get_config()
+        ids = {config['input_layers'][0][0]: -1}
+        pads = {-1: 0}
+        time_axis = {-1: True}
+        ops = []
+        for layer_config in config['layers']:
+            kind = layer_config['class_name']
+            if kind == 'InputLayer':
+                continue
+            layer = model.get_layer(layer_config['name'])
+            ids[layer_config['name']] = len(ops)
+            inputs = [ids[node[0]]
+                      for node in layer_config['inbound_nodes'][0]]
+            activation = layer.get_config().get('activation', 'linear')
+            op = {'name': len(ops), 'kind': kind, 'inputs': inputs,
+                  'weights': layer.get_weights(),
+                  'activation_name': activation}
+            pad = max(pads[inbound] for inbound in inputs)
+            if kind == 'Conv1D':
+                width = layer.kernel_size[0]
+                op['dilation'] = layer.dilation_rate[0]
+                op['offsets'] = \
+                    [op['dilation'] * i for i in range(width - 1, -1, -1)]
+                if layer.padding != 'causal' and width > 1:
+                    raise ValueError('Only causal convolutions are supported')
+                pad += (width - 1) * op['dilation']
+            elif kind == 'Permute':
+                # Permute the axes after the member and batch axes.
+                op['dims'] = [0, 1] + [dim + 1 for dim in layer.dims]
+            elif kind not in ('Dense', 'Add', 'Activation'):
+                raise ValueError('Unsupported layer %s' % (kind))
+            op['pad'] = pads[op['name']] = min(pad, input_length)
+            time_axis[op['name']] = kind != 'Permute' and \
+                all(time_axis[inbound] for inbound in inputs)
+            op['time_axis'] = time_axis[op['name']]
+            ops.append(op)
+        return ops, ids[config['output_layers'][0][0]]
+
+    def save(self, save_path):
+        """Save the network with its kernels in its precision.
+
+        Read back with load_exported, without keras models.
+        :param save_path: Path to .npz file.
+        """
+        arrays = {}
+        ops = []
+        for op in self.ops:
+            ops.append({key: value for key, value in op.items()
+                        if key not in ('weights', 'activation')})
+            ops[-1]['n_weights'] = len(op['weights'])
+            for i, weights in enumerate(op['weights']):
+                if i == 0:
+                    weights, scale = quantize(weights, self.precision)
+                    if scale is not None:
+                        arrays['scale_%d' % (op['name'])] = scale
+                arrays['weights_%d_%d' % (op['name'], i)] = weights
+        graph = {'input_length': self.input_length,
+                 'n_markers': self.n_markers, 'n_members': self.n_members,
+                 'is_ensemble': self.is_ensemble,
+                 'return_member_data': self.return_member_data,
+                 'output_name': self.output_name, 'ops': ops,
+                 'precision': self.precision}
+        arrays['graph'] = np.array(json.dumps(graph))
+        np.savez_compressed(save_path, **arrays)
+
+    def signature(self, op):
+        """Describe a layer, weights excluded, to compare members."""
+        return (op['kind'], op['inputs'], op['activation_name'],
+                op.get('dilation'), op.get('dims'),
+                [weights.shape for weights in op['weights']])
+
+    def reset(self, n_slots):
+        """Allocate activation caches for n_slots windows.
+
+        :param n_slots: Number of windows tracked between steps.
+        """
+        self.caches = {}
+        for op in self.ops:
+            if op['time_axis']:
+                self.caches[op['name']] = None
+        self.n_slots = n_slots
+
+    def apply(self, op, values, positions):
+        """Compute the output of a layer at a set of positions.
+
+        :param op: Layer
+        :param values: Full outputs of the preceding layers, by name, of
+                       shape (n_members x n_windows x ...). The input has no
+                       member axis.
+        :param positions: Positions of the window to compute, or None for
+                          layers without a time axis.
+        :return: Output (n_members x n_windows x n_positions x n_channels)
+        """
+        inputs = [values[inbound] for inbound in op['inputs']]
+        kind = op['kind']
+        if kind == 'Permute':
+            return np.transpose(inputs[0], op['dims'])
+        if kind == 'Add':
+            return sum(x if positions is None else x[:, :, positions]
+                       for x in inputs)
+        x = inputs[0]
+        kernel = op['weights'][0] if op['weights'] else None
+        if kind == 'Conv1D' and x.ndim == 3:
+            # The input is shared by all members.
+            ids = positions[:, None] - np.array(op['offsets'])[None, :]
+            taps = x[:, np.maximum(ids, 0), :]
+            taps[:, ids < 0, :] = 0
+            x = np.ascontiguousarray(np.moveaxis(
+                np.tensordot(taps, kernel, axes=([2, 3], [1, 2])), 2, 0))
+        elif kind == 'Conv1D':
+            # Gather the taps of each position, with zeros before the window.
+            ids = positions[:, None] - np.array(op['offsets'])[None, :]
+            taps = x[:, :, np.maximum(ids, 0), :]
+            taps[:, :, ids < 0, :] = 0
+            n_members, n_windows, n_positions = taps.shape[:3]
+            x = np.matmul(taps.reshape((n_members, -1,
+                                        np.prod(kernel.shape[1:3]))),
+                          kernel.reshape((n_members, -1, kernel.shape[3])))
+            x = x.reshape((n_members, n_windows, n_positions, -1))
+        elif kind == 'Dense':
+            if positions is not None:
+                x = x[:, :, positions]
+            x = np.matmul(x, kernel[:, None])
+        elif positions is not None:
+            x = x[:, :, positions]
+        if len(op['weights']) > 1:
+            x = x + op['weights'][1][:, None, None, :]
+        return op['activation'](x)
+
+    def forward(self, x, keys=None, shift=None):
+        """Run the members on windows, reusing cached activations.
+
+        :param x: Windows (n_windows x input_length x n_markers)
+        :param keys: Cache rows of the windows. If None, nothing is cached.
+        :param shift: Number of frames appended to every window since the
+                      activations under its key were cached. input_length
+                      if they are not valid.
+        :return: Output of each member (n_members x n_windows x 1 x
+                 n_markers)
+        """
+        L = self.input_length
+        all_positions = np.arange(L)
+        values = {-1: x.astype(self.dtype)}
+        for op in self.ops:
+            if not op['time_axis']:
+                values[op['name']] = self.apply(op, values, None)
+                continue
+            if keys is None or self.pad[op['name']] >= L - shift:
+                positions = all_positions
+            else:
+                positions = np.concatenate((
+                    all_positions[:self.pad[op['name']]],
+                    all_positions[(L - shift):]))
+            output = self.apply(op, values, positions)
+            if positions is not all_positions:
+                cached = self.caches[op['name']][:, keys]
+                cached[:, :, :(L - shift)] = cached[:, :, shift:]
+                cached[:, :, positions] = output
+                output = cached
+            if keys is not None:
+                if self.caches[op['name']] is None:
+                    self.caches[op['name']] = \
+                        np.zeros((self.n_members, self.n_slots) +
+                                 output.shape[2:], self.dtype)
+                self.caches[op['name']][:, keys] = output
+            values[op['name']] = output
+            self.n_positions += positions.shape[0] * x.shape[0]
+        self.n_windows += x.shape[0]
+        return values[self.output_name]
+
+    def combine(self, output):
+        """Compute the model output from the output of each member."""
+        if not self.is_ensemble:
+            return output[0]
+        member_preds = np.transpose(output[:, :, 0, :], (1, 0, 2))
+        preds = ensemble_median(member_preds)[:, None, :]
+        if self.return_member_data:
+            return [preds, member_preds]
+        return preds
+
+    def predict_windows(self, x, keys, shifts):
+        """Predict windows that moved forward since their last prediction.
+
+        :param x: Windows (n_windows x input_length x n_markers)
+        :param keys: Integer cache row of each window, below n_slots.
+        :param shifts: Number of frames appended to each window since its
+                       last prediction under the same key. input_length or
+                       more if its activations are not cached.
+        :return: Model output, as predict.
+        """
+        start = time.time()
+        shifts = np.minimum(shifts, self.input_length)
+        output = None
+        for shift in np.unique(shifts):
+            shift_ids = np.where(shifts == shift)[0]
+            for i in range(0, shift_ids.shape[0], self.chunk_size):
+                ids = shift_ids[i:(i + self.chunk_size)]
+                output_ids = self.forward(x[ids], keys[ids], shift)
+                if output is None:
+                    output = np.zeros((self.n_members, x.shape[0]) +
+                                      output_ids.shape[2:], output_ids.dtype)
+                output[:, ids] = output_ids
+        self.n_calls += 1
+        self.total_time += time.time() - start
+        return self.combine(output)
+
+    def predict(self, x, batch_size=32):
+        """Generate predictions of full windows, as Model.predict.
+
+        :param x: Input data
+        :param batch_size: Number of samples per forward pass, at most
+                           chunk_size.
+        """
+        batch_size = min(batch_size, self.chunk_size)
+        return self.combine(np.concatenate(
+            [self.forward(x[i:(i + batch_size)])
+             for i in range(0, max(x.shape[0], 1), batch_size)], axis=1))
+
+    def report(self):
+        """Print the time per call and the share of positions recomputed."""
+        if self.n_calls == 0:
+            return
+        n_time_ops = sum(op['time_axis'] for op in self.ops)
+        print('Incremental inference (%d members): %d calls, %.3f ms/call, '
+              '%.1f%% of positions recomputed' %
+              (self.n_members, self.n_calls,
+               1e3 * self.total_time / self.n_calls,
+               100 * self.n_positions /
+               max(self.n_windows * n_time_ops * self.input_length, 1)),
+              flush=True)
+
+
+class StepLSTM(object):
+    """Run the stacked LSTMs of lstm_model one frame at a time.
+
+    The hidden and cell states of every layer are carried from one
+    prediction of a window to the next, and only the frames appended in
+    between are fed to the LSTMs. The states are seeded by running the full
+    window from zero states whenever a window is filled, i.e. at the start
+    of each gap, so the first prediction of a gap is that of the model.
+
+    The model restarts from zero states at the first frame of every window,
+    whereas carried states also remember the frames that left the window.
+    Later predictions of a gap therefore differ from those of the model, and
+    step mode is only used when asked for. benchmark_incremental measures the
+    difference on a recording.
+
+    Supports models made of stacked LSTM layers followed by a Dense layer and
+    the pad Lambda of lstm_model.
+    """
+
+    def __init__(self, model):
+        """Copy the weights of the LSTM and Dense layers.
+
+        :param model: Keras model built by models.lstm_model
+        """
+        self.input = model.input
+        self.output_shape = model.output_shape
+        self.input_length, self.n_markers = model.input.shape.as_list()[1:]
+        self.lstms = []
+        self.dense = None
+        for layer in model.layers:
+            kind = layer.__class__.__name__
+            if kind == 'LSTM' and self.dense is None:
+                config = layer.get_config()
+                kernel, recurrent_kernel = layer.get_weights()[:2]
+                bias = layer.get_weights()[2] if config['use_bias'] else 0
+                self.lstms.append(
+                    {'kernel': kernel, 'recurrent_kernel': recurrent_kernel,
+                     'bias': bias, 'units': config['units'],
+                     'activation': ACTIVATIONS[config['activation']],
+                     'recurrent_activation':
+                         ACTIVATIONS[config['recurrent_activation']]})
+            elif kind == 'Dense' and self.dense is None:
+                self.dense = layer.get_weights()
+                self.dense_activation = \
+                    ACTIVATIONS[layer.get_config()['activation']]
+            elif kind not in ('InputLayer', 'Lambda'):
+                raise ValueError('Unsupported layer %s' % (kind))
+        self.dtype = self.lstms[0]['kernel'].dtype
+        self.states = None
+        self.n_calls = 0
+        self.n_steps = 0
+        self.n_windows = 0
+        self.total_time = 0.
+
+    def reset(self, n_slots):
+        """Allocate the states of n_slots windows.
+
+        :param n_slots: Number of windows tracked between steps.
+        """
+        self.states = [(np.zeros((n_slots, lstm['units']), self.dtype),
+                        np.zeros((n_slots, lstm['units']), self.dtype))
+                       for lstm in self.lstms]
+
+    def step(self, frames, states):
+        """Feed frames to the LSTMs.
+
+        :param frames: Frames (n_windows x n_frames x n_markers)
+        :param states: (hidden, cell) states of every layer, updated in
+                       place.
+        :return: Hidden state of the last layer.
+        """
+        for i in range(frames.shape[1]):
+            x = frames[:, i, :]
+            for lstm, (h, c) in zip(self.lstms, states):
+                z = np.dot(x, lstm['kernel']) + \
+                    np.dot(h, lstm['recurrent_kernel']) + lstm['bias']
+                units = lstm['units']
+                gate_in = lstm['recurrent_activation'](z[:, :units])
+                gate_forget = \
+                    lstm['recurrent_activation'](z[:, units:(2 * units)])
+                gate_out = lstm['recurrent_activation'](z[:, (3 * units):])
+                c[:] = gate_forget * c + gate_in * \
+                    lstm['activation'](z[:, (2 * units):(3 * units)])
+                h[:] = gate_out * lstm['activation'](c)
+                x = h
+            self.n_steps += frames.shape[0]
+        return x
+
+    def output(self, h):
+        """Apply the Dense layer to the last hidden state."""
+        x = np.dot(h, self.dense[0])
+        if len(self.dense) > 1:
+            x = x + self.dense[1]
+        return self.dense_activation(x)[:, None, :]
+
+    def predict_windows(self, x, keys, shifts):
+        """Predict windows that moved forward since their last prediction.
+
+        :param x: Windows (n_windows x input_length x n_markers)
+        :param keys: Integer state row of each window, below n_slots.
+        :param shifts: Number of frames appended to each window since its
+                       last prediction under the same key. input_length or
+                       more to seed its states from the window.
+        :return: Predictions (n_windows x 1 x n_markers)
+        """
+        start = time.time()
+        x = x.astype(self.dtype)
+        shifts = np.minimum(shifts, self.input_length)
+        output = np.zeros((x.shape[0], 1, self.dense[0].shape[1]),
+                          self.dtype)
+        for shift in np.unique(shifts):
+            ids = np.where(shifts == shift)[0]
+            if shift == self.input_length:
+                states = [(np.zeros((ids.shape[0], lstm['units']),
+                                    self.dtype),
+                           np.zeros((ids.shape[0], lstm['units']),
+                                    self.dtype)) for lstm in self.lstms]
+            else:
+                states = [(h[keys[ids]], c[keys[ids]])
+                          for h, c in self.states]
+            h = self.step(x[ids, (self.input_length - shift):, :], states)
+            for (h_all, c_all), (h_ids, c_ids) in zip(self.states, states):
+                h_all[keys[ids]] = h_ids
+                c_all[keys[ids]] = c_ids
+            output[ids] = self.output(h)
+        self.n_windows += x.shape[0]
+        self.n_calls += 1
+        self.total_time += time.time() - start
+        return output
+
+    def predict(self, x, batch_size=32):
+        """Generate predictions of full windows, as Model.predict.
+
+        :param x: Input data
+        :param batch_size: Number of samples per forward pass.
+        """
+        outputs = []
+        for i in range(0, max(x.shape[0], 1), batch_size):
+            batch = x[i:(i + batch_size)].astype(self.dtype)
+            states = [(np.zeros((batch.shape[0], lstm['units']), self.dtype),
+                       np.zeros((batch.shape[0], lstm['units']), self.dtype))
+                      for lstm in self.lstms]
+            outputs.append(self.output(self.step(batch, states)))
+        return np.concatenate(outputs, axis=0)
+
+    def report(self):
+        """Print the time per call and the number of frames fed per window."""
+        if self.n_calls == 0:
+            return
+        print('Step LSTM inference: %d calls, %.3f ms/call, %.2f frames fed '
+              'per window' %
+              (self.n_calls, 1e3 * self.total_time / self.n_calls,
+               self.n_steps / max(self.n_windows, 1)), flush=True)
+
+
+class IncrementalEnsemble(object):
+    """Ensemble of incremental models built by build_ensemble.ensemble.
+
+    Used for ensembles whose members cannot be fused into a single
+    IncrementalWaveNet, such as LSTMs. Each member keeps its own caches.
+    The ensemble prediction is the median of the members, with the member
+    predictions as second output if the ensemble returns member data.
+    """
+
+    def __init__(self, members, return_member_data=False):
+        """Copy the weights and graphs of the members.
+
+        :param members: Keras models of the members.
+        :param return_member_data: If True, the ensemble has two outputs: the
+                                   ensemble prediction and all member
+                                   predictions.
+        """
+        self.input = members[0].input
+        n_markers = self.input.shape.as_list()[2]
+        self.output_shape = (None, 1, n_markers)
+        if return_member_data:
+            self.output_shape = [self.output_shape,
+                                 (None, len(members), n_markers)]
+        self.members = [incremental_model(member) for member in members]
+        self.return_member_data = return_member_data
+        self.n_calls = 0
+        self.total_time = 0.
+
+    def reset(self, n_slots):
+        """Allocate activation caches for n_slots windows."""
+        for member in self.members:
+            member.reset(n_slots)
+
+    def combine(self, outputs):
+        """Compute the ensemble output from the outputs of the members."""
+        member_preds = np.concatenate(outputs, axis=1)
+        preds = ensemble_median(member_preds)[:, None, :]
+        if self.return_member_data:
+            return [preds, member_preds]
+        return preds
+
+    def predict_windows(self, x, keys, shifts):
+        """Predict windows that moved forward (see
+        IncrementalWaveNet.predict_windows)."""
+        start = time.time()
+        output = self.combine([member.predict_windows(x, keys, shifts)
+                               for member in self.members])
+        self.n_calls += 1
+        self.total_time += time.time() - start
+        return output
+
+    def predict(self, x, batch_size=32):
+        """Generate predictions of full windows, as Model.predict."""
+        return self.combine([member.predict(x, batch_size=batch_size)
+                             for member in self.members])
+
+    def report(self):
+        """Print the time per call and the share of positions recomputed."""
+        if self.n_calls == 0:
+            return
+        print('Incremental ensemble: %d calls, %.3f ms/call' %
+              (self.n_calls, 1e3 * self.total_time / self.n_calls))
+        self.members[0].report()
+
+
+def incremental_model(model, precision='float32'):
+    """Wrap a keras model or ensemble for incremental inference.
+
+    WaveNets are wrapped in an IncrementalWaveNet and LSTMs in a StepLSTM,
+    which only approximates the model (see StepLSTM).
+    :param model: Keras model, or incremental model returned unchanged.
+    :param precision: Precision of the kernels of WaveNets (see quantize).
+    :return: IncrementalWaveNet, StepLSTM or IncrementalEnsemble
+    """
+    if isinstance(model, (IncrementalWaveNet, StepLSTM,
+                          IncrementalEnsemble)):
+        return model
+    members = [layer for layer in model.layers if isinstance(layer, Model)]
+    if members:
+        return incremental_ensemble(members, len(model.outputs) > 1,
+                                    precision)
+    if any(layer.__class__.__name__ == 'LSTM' for layer in model.layers):
+        if precision != 'float32':
+            raise ValueError('LSTMs only run in float32')
+        return StepLSTM(model)
+    return IncrementalWaveNet(model, precision=precision)
+
+
+def incremental_ensemble(members, return_member_data=False,
+                         precision='float32'):
+    """Wrap the members of an ensemble for incremental inference.
+
+    WaveNet members of identical architectures are fused into a single
+    IncrementalWaveNet. Others are run one by one in an IncrementalEnsemble.
+    :param members: Keras models of the members.
+    :param return_member_data: If True, the ensemble has two outputs: the
+                               ensemble prediction and all member predictions.
+    :param precision: Precision of the kernels of fused WaveNets (see
+                      quantize).
+    :return: IncrementalWaveNet or IncrementalEnsemble
+    """
+    try:
+        return IncrementalWaveNet(members[0], members,
+                                  return_member_data=return_member_data,
+                                  precision=precision)
+    except ValueError:
+        if precision != 'float32':
+            raise
+        return IncrementalEnsemble(members, return_member_data)
+
+
+def load_incremental(model_path, precision='float32'):
+    """Load a model or ensemble for incremental inference.
+
+    Ensembles saved by build_ensemble are rebuilt from the members listed in
+    the training_info.mat of their run, so their Lambda layers, and the
+    tf.contrib percentile they call, are never loaded. Models exported to
+    .npz files are read with load_exported.
+    :param model_path: Path to model, ensemble or exported model.
+    :param precision: Precision of the kernels of WaveNets (see quantize).
+    :return: IncrementalWaveNet, StepLSTM or IncrementalEnsemble
+    """
+    if is_exported(model_path):
+        return load_exported(model_path)
+    info_path = os.path.join(os.path.dirname(model_path), 'training_info.mat')
+    info = loadmat(info_path) if os.path.exists(info_path) else {}
+    if 'model_paths' not in info:
+        return incremental_model(load_model(model_path), precision)
+
+    base_output_path = str(np.squeeze(info['base_output_path']))
+    members = [load_model(os.path.join(base_output_path,
+                                       str(np.squeeze(path))))
+               for path in np.ravel(info['model_paths'])]
+    return incremental_ensemble(members,
+                                bool(np.squeeze(info['return_member_data'])),
+                                precision)
+
+
+def is_exported(model_path):
+    """Whether a model path points to a model exported with
+    IncrementalWaveNet.save."""
+    return os.path.splitext(model_path)[1] == '.npz'
+
+
+def load_exported(model_path):
+    """Load a model exported with IncrementalWaveNet.save.
+
+    :param model_path: Path to .npz file.
+    :return: IncrementalWaveNet in the precision it was exported in.
+    """
+    with np.load(model_path) as f:
+        graph = json.loads(str(f['graph']))
+        for op in graph['ops']:
+            op['weights'] = [f['weights_%d_%d' % (op['name'], i)]
+                             for i in range(op.pop('n_weights'))]
+            if 'scale_%d' % (op['name']) in f:
+                op['weights'][0] = dequantize(op['weights'][0],
+                                              f['scale_%d' % (op['name'])])
+    return IncrementalWaveNet(graph, precision=graph['precision'])
@@ -1,118 +1,225 @@
 """Imputes markers with mbi models."""
 import clize
-import datetime
 import h5py
 import numpy as np
 import os
 import re
-from scipy.io import savemat, loadmat
-from skimage import measure
+from scipy.io import loadmat, whosmat
+from blend import blend
+from store import is_store, load_store, store_shapes
 
 
-def sigmoid(x, x_0, k):
-    """Sigmoid function.
+def sort_fold_paths(fold_paths):
+    """Order the fold paths by the fold id in the filename.
 
-    For use in weighted averaging of marker predictions from
-    the forward and reverse passes.
-    :param x: domain
-    :param x_0: midpoint
-    :parak k: exponent constant.
+    :param fold_paths: List of paths to chunked predictions.
     """
-    return 1 / (1 + np.exp(-k*(x-x_0)))
+    # Consider revising
+    fold_files = [os.path.basename(s) for s in fold_paths]
+    folds = [int(re.findall('\d+', s)[0]) for s in fold_files]
+    sorted_indices = sorted(range(len(folds)), key=lambda k: folds[k])
+    return [fold_paths[i] for i in sorted_indices]
+
+
+def fold_frames(data, n_frames):
+    """Slice of the frames of a fold without its context halo.
+
+    :param data: Dictionary of fold variables holding halo_start and
+                 halo_end. Folds saved without a halo have neither.
+    :param n_frames: Number of frames saved in the fold, halo included.
+    """
+    halo_start = int(np.squeeze(data.get('halo_start', 0)))
+    halo_end = int(np.squeeze(data.get('halo_end', 0)))
+    return slice(halo_start, n_frames - halo_end)
+
+
+def load_fold(fold_path, variable_names=None):
+    """Read the variables of a fold, as loadmat does.
+
+    Folds are prediction stores (see store.py). Folds saved with savemat by
+    earlier versions are read with loadmat.
+    :param fold_path: Path to chunked predictions.
+    :param variable_names: Names of the variables to read. Defaults to all.
+    """
+    if is_store(fold_path):
+        return load_store(fold_path, variable_names)
+    return loadmat(fold_path, variable_names=variable_names)
+
+
+def fold_member_stds(data):
+    """Member stds of a fold, zero for folds of single models.
+
+    :param data: Dictionary of fold variables, as returned by load_fold.
+    """
+    if 'member_stds' in data:
+        return data['member_stds']
+    return np.zeros(data['preds'].shape)
+
 
+def read_fold_header(fold_path):
+    """Read the direction and size of a fold without loading its data.
 
-def merge(save_path, *fold_paths):
+    :param fold_path: Path to chunked predictions.
+    :return: pass_direction, n_frames, n_markers, frames. n_frames excludes
+             the context halo and frames is the slice that drops it.
+    """
+    if is_store(fold_path):
+        shapes = store_shapes(fold_path)
+    else:
+        shapes = {name: shape for name, shape, _ in whosmat(fold_path)}
+    header = load_fold(fold_path, ['pass_direction', 'halo_start',
+                                   'halo_end'])
+    pass_direction = header['pass_direction'][0]
+    n_frames, n_markers = shapes['preds']
+    frames = fold_frames(header, n_frames)
+    return pass_direction, frames.stop - frames.start, n_markers, frames
+
+
+def merge_streaming(save_path, fold_paths, block_size=100000):
+    """Merge the predictions from chunked passes one fold at a time.
+
+    Fold headers are read first to size the output. Each fold is then
+    streamed into its slice of chunked HDF5 datasets, and the passes are
+    blended in blocks that begin on fully tracked frames, so no gap is split
+    across blocks. Peak memory is about one fold or block rather than the
+    whole recording.
+    :param save_path: Path to .h5 file where merged predictions will be saved.
+    :param fold_paths: List of paths to chunked predictions, sorted by fold.
+    :param block_size: Number of frames to blend at a time.
+    """
+    # Size the output from the fold headers.
+    headers = [read_fold_header(path) for path in fold_paths]
+    offsets = []
+    n_frames = {'forward': 0, 'reverse': 0}
+    for pass_direction, n_frames_fold, n_markers, _ in headers:
+        offsets.append(n_frames[pass_direction])
+        n_frames[pass_direction] += n_frames_fold
+    if n_frames['forward'] != n_frames['reverse']:
+        raise ValueError('Forward and reverse folds cover %d and %d frames.'
+                         % (n_frames['forward'], n_frames['reverse']))
+    n_frames = n_frames['forward']
+    n_bad_markers = np.round(n_markers/3).astype('int32')
+    chunks = (min(block_size, n_frames), n_markers)
+    print('Merging %d frames' % (n_frames), flush=True)
+
+    scratch_path = os.path.splitext(save_path)[0] + '_scratch.h5'
+    with h5py.File(save_path, 'w') as f, \
+            h5py.File(scratch_path, 'w') as scratch:
+        for name in ['predsF', 'predsR', 'member_stdsF', 'member_stdsR']:
+            scratch.create_dataset(name, (n_frames, n_markers), 'float64',
+                                   chunks=chunks)
+        for name in ['bad_framesF', 'bad_framesR']:
+            scratch.create_dataset(name, (n_frames, n_markers), bool,
+                                   chunks=chunks)
+        for name in ['preds', 'markers', 'member_stds']:
+            f.create_dataset(name, (n_frames, n_markers), 'float64',
+                             chunks=chunks)
+        f.create_dataset('badFrames', (n_frames, n_bad_markers), 'float64',
+                         chunks=(chunks[0], n_bad_markers))
+
+        # Stream each fold into its slice in real world coordinates.
+        for path, header, offset in zip(fold_paths, headers, offsets):
+            print('Streaming %s' % (path), flush=True)
+            pass_direction, n_frames_fold, _, frames = header
+            suffix = 'F' if pass_direction == 'forward' else 'R'
+            ids = slice(offset, offset + n_frames_fold)
+            data = load_fold(path)
+            marker_means = np.array(data['marker_means'][:])
+            marker_stds = np.array(data['marker_stds'][:])
+            scratch['preds' + suffix][ids] = \
+                data['preds'][frames]*marker_stds + marker_means
+            scratch['member_stds' + suffix][ids] = \
+                fold_member_stds(data)[frames]
+            scratch['bad_frames' + suffix][ids] = \
+                data['bad_frames'][frames] > .5
+            if pass_direction == 'forward':
+                f['markers'][ids] = \
+                    data['markers'][frames]*marker_stds + marker_means
+            data = None
+
+        def merged_bad_frames(start, stop):
+            # Frames that are bad in both passes, per marker.
+            is_bad = scratch['bad_framesF'][start:stop] & \
+                scratch['bad_framesR'][start:stop]
+            return np.any(is_bad.reshape((-1, n_bad_markers, 3)), axis=2)
+
+        def block_end(start):
+            # First fully tracked frame at least block_size frames away.
+            stop = min(start + block_size, n_frames)
+            while stop < n_frames:
+                next_stop = min(stop + block_size, n_frames)
+                is_bad = np.any(merged_bad_frames(stop, next_stop), axis=1)
+                if not np.all(is_bad):
+                    return stop + np.argmin(is_bad)
+                stop = next_stop
+            return n_frames
+
+        # Blend the passes block by block.
+        print('Computing weighted average', flush=True)
+        start = 0
+        while start < n_frames:
+            stop = block_end(start)
+            ids = slice(start, stop)
+            bad_frames = merged_bad_frames(start, stop)
+            f['preds'][ids], f['member_stds'][ids] = \
+                blend(scratch['predsF'][ids], scratch['predsR'][ids],
+                      bad_frames, k=1,
+                      member_stdsF=scratch['member_stdsF'][ids],
+                      member_stdsR=scratch['member_stdsR'][ids])
+            f['badFrames'][ids] = bad_frames
+            start = stop
+    os.remove(scratch_path)
+    print('Saved to %s' % (save_path))
+
+
+def merge(save_path, *fold_paths, stream=False, block_size=100000):
     """Merge the predictions from chunked passes.
 
     :param save_path: Path to .mat file where merged predictions will be saved.
     :param fold_paths: List of paths to chunked predictions to merge.
+    :param stream: If True, stream folds into the output one at a time
+                   instead of holding the whole recording in memory. Requires
+                   save_path and returns None.
+    :param block_size: Number of frames to blend at a time when streaming.
     """
     # Order the files in the imputation path by the fold id in the filename
-    # Consider revising
-    fold_files = [os.path.basename(s) for s in fold_paths]
-    folds = [int(re.findall('\d+', s)[0]) for s in fold_files]
-    sorted_indices = sorted(range(len(folds)), key=lambda k: folds[k])
-    fold_paths = [fold_paths[i] for i in sorted_indices]
+    fold_paths = sort_fold_paths(fold_paths)
     print('Reorganized fold paths:')
     print(fold_paths)
 
-    n_folds_to_merge = len(fold_paths)
-    markers = None
-    bad_framesF = None
-    bad_framesR = None
-    predsF = None
-    predsR = None
-    # member_predsF = None
-    # member_predsR = None
-
-    member_stdsF = None
-    member_stdsR = None
-    for i in range(n_folds_to_merge):
+    if stream:
+        return merge_streaming(save_path, fold_paths, block_size=block_size)
+
+    # Collect the folds of each pass and concatenate them once.
+    markers = []
+    bad_framesF = []
+    bad_framesR = []
+    predsF = []
+    predsR = []
+    member_stdsF = []
+    member_stdsR = []
+    for i in range(len(fold_paths)):
         print('%d' % (i), flush=True)
-        data = loadmat(fold_paths[i])
-        pass_direction = data['pass_direction'][:]
-        markers_single_fold = np.array(data['markers'][:])
-        preds_single_fold = np.array(data['preds'][:])
-        # member_preds_single_fold = np.array(data['member_preds'][:])
-        member_stds_single_fold = np.array(data['member_stds'][:])
-        bad_frames_single_fold = np.array(data['bad_frames'][:])
-
-        if (markers is None) & (pass_direction == 'forward'):
-            markers = markers_single_fold
-        elif (pass_direction == 'forward'):
-            markers = np.concatenate((markers, markers_single_fold), axis=0)
-
-        if (bad_framesF is None) & (pass_direction == 'forward'):
-            bad_framesF = bad_frames_single_fold
-        elif (pass_direction == 'forward'):
-            bad_framesF = \
-                np.concatenate((bad_framesF, bad_frames_single_fold), axis=0)
-
-        if (bad_framesR is None) & (pass_direction == 'reverse'):
-            bad_framesR = bad_frames_single_fold
-        elif (pass_direction == 'reverse'):
-            bad_framesR = \
-                np.concatenate((bad_framesR,
-                                bad_frames_single_fold), axis=0)
-
-        if (predsF is None) & (pass_direction == 'forward'):
-            predsF = preds_single_fold
-        elif (pass_direction == 'forward'):
-            predsF = np.concatenate((predsF, preds_single_fold), axis=0)
-
-        if (predsR is None) & (pass_direction == 'reverse'):
-            predsR = preds_single_fold
-        elif (pass_direction == 'reverse'):
-            predsR = \
-                np.concatenate((predsR, preds_single_fold), axis=0)
-
-        # if (member_predsF is None) & (pass_direction == 'forward'):
-        #     member_predsF = member_preds_single_fold
-        # elif (pass_direction == 'forward'):
-        #     member_predsF = \
-        #         np.concatenate((member_predsF,
-        #                         member_preds_single_fold), axis=1)
-        #
-        # if (member_predsR is None) & (pass_direction == 'reverse'):
-        #     member_predsR = member_preds_single_fold
-        # elif (pass_direction == 'reverse'):
-        #     member_predsR = \
-        #         np.concatenate((member_predsR,
-        #                         member_preds_single_fold), axis=1)
-
-        if (member_stdsF is None) & (pass_direction == 'forward'):
-            member_stdsF = member_stds_single_fold
-        elif (pass_direction == 'forward'):
-            member_stdsF = \
-                np.concatenate((member_stdsF,
-                                member_stds_single_fold), axis=0)
-
-        if (member_stdsR is None) & (pass_direction == 'reverse'):
-            member_stdsR = member_stds_single_fold
-        elif (pass_direction == 'reverse'):
-            member_stdsR = \
-                np.concatenate((member_stdsR,
-                                member_stds_single_fold), axis=0)
+        data = load_fold(fold_paths[i])
+        pass_direction = data['pass_direction'][0]
+        # Drop the context halo read before or after the fold.
+        frames = fold_frames(data, data['preds'].shape[0])
+        if pass_direction == 'forward':
+            markers.append(np.array(data['markers'][frames]))
+            predsF.append(np.array(data['preds'][frames]))
+            bad_framesF.append(np.array(data['bad_frames'][frames]))
+            member_stdsF.append(np.array(fold_member_stds(data)[frames]))
+        elif pass_direction == 'reverse':
+            predsR.append(np.array(data['preds'][frames]))
+            bad_framesR.append(np.array(data['bad_frames'][frames]))
+            member_stdsR.append(np.array(fold_member_stds(data)[frames]))
+    markers = np.concatenate(markers, axis=0)
+    predsF = np.concatenate(predsF, axis=0)
+    predsR = np.concatenate(predsR, axis=0)
+    bad_framesF = np.concatenate(bad_framesF, axis=0)
+    bad_framesR = np.concatenate(bad_framesR, axis=0)
+    member_stdsF = np.concatenate(member_stdsF, axis=0)
+    member_stdsR = np.concatenate(member_stdsR, axis=0)
 
     marker_means = np.array(data['marker_means'][:])
     marker_stds = np.array(data['marker_stds'][:])
@@ -149,30 +256,9 @@ def merge(save_path, *fold_paths):
     # Compute the weighted average of the forward and reverse predictions using
     # a logistic function
     print('Computing weighted average', flush=True)
-    preds = np.zeros(predsF.shape)
-    member_stds = np.zeros(member_stdsF.shape)
-    k = 1
-    for i in range(bad_frames.shape[1]*3):
-        start = datetime.datetime.now()
-        print('marker number: %d' % (i), flush=True)
-        is_bad = bad_frames[:, np.floor(i/3).astype('int32')]
-        CC = measure.label(is_bad, background=0)
-        num_CC = len(np.unique(CC))-1
-        preds[:, i] = predsF[:, i]
-        for j in range(num_CC):
-            CC_ids = np.array(np.where(CC == (j+1)))
-            length_CC = CC_ids.shape[0]
-            x_0 = np.round(length_CC/2)
-            weightR = sigmoid(np.arange(length_CC), x_0, k)
-            weightF = 1-weightR
-            preds[CC_ids, i] = \
-                (predsF[CC_ids, i]*weightF) +\
-                (predsR[CC_ids, i]*weightR)
-            member_stds[CC_ids, i] = \
-                np.sqrt(((member_stdsF[CC_ids, i]**2)*weightF) +
-                        ((member_stdsR[CC_ids, i]**2)*weightR))
-        elapsed = datetime.datetime.now() - start
-        print(elapsed)
+    preds, member_stds = blend(predsF, predsR, bad_frames, k=1,
+                               member_stdsF=member_stdsF,
+                               member_stdsR=member_stdsR)
 
     # Save predictions to a matlab file.
     if save_path is not None:
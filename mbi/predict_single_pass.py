@@ -1,11 +1,13 @@
 """Imputes markers with mbi models."""
 import clize
-import h5py
 from keras.models import load_model
 import numpy as np
 import os
-from scipy.io import savemat
-from scipy import stats
+from dataset import open_session
+from incremental import incremental_model, is_exported, load_incremental
+from runtime import as_runtime
+from rollout import Checkpoint, predict_gaps
+from store import PredictionStore
 
 
 def sigmoid(x, x_0, k):
@@ -22,7 +24,8 @@ def sigmoid(x, x_0, k):
 
 def predict_markers(model, X, bad_frames, markers_to_fix=None,
                     error_diff_thresh=.25, outlier_thresh=3,
-                    return_member_data=False):
+                    return_member_data=False, batch_size=1000,
+                    checkpoint=None):
     """Imputes the position of missing markers.
 
     :param model: model to use for prediction
@@ -38,104 +41,30 @@ def predict_markers(model, X, bad_frames, markers_to_fix=None,
     :param return_member_data: If true, also return the predictions of each
                                ensemble member in a matrix of size
                                n_members x n_frames x n_markers. The
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param checkpoint: Optional rollout.Checkpoint from which to resume, and
+                       to which the rollout is periodically saved.
     :return: preds, bad_frames
     """
-    # Get the input lengths and find the first instance of all good frames.
-    input_length = model.input.shape.as_list()[1]
-    bad_frames = np.repeat(bad_frames, 3, axis=1) > .5
-    startpoint = 0
-
-    # See whether you should fix errors
-    fix_errors = np.any(markers_to_fix)
-
-    # Reshape and get the starting seed.
-    X = X[None, ...]
-    X_start = X[:, startpoint:(startpoint+input_length), :]
-
-    # Preallocate
-    preds = np.zeros((X.shape))
-    preds[:, startpoint:(startpoint+input_length), :] = X_start
-    pred = np.zeros((1, 1, X.shape[2]))
-
     if return_member_data:
-        n_members = model.output_shape[1][1]
-        member_stds = np.zeros((1, X.shape[1], X.shape[2]))
-        member_pred = np.zeros((1, n_members, X.shape[2]))
-
-        # At each step, generate a prediction, replace the predictions of
-        # markers you do not want to predict with the ground truth, and append
-        # the resulting vector to the end of the next input chunk.
-        for i in range(startpoint, X.shape[1]-input_length-startpoint):
-            if np.mod(i, 10000) == 0:
-                print('Predicting frame: ', i, flush=True)
-            next_frame_id = (startpoint+input_length)+i
-
-            # If there is a marker prediction that is greater than the
-            # difference threshold above, mark it as a bad frame.
-            # These are likely just jumps or identity swaps from MoCap that
-            # were not picked up by preprocessing.
-            if fix_errors:
-                diff = pred[:, 0, :] - X[:, next_frame_id, :]
-                errors = np.squeeze(np.abs(diff) > error_diff_thresh)
-                errors[~markers_to_fix] = False
-                bad_frames[next_frame_id, errors] = True
-            if np.any(bad_frames[next_frame_id, :]):
-                pred, member_pred = model.predict(X_start)
-
-            # Detect anomalous predictions.
-            outliers = np.squeeze(np.abs(pred) > outlier_thresh)
-            pred[:, 0, outliers] = X[:, next_frame_id, outliers]
-
-            # Only use the predictions for the bad markers. Take the
-            # predictions and append to the end of X_start for future
-            # prediction.
-            pred[:, 0, ~bad_frames[next_frame_id, :]] = \
-                X[:, next_frame_id, ~bad_frames[next_frame_id, :]]
-            member_pred[:, :, ~bad_frames[next_frame_id, :]] = float('nan')
-            member_std = np.nanstd(member_pred, axis=1)
-            preds[:, next_frame_id, :] = np.squeeze(pred)
-            member_stds[0, next_frame_id, :] = np.squeeze(member_std)
-            X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
-        return np.squeeze(preds), bad_frames, member_stds
-    else:
-        # At each step, generate a prediction, replace the predictions of
-        # markers you do not want to predict with the ground truth, and append
-        # the resulting vector to the end of the next input chunk.
-        for i in range(startpoint, X.shape[1]-input_length-startpoint):
-            if np.mod(i, 10000) == 0:
-                print('Predicting frame: ', i, flush=True)
-            next_frame_id = (startpoint+input_length)+i
-
-            # If there is a marker prediction that is greater than the
-            # difference threshold above, mark it as a bad frame.
-            # These are likely just jumps or identity swaps from MoCap that
-            # were not picked up by preprocessing.
-            if fix_errors:
-                diff = pred[:, 0, :] - X[:, next_frame_id, :]
-                errors = np.squeeze(np.abs(diff) > error_diff_thresh)
-                errors[~markers_to_fix] = False
-                bad_frames[next_frame_id, errors] = True
-            if np.any(bad_frames[next_frame_id, :]):
-                pred = model.predict(X_start)
-
-            # Detect anomalous predictions.
-            outliers = np.squeeze(np.abs(pred) > outlier_thresh)
-            pred[:, 0, outliers] = X[:, next_frame_id, outliers]
-
-            # Only use the predictions for the bad markers. Take the
-            # predictions and append to the end of X_start for future
-            # prediction.
-            pred[:, 0, ~bad_frames[next_frame_id, :]] = \
-                X[:, next_frame_id, ~bad_frames[next_frame_id, :]]
-            preds[:, next_frame_id, :] = np.squeeze(pred)
-            X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
-        return np.squeeze(preds), bad_frames
+        preds, bad_frames, member_stds = \
+            predict_gaps(model, X, bad_frames, markers_to_fix=markers_to_fix,
+                         error_diff_thresh=error_diff_thresh,
+                         outlier_thresh=outlier_thresh, member_data='stds',
+                         batch_size=batch_size, checkpoint=checkpoint)
+        return preds, bad_frames, member_stds[None, ...]
+    return predict_gaps(model, X, bad_frames, markers_to_fix=markers_to_fix,
+                        error_diff_thresh=error_diff_thresh,
+                        outlier_thresh=outlier_thresh, batch_size=batch_size,
+                        checkpoint=checkpoint)
 
 
 def predict_single_pass(model_path, data_path, pass_direction, *,
                         save_path=None, stride=1, n_folds=10, fold_id=None,
                         markers_to_fix=None, error_diff_thresh=.25,
-                        model=None):
+                        model=None, batch_size=1000, halo=0, dataset=None,
+                        incremental=False, save_dtype='float32',
+                        compression='gzip', checkpoint_interval=None):
     """Imputes the position of missing markers.
 
     :param model_path: Path to model to use for prediction.
@@ -153,75 +82,86 @@ def predict_single_pass(model_path, data_path, pass_direction, *,
     :param error_diff_thresh: Z-scored difference threshold marking suspicious
                               frames
     :param model: Model to be used in prediction. Overrides model_path.
+    :param batch_size: Maximum number of gaps imputed in a single model call.
+    :param halo: Number of frames preceding (forward) or following (reverse)
+                 the fold to read as context for the rollout. The halo is
+                 saved with the fold and dropped by merge.
+    :param dataset: Dataset to be used in prediction (see
+                    dataset.open_session). Overrides data_path.
+    :param incremental: If True, evaluate WaveNet models incrementally,
+                        reusing the activations of the previous frame, and
+                        step LSTM models one frame at a time, which is
+                        approximate (see incremental.py).
+    :param save_dtype: Dtype of the saved predictions, markers and member
+                       stds.
+    :param compression: HDF5 compression of the saved frames, or 'none'.
+    :param checkpoint_interval: If set, save the state of the rollout to
+                                save_path every checkpoint_interval seconds.
+                                A job restarted with the same arguments
+                                resumes from the last checkpoint, and saves
+                                the same predictions as an uninterrupted job.
+                                The checkpoint is deleted once the
+                                predictions are saved.
     :return: preds
     """
     if not (pass_direction == 'forward') | (pass_direction == 'reverse'):
         raise ValueError('pass_direction must be forward or reverse')
 
-    # Check data extensions
-    filename, file_extension = os.path.splitext(data_path)
-    accepted_extensions = {'.h5', '.hdf5', '.mat'}
-    if file_extension not in accepted_extensions:
-        raise ValueError('Improper extension: hdf5 or \
-                         mat -v7.3 file required.')
-
-    # Load data
+    # Load data. Only the frames to impute are read below.
     print('Loading data')
-    f = h5py.File(data_path, 'r')
-    if file_extension in {'.h5', '.hdf5'}:
-        markers = np.array(f['markers'][:]).T
-        marker_means = np.array(f['marker_means'][:]).T
-        marker_stds = np.array(f['marker_stds'][:]).T
-        bad_frames = np.array(f['bad_frames'][:]).T
-    else:
-        # Get the markers data from the struct
-        dset = 'markers_aligned_preproc'
-        marker_names = list(f[dset].keys())
-        n_frames_tot = f[dset][marker_names[0]][:].T.shape[0]
-        n_dims = f[dset][marker_names[0]][:].T.shape[1]
-
-        markers = np.zeros((n_frames_tot, len(marker_names)*n_dims))
-        for i in range(len(marker_names)):
-            marker = f[dset][marker_names[i]][:].T
-            for j in range(n_dims):
-                markers[:, i*n_dims + j] = marker[:, j]
-
-        # Z-score the marker data
-        marker_means = np.mean(markers, axis=0)
-        marker_means = marker_means[None, ...]
-        marker_stds = np.std(markers, axis=0)
-        marker_stds = marker_stds[None, ...]
-        print(marker_means)
-        print(marker_stds)
-        markers = stats.zscore(markers)
-
-        # Get the bad_frames data from the cell
-        dset = 'bad_frames_agg'
-        n_markers = f[dset][:].shape[0]
-        bad_frames = np.zeros((markers.shape[0], n_markers))
-        for i in range(n_markers):
-            reference = f[dset][i][0]
-            bad_frames[np.squeeze(f[reference][:]).astype('int32') - 1, i] = 1
-
-    # Get the start frame and number of frames after splitting the data up
-    markers = markers[::stride, :]
-    bad_frames = bad_frames[::stride, :]
-    n_frames = int(np.floor(markers.shape[0]/n_folds))
+    opened_dataset = dataset is None
+    if opened_dataset:
+        dataset = open_session(data_path)
+    markers = dataset.markers
+    marker_means = dataset.marker_means
+    marker_stds = dataset.marker_stds
+    bad_frames = dataset.bad_frames
+
+    # Get the start frame and number of frames after splitting the data up.
+    # Frames are counted after striding.
+    n_frames_tot = len(range(0, markers.shape[0], stride))
+    n_frames = int(np.floor(n_frames_tot/n_folds))
     fold_id = int(fold_id)
     start_frame = n_frames * int(fold_id)
 
     # Also predict the remainder if on the last fold.
     if fold_id == (n_folds-1):
-        markers = markers[start_frame:, :]
-        bad_frames = bad_frames[start_frame:, :]
+        stop_frame = n_frames_tot
     else:
-        markers = markers[start_frame:(start_frame + n_frames), :]
-        bad_frames = bad_frames[start_frame:(start_frame + n_frames), :]
-
-    # Load model
-    if model is None:
+        stop_frame = start_frame + n_frames
+
+    # Extend the fold with a halo of context frames on the side the rollout
+    # starts from, so gaps that straddle fold boundaries are seeded.
+    halo = int(halo)
+    if pass_direction == 'forward':
+        halo_start = min(halo, start_frame)
+        halo_end = 0
+    else:
+        halo_start = 0
+        halo_end = min(halo, n_frames_tot - stop_frame)
+    fold = slice((start_frame - halo_start)*stride,
+                 (stop_frame + halo_end)*stride, stride)
+    markers = markers[fold]
+    bad_frames = bad_frames[fold]
+    if opened_dataset:
+        dataset.close()
+
+    # Load model. Exported models only run in the numpy engine.
+    if model is None and is_exported(model_path):
+        incremental = True
+    # Models passed already wrapped for incremental inference stay so.
+    if model is not None and hasattr(model, 'predict_windows'):
+        incremental = True
+    if model is None and incremental:
+        print('Loading model')
+        model = load_incremental(model_path)
+    elif model is None:
         print('Loading model')
         model = load_model(model_path)
+    if incremental:
+        model = incremental_model(model)
+    else:
+        model = as_runtime(model)
 
     # Check how many outputs the model has to handle it appropriately
     n_outputs = len(model.output_shape)
@@ -229,7 +169,6 @@ def predict_single_pass(model_path, data_path, pass_direction, *,
         return_member_data = True
     else:
         return_member_data = False
-        member_stds = [None]
 
     # Set Markers to fix
     if markers_to_fix is None:
@@ -247,6 +186,14 @@ def predict_single_pass(model_path, data_path, pass_direction, *,
     print('Predicting %d frames starting at frame %d.'
           % (markers.shape[0], start_frame))
 
+    checkpoint = None
+    if save_path is not None and checkpoint_interval is not None:
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        checkpoint = Checkpoint(
+            os.path.join(save_path, '%s_fold_id_%d_checkpoint.npz' %
+                         (pass_direction, fold_id)), checkpoint_interval)
+
     # If the model can return the member predictions, do so.
     if return_member_data:
         print('Imputing markers: %s pass' % (pass_direction), flush=True)
@@ -254,7 +201,8 @@ def predict_single_pass(model_path, data_path, pass_direction, *,
             predict_markers(model, markers, bad_frames,
                             markers_to_fix=markers_to_fix,
                             error_diff_thresh=error_diff_thresh,
-                            return_member_data=return_member_data)
+                            return_member_data=return_member_data,
+                            batch_size=batch_size, checkpoint=checkpoint)
     else:
         # Forward predict
         print('Imputing markers: %s pass' % (pass_direction), flush=True)
@@ -262,7 +210,12 @@ def predict_single_pass(model_path, data_path, pass_direction, *,
             predict_markers(model, markers, bad_frames,
                             markers_to_fix=markers_to_fix,
                             error_diff_thresh=error_diff_thresh,
-                            return_member_data=return_member_data)
+                            return_member_data=return_member_data,
+                            batch_size=batch_size, checkpoint=checkpoint)
+        # A single model has no spread between members.
+        member_stds = np.zeros((1,) + preds.shape)
+
+    model.report()
 
     # Flip the data for the reverse cases to save in the correct direction.
     if pass_direction == 'reverse':
@@ -271,21 +224,29 @@ def predict_single_pass(model_path, data_path, pass_direction, *,
         bad_frames = bad_frames[::-1, :]
         member_stds = member_stds[:, ::-1, :]
 
-    # Save predictions to a matlab file.
+    # Save predictions to a MATLAB v7.3 file.
     if save_path is not None:
         file_name = '%s_fold_id_%d.mat' % (pass_direction, fold_id)
         if not os.path.exists(save_path):
             os.makedirs(save_path)
         save_path = os.path.join(save_path, file_name)
         print('Saving to %s' % (save_path))
-        savemat(save_path, {'preds': preds, 'markers': markers,
-                            'bad_frames': bad_frames,
-                            'member_stds': np.squeeze(member_stds),
-                            'n_folds': n_folds,
-                            'fold_id': fold_id,
-                            'pass_direction': pass_direction,
-                            'marker_means': marker_means,
-                            'marker_stds': marker_stds})
+        with PredictionStore(save_path, 'w', dtype=save_dtype,
+                             compression=compression) as store:
+            store.write('preds', preds, store_dtype=True)
+            store.write('markers', markers, store_dtype=True)
+            store.write('bad_frames', bad_frames)
+            store.write('member_stds', np.squeeze(member_stds, axis=0),
+                        store_dtype=True)
+            store.write('n_folds', n_folds)
+            store.write('fold_id', fold_id)
+            store.write('pass_direction', pass_direction)
+            store.write('halo_start', halo_start)
+            store.write('halo_end', halo_end)
+            store.write('marker_means', marker_means)
+            store.write('marker_stds', marker_stds)
+        if checkpoint is not None:
+            checkpoint.remove()
 
     return preds
 
@@ -0,0 +1,20 @@
+#!/bin/bash
+#SBATCH -J ImputeFolds
+#SBATCH -p olveczky      # partition (queue)
+#SBATCH -N 1                # number of nodes
+#SBATCH -n 1                # number of tasks
+#SBATCH -c 32               # number of cores
+#SBATCH --mem 120000        # memory for all cores
+#SBATCH -t 0-24:00          # time (D-HH:MM)
+#SBATCH --export=ALL
+#SBATCH -o logs/Job.imputeFolds.%N.%j.out    # STDOUT
+#SBATCH -e logs/Job.imputeFolds.%N.%j.err    # STDERR
+
+# Impute all folds of both passes on one node and merge them.
+# $1 model path, $2 data path, $3 fold save path, $4 merged file path,
+# $5 stride, $6 number of folds, $7 error diff threshold
+FUNC="impute_folds.py"
+
+srun -l process/py.sh $FUNC $1 $2 $3 --merged-path=$4 --stride=$5 --n-folds=$6 --n-workers=$SLURM_CPUS_PER_TASK --error-diff-thresh=$7
+
+wait
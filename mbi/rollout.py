@@ -0,0 +1,690 @@
+"""Batched autoregressive imputation of marker gaps."""
+import numpy as np
+import os
+import time
+
+# Gap states used by the scheduler in predict_gaps.
+PENDING = 0
+ACTIVE = 1
+DONE = 2
+ABSORBED = 3
+
+
+class ContextWindow:
+    """Preallocated circular buffer holding the context windows of a rollout.
+
+    Every frame is stored twice, input_length frames apart, in a buffer of
+    twice the window length. The last input_length frames of each window are
+    then always a contiguous slice of the buffer, so appending a frame costs
+    two writes and no allocation. All windows advance together.
+
+    shift counts the frames appended to each window since it was last
+    predicted, for incremental models. Filled windows have a shift of
+    input_length.
+    """
+
+    def __init__(self, n_windows, input_length, n_markers, dtype='float64'):
+        """Allocate the buffer.
+
+        :param n_windows: Number of windows (batch size of the model)
+        :param input_length: Number of frames input to the model.
+        :param n_markers: Number of markers per frame
+        :param dtype: Data type of the buffer
+        """
+        self.input_length = input_length
+        self.buffer = np.zeros((n_windows, 2 * input_length, n_markers),
+                               dtype)
+        self.head = 0
+        self.shift = np.full((n_windows,), input_length)
+
+    def fill(self, frames, ids=slice(None)):
+        """Replace the contents of windows.
+
+        :param frames: Frames of shape (n_ids, input_length, n_markers)
+        :param ids: Windows to fill. Default all.
+        """
+        # Rotate the frames so that the oldest sits at the current head.
+        frames = np.roll(frames, self.head, axis=1)
+        self.buffer[ids, :self.input_length, :] = frames
+        self.buffer[ids, self.input_length:, :] = frames
+        self.shift[ids] = self.input_length
+
+    def append(self, frame, ids=slice(None)):
+        """Drop the oldest frame of every window and append a new one.
+
+        Windows not in ids are advanced as well and hold stale data until
+        they are filled again.
+        :param frame: Frames of shape (n_ids, n_markers)
+        :param ids: Windows receiving the frame. Default all.
+        """
+        self.buffer[ids, self.head, :] = frame
+        self.buffer[ids, self.head + self.input_length, :] = frame
+        self.head = (self.head + 1) % self.input_length
+        self.shift[ids] += 1
+
+    def view(self):
+        """Return a view of all windows, oldest frame first."""
+        return self.buffer[:, self.head:(self.head + self.input_length), :]
+
+    def extend(self, X, frame_ids, n_new, ids):
+        """Append runs of consecutive frames of X to a subset of windows.
+
+        :param X: marker data (n_frames x n_markers)
+        :param frame_ids: First frame of X to append to each window.
+        :param n_new: Number of frames to append to each window.
+        :param ids: Integer indices of the windows.
+        """
+        # Position p of the new window is element p + n_new of the old window
+        # followed by the new frames.
+        ids = np.asarray(ids)
+        shift = self.shift[ids] + n_new
+        pos = np.arange(self.input_length)[None, :] + n_new[:, None]
+        from_old = pos < self.input_length
+        old = self.take(ids)
+        old = old[np.arange(ids.shape[0])[:, None],
+                  np.minimum(pos, self.input_length - 1), :]
+        new = X[np.clip(frame_ids[:, None] + pos - self.input_length, 0,
+                        X.shape[0] - 1), :]
+        self.fill(np.where(from_old[..., None], old, new), ids)
+        self.shift[ids] = shift
+
+    def take(self, ids, out=None):
+        """Gather a subset of windows into a batch.
+
+        :param ids: Integer indices of the windows.
+        :param out: Optional preallocated array with at least len(ids) rows.
+        """
+        if out is None:
+            return np.take(self.view(), ids, axis=0)
+        out = out[:len(ids)]
+        np.take(self.view(), ids, axis=0, out=out, mode='clip')
+        return out
+
+
+def flag_errors(X, bad_frames, markers_to_fix, error_diff_thresh,
+                input_length, continued=False):
+    """Mark jumps between consecutive measured frames as bad.
+
+    This is the error check of the sequential rollout evaluated for every
+    frame at once. It is exact wherever the previous frame of a marker was
+    measured rather than imputed, which is everywhere outside of gaps. The
+    check on the first imputed frame compares against zeros, as the
+    sequential rollout does.
+    :param X: marker data (n_frames x n_markers)
+    :param bad_frames: logical matrix of shape == X.shape
+    :param markers_to_fix: boolean vector of length n_markers.
+    :param error_diff_thresh: z-scored distance at which predictions override
+                              marker measurements.
+    :param input_length: Number of frames input to the model.
+    :param continued: If True, X continues a longer recording, and the first
+                      imputed frame is checked against the frame before it.
+    :return: bad_frames with the detected errors marked
+    """
+    bad_frames = bad_frames.copy()
+    if X.shape[0] <= input_length:
+        return bad_frames
+    prev = np.zeros((X.shape[0] - input_length, X.shape[1]))
+    prev[1:, :] = X[input_length:-1, :]
+    if continued:
+        prev[0, :] = X[input_length - 1, :]
+    errors = np.abs(prev - X[input_length:, :]) > error_diff_thresh
+    errors[:, ~markers_to_fix] = False
+    bad_frames[input_length:, :] |= errors
+    return bad_frames
+
+
+def find_runs(mask):
+    """Find the runs of True values in a boolean vector.
+
+    :param mask: Boolean vector
+    :return: starts, lengths
+    """
+    edges = np.diff(np.concatenate(([0], mask.astype('int8'), [0])))
+    starts = np.where(edges == 1)[0]
+    lengths = np.where(edges == -1)[0] - starts
+    return starts, lengths
+
+
+class RunIndex:
+    """Run-length index of the frames containing bad markers.
+
+    Lets the rollout jump from one gap to the next without visiting the
+    fully tracked frames in between.
+    """
+
+    def __init__(self, bad_frames, first_frame=0):
+        """Index the runs of bad frames.
+
+        :param bad_frames: logical matrix (n_frames x n_markers)
+        :param first_frame: Frames before first_frame are ignored.
+        """
+        is_bad = np.any(bad_frames, axis=1)
+        is_bad[:first_frame] = False
+        self.n_frames = is_bad.shape[0]
+        self.starts, self.lengths = find_runs(is_bad)
+        self.ends = self.starts + self.lengths
+
+    def next_bad(self, frame_ids):
+        """Return the first bad frame at or after each frame id.
+
+        :param frame_ids: Integer vector of frame ids.
+        :return: Frame ids, n_frames where there is no bad frame left.
+        """
+        ids = np.searchsorted(self.ends, frame_ids, side='right')
+        next_bad = np.full(np.shape(frame_ids), self.n_frames)
+        has_bad = ids < self.starts.shape[0]
+        next_bad[has_bad] = np.maximum(self.starts[ids[has_bad]],
+                                       frame_ids[has_bad])
+        return next_bad
+
+    def gaps(self, input_length):
+        """Find independent gaps.
+
+        A gap is a stretch of frames containing bad markers in which
+        consecutive runs of bad frames are separated by fewer than
+        input_length tracked frames. The context window preceding each gap is
+        then made entirely of measured data, so gaps can be imputed
+        independently of one another.
+        :param input_length: Number of frames input to the model.
+        :return: starts, lasts - first and last bad frame of each gap.
+        """
+        splits = np.where((self.starts[1:] - self.ends[:-1]) >=
+                          input_length)[0]
+        starts = np.concatenate((self.starts[:1], self.starts[splits + 1]))
+        lasts = np.concatenate((self.ends[splits], self.ends[-1:])) - 1
+        return starts, lasts
+
+
+class GapRollout:
+    """State of the batched rollout of the gaps of one recording.
+
+    Each independent gap occupies one slot of a batch holding its context
+    window and its last appended frame. A step gathers the windows of the
+    gaps that need a prediction with inputs, and advances every active gap
+    by one frame with advance. Several rollouts can share model calls (see
+    run_rollouts).
+    """
+
+    def __init__(self, X, bad_frames, input_length, markers_to_fix=None,
+                 error_diff_thresh=.25, outlier_thresh=3, member_data=None,
+                 n_members=None, batch_size=1000, continued=False,
+                 verbose=True):
+        """Find the gaps of a recording.
+
+        :param X: marker data (n_frames x n_markers)
+        :param bad_frames: logical matrix of shape (n_frames, n_markers/3)
+        :param input_length: Number of frames input to the model.
+        :param markers_to_fix: boolean vector of length n_markers.
+        :param error_diff_thresh: z-scored distance at which predictions
+                                  override marker measurements.
+        :param outlier_thresh: Threshold at which to ignore model predictions.
+        :param member_data: None, 'stds' or 'preds' (see predict_gaps).
+        :param n_members: Number of ensemble members if member_data is
+                          'preds'.
+        :param batch_size: Maximum number of gaps advanced together.
+        :param continued: If True, X continues a longer recording, and the
+                          first imputed frame is checked against the frame
+                          before it rather than zeros.
+        :param verbose: If True, print the number of gaps.
+        """
+        self.X = X
+        self.input_length = input_length
+        self.n_frames, n_markers = X.shape
+        self.markers_to_fix = markers_to_fix
+        self.error_diff_thresh = error_diff_thresh
+        self.outlier_thresh = outlier_thresh
+        self.member_data = member_data
+        self.fix_errors = np.any(markers_to_fix)
+        self.continued = continued
+
+        # Every frame outside of a gap is known without running the model.
+        bad_frames = np.repeat(bad_frames, 3, axis=1) > .5
+        self.measured_bad = bad_frames
+        if self.fix_errors:
+            bad_frames = flag_errors(X, bad_frames, markers_to_fix,
+                                     error_diff_thresh, input_length,
+                                     continued)
+        self.bad_frames = bad_frames
+        self.static_bad = bad_frames.copy()
+        self.preds = np.array(X, dtype='float64')
+        if member_data == 'stds':
+            self.member_out = np.full((self.n_frames, n_markers), np.nan)
+            self.member_out[:input_length, :] = 0
+        elif member_data == 'preds':
+            self.member_out = np.zeros((n_members, self.n_frames, n_markers))
+
+        self.run_index = RunIndex(bad_frames, input_length)
+        self.starts, lasts = self.run_index.gaps(input_length)
+        self.n_gaps = self.starts.shape[0]
+        if verbose:
+            print('Imputing %d gaps' % (self.n_gaps), flush=True)
+
+        # Per-gap scheduling state.
+        self.status = np.full((self.n_gaps,), PENDING)
+        self.cursor = self.starts.copy()
+        self.lasts = lasts.copy()
+        self.nxt = np.arange(1, self.n_gaps + 1)
+        self.clean_run = np.zeros((self.n_gaps,), 'int64')
+        self.slot_of = np.zeros((self.n_gaps,), 'int64')
+        self.windows = ContextWindow(batch_size, input_length, n_markers)
+        self.prev = np.zeros((batch_size, n_markers))
+        self.free_slots = list(range(batch_size - 1, -1, -1))
+        self.active = np.zeros((0,), 'int64')
+        self.next_pending = 0
+
+    def restore(self, gap):
+        """Undo the writes of a gap that turned out to depend on its
+        predecessor."""
+        ids = slice(self.starts[gap], self.cursor[gap])
+        self.preds[ids, :] = self.X[ids, :]
+        self.bad_frames[ids, :] = self.static_bad[ids, :]
+        if self.member_data == 'stds':
+            self.member_out[ids, :] = np.nan
+        elif self.member_data == 'preds':
+            self.member_out[:, ids, :] = 0
+
+    def admit(self):
+        """Admit pending gaps into free slots in temporal order.
+
+        :return: True if any gap is active.
+        """
+        X = self.X
+        admitted = []
+        while self.free_slots and self.next_pending < self.n_gaps:
+            gap = self.next_pending
+            self.next_pending += 1
+            if self.status[gap] != PENDING:
+                continue
+            slot = self.free_slots.pop()
+            start = self.starts[gap]
+            self.windows.fill(X[None, (start - self.input_length):start, :],
+                              slot)
+            if start == self.input_length and not self.continued:
+                self.prev[slot, :] = 0
+            else:
+                self.prev[slot, :] = X[start - 1, :]
+            self.slot_of[gap] = slot
+            self.status[gap] = ACTIVE
+            admitted.append(gap)
+        if admitted:
+            self.active = np.concatenate((self.active,
+                                          admitted)).astype('int64')
+        return self.active.size > 0
+
+    def inputs(self, out):
+        """Gather the windows of the gaps that need a prediction.
+
+        Checks for errors against the previous frame of each active gap.
+        :param out: Preallocated batch with at least batch_size rows.
+        :return: Number of windows written to out.
+        """
+        active = self.active
+        self.slots = self.slot_of[active]
+        self.frame_ids = self.cursor[active]
+        self.X_next = self.X[self.frame_ids, :]
+        is_bad = self.measured_bad[self.frame_ids, :]
+        if self.fix_errors:
+            errors = np.abs(self.prev[self.slots, :] - self.X_next) > \
+                self.error_diff_thresh
+            errors[:, ~self.markers_to_fix] = False
+            is_bad = is_bad | errors
+        self.bad_frames[self.frame_ids, :] = is_bad
+        self.is_bad = is_bad
+        self.needs = np.any(is_bad, axis=1)
+        self.predicted_slots = self.slots[self.needs]
+        return self.windows.take(self.predicted_slots, out=out).shape[0]
+
+    def advance(self, output=None, member_pred=None):
+        """Append a frame to every active gap.
+
+        :param output: Model predictions (n_needs x 1 x n_markers) for the
+                       windows returned by inputs.
+        :param member_pred: Predictions of the ensemble members
+                            (n_needs x n_members x n_markers), if member_data
+                            is not None.
+        """
+        X = self.X
+        n_frames = self.n_frames
+        active, slots, frame_ids = self.active, self.slots, self.frame_ids
+        X_next, is_bad, needs = self.X_next, self.is_bad, self.needs
+        cursor, clean_run = self.cursor, self.clean_run
+
+        # Only use the predictions for the bad markers that are not
+        # anomalous.
+        pred = X_next.copy()
+        if np.any(needs):
+            output = output[:, 0, :]
+            use_pred = is_bad[needs, :] & \
+                ~(np.abs(output) > self.outlier_thresh)
+            pred[needs, :] = np.where(use_pred, output, X_next[needs, :])
+            if self.member_data == 'stds':
+                self.member_out[frame_ids[needs], :] = \
+                    np.where(is_bad[needs, :], np.std(member_pred, axis=1),
+                             np.nan)
+            elif self.member_data == 'preds':
+                member_pred = np.where(is_bad[needs, None, :], member_pred, 0)
+                self.member_out[:, frame_ids[needs], :] = \
+                    np.transpose(member_pred, (1, 0, 2))
+        self.preds[frame_ids, :] = pred
+
+        # Append the frame to the context windows.
+        self.windows.append(pred, slots)
+        self.prev[slots, :] = pred
+        clean_run[active] = np.where(needs, 0, clean_run[active] + 1)
+        cursor[active] += 1
+
+        # After a tracked frame, every frame up to the next bad frame is
+        # known. Skip over them, finishing the gap once it is past its last
+        # bad frame and the context window holds only measured data again.
+        finished = cursor[active] >= n_frames
+        tracked = ~needs & ~finished
+        gaps = active[tracked]
+        next_bad = self.run_index.next_bad(cursor[gaps])
+        n_skipped = next_bad - cursor[gaps]
+        clean_run[gaps] += n_skipped
+        done = (next_bad >= n_frames) | \
+            ((clean_run[gaps] >= self.input_length) &
+             (next_bad > self.lasts[gaps]))
+        finished[tracked] = done
+        jump = ~done & (n_skipped > 0)
+        if np.any(jump):
+            jump_slots = slots[tracked][jump]
+            self.windows.extend(X, cursor[gaps[jump]], n_skipped[jump],
+                                jump_slots)
+            self.prev[jump_slots, :] = X[next_bad[jump] - 1, :]
+            cursor[gaps[jump]] = next_bad[jump]
+        self.status[active[finished]] = DONE
+        self.free_slots.extend(slots[finished].tolist())
+        active = active[~finished]
+
+        # Merge gaps whose rollout reaches the start of the following gap.
+        nxt = self.nxt
+        has_next = nxt[active] < self.n_gaps
+        reached = np.zeros(active.shape, bool)
+        reached[has_next] = \
+            cursor[active[has_next]] == self.starts[nxt[active[has_next]]]
+        for gap in active[reached]:
+            # A gap absorbed earlier in this loop was merged into the gap
+            # before it, which continues from where it stands.
+            if self.status[gap] == ABSORBED:
+                continue
+            absorbed = nxt[gap]
+            if self.status[absorbed] == ACTIVE:
+                self.free_slots.append(self.slot_of[absorbed])
+                active = active[active != absorbed]
+            if self.status[absorbed] != PENDING:
+                self.restore(absorbed)
+            self.status[absorbed] = ABSORBED
+            self.lasts[gap] = max(self.lasts[gap], self.lasts[absorbed])
+            nxt[gap] = nxt[absorbed]
+        self.active = active
+
+    def state(self):
+        """Return the mutable state of the rollout as a dict of arrays.
+
+        Everything else is derived from the arguments of the rollout.
+        """
+        state = dict(preds=self.preds, bad_frames=self.bad_frames,
+                     status=self.status, cursor=self.cursor,
+                     lasts=self.lasts, nxt=self.nxt,
+                     clean_run=self.clean_run, slot_of=self.slot_of,
+                     buffer=self.windows.buffer,
+                     head=np.array(self.windows.head),
+                     shift=self.windows.shift, prev=self.prev,
+                     free_slots=np.array(self.free_slots, 'int64'),
+                     active=self.active,
+                     next_pending=np.array(self.next_pending),
+                     starts=self.starts, static_bad=self.static_bad)
+        if self.member_data is not None:
+            state['member_out'] = self.member_out
+        return state
+
+    def set_state(self, state):
+        """Restore a state returned by state.
+
+        :param state: Dict of arrays.
+        """
+        if not (np.array_equal(state['starts'], self.starts) and
+                np.array_equal(state['static_bad'], self.static_bad) and
+                state['buffer'].shape == self.windows.buffer.shape and
+                ('member_out' in state) == (self.member_data is not None)):
+            raise ValueError('The checkpoint was made with different data or '
+                             'arguments.')
+        self.preds = state['preds']
+        self.bad_frames = state['bad_frames']
+        if self.member_data is not None:
+            self.member_out = state['member_out']
+        self.status = state['status']
+        self.cursor = state['cursor']
+        self.lasts = state['lasts']
+        self.nxt = state['nxt']
+        self.clean_run = state['clean_run']
+        self.slot_of = state['slot_of']
+        self.windows.buffer = state['buffer']
+        self.windows.head = int(state['head'])
+        self.windows.shift = state['shift']
+        self.prev = state['prev']
+        self.free_slots = state['free_slots'].tolist()
+        self.active = state['active']
+        self.next_pending = int(state['next_pending'])
+
+    def results(self):
+        """Return preds, bad_frames(, member data)."""
+        if self.member_data is not None:
+            return self.preds, self.bad_frames, self.member_out
+        return self.preds, self.bad_frames
+
+
+class Checkpoint:
+    """Periodic snapshots of the rollouts of run_rollouts.
+
+    A snapshot holds the state of every rollout between two steps, so a
+    rollout resumed from it makes the same model calls as one that never
+    stopped, and produces identical results. Snapshots replace each other
+    atomically, so an interrupted save leaves the previous one intact.
+    """
+
+    def __init__(self, path, interval=600):
+        """Initialize the checkpoint.
+
+        :param path: Path to the .npz snapshot.
+        :param interval: Minimum time between snapshots (s).
+        """
+        self.path = path
+        self.interval = interval
+        self.last_save = time.time()
+
+    def load(self, rollouts):
+        """Restore the rollouts from the snapshot, if there is one.
+
+        :param rollouts: List of GapRollouts, as created for the snapshot.
+        :return: Number of steps taken before the snapshot, 0 if there is
+                 none.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        print('Resuming from %s' % (self.path), flush=True)
+        with np.load(self.path) as data:
+            if int(data['n_rollouts']) != len(rollouts):
+                raise ValueError('The checkpoint was made with different '
+                                 'data or arguments.')
+            for i, rollout in enumerate(rollouts):
+                prefix = 'rollout_%d_' % (i)
+                rollout.set_state({name[len(prefix):]: data[name]
+                                   for name in data.files
+                                   if name.startswith(prefix)})
+            return int(data['n_steps'])
+
+    def save(self, rollouts, n_steps):
+        """Write a snapshot of the rollouts.
+
+        :param rollouts: List of GapRollouts
+        :param n_steps: Number of steps taken.
+        """
+        arrays = {'n_rollouts': np.array(len(rollouts)),
+                  'n_steps': np.array(n_steps)}
+        for i, rollout in enumerate(rollouts):
+            for name, value in rollout.state().items():
+                arrays['rollout_%d_%s' % (i, name)] = value
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, self.path)
+        self.last_save = time.time()
+        print('Saved checkpoint at step %d' % (n_steps), flush=True)
+
+    def update(self, rollouts, n_steps):
+        """Write a snapshot if the interval has passed since the last one."""
+        if time.time() - self.last_save >= self.interval:
+            self.save(rollouts, n_steps)
+
+    def remove(self):
+        """Delete the snapshot once it is no longer needed."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_rollouts(model, rollouts, batch_size, checkpoint=None):
+    """Advance several rollouts together, sharing each model call.
+
+    Incremental models (see incremental.py) are given the cache key of every
+    window, the slot of its gap, and the number of frames appended to it
+    since its last prediction.
+    :param model: model to use for prediction
+    :param rollouts: List of GapRollouts
+    :param batch_size: Maximum number of gaps of each rollout advanced in a
+                       single model call.
+    :param checkpoint: Optional Checkpoint from which to resume, and to which
+                       the rollouts are periodically saved.
+    """
+    input_length, n_markers = model.input.shape.as_list()[1:]
+    batch = np.zeros((len(rollouts) * batch_size, input_length, n_markers))
+    incremental = hasattr(model, 'predict_windows')
+    if incremental:
+        model.reset(len(rollouts) * batch_size)
+    n_steps = 0
+    if checkpoint is not None:
+        n_steps = checkpoint.load(rollouts)
+        # Caches of incremental models are not saved. Recompute every
+        # window on its next prediction. This is exact for WaveNets, while
+        # LSTMs in step mode restart from the window (see incremental.py).
+        for rollout in rollouts:
+            rollout.windows.shift[:] = input_length
+    while True:
+        active = [rollout for rollout in rollouts if rollout.admit()]
+        if not active:
+            break
+
+        n_steps += 1
+        if np.mod(n_steps, 1000) == 0:
+            print('Step %d: %d gaps active, %d pending' %
+                  (n_steps, sum(rollout.active.size for rollout in active),
+                   sum(rollout.n_gaps - rollout.next_pending
+                       for rollout in rollouts)), flush=True)
+
+        # Stack the windows of every rollout into a single batch.
+        bounds = [0]
+        for rollout in active:
+            bounds.append(bounds[-1] + rollout.inputs(batch[bounds[-1]:]))
+        output = member_pred = None
+        if bounds[-1] > 0 and incremental:
+            keys = np.concatenate([rollouts.index(rollout) * batch_size +
+                                   rollout.predicted_slots
+                                   for rollout in active])
+            shifts = np.concatenate([
+                rollout.windows.shift[rollout.predicted_slots]
+                for rollout in active])
+            output = model.predict_windows(batch[:bounds[-1]], keys, shifts)
+            for rollout in active:
+                rollout.windows.shift[rollout.predicted_slots] = 0
+        elif bounds[-1] > 0:
+            output = model.predict(batch[:bounds[-1]],
+                                   batch_size=bounds[-1])
+        if isinstance(output, list):
+            output, member_pred = output
+        for i, rollout in enumerate(active):
+            ids = slice(bounds[i], bounds[i + 1])
+            rollout.advance(None if output is None else output[ids],
+                            None if member_pred is None else member_pred[ids])
+        if checkpoint is not None:
+            checkpoint.update(rollouts, n_steps)
+
+
+def predict_gaps(model, X, bad_frames, markers_to_fix=None,
+                 error_diff_thresh=.25, outlier_thresh=3, member_data=None,
+                 batch_size=1000, checkpoint=None):
+    """Imputes the position of missing markers, advancing all gaps together.
+
+    Produces the same results as the sequential frame by frame rollout, but
+    only runs the model on frames with missing markers, and advances every
+    independent gap by one frame per model call. Tracked stretches are
+    skipped using a run-length index of the bad frames, so the work done
+    scales with the number of missing frames rather than the length of the
+    recording. Gaps whose rollout runs into the context window of the
+    following gap are merged on the fly.
+    :param model: model to use for prediction
+    :param X: marker data (n_frames x n_markers)
+    :param bad_frames: logical matrix of shape (n_frames, n_markers/3) where 0
+                       denotes a tracked frame and 1 denotes a dropped frame
+    :param markers_to_fix: boolean vector of length n_markers. True if you
+                           wish to override marker on frames further than
+                           error_diff_thresh from the previous prediction.
+    :param error_diff_thresh: z-scored distance at which predictions override
+                              marker measurements.
+    :param outlier_thresh: Threshold at which to ignore model predictions.
+    :param member_data: None, 'stds' or 'preds'. If 'stds', also return the
+                        std of the ensemble members (n_frames x n_markers),
+                        nan where a marker was not imputed. If 'preds', also
+                        return the predictions of each ensemble member
+                        (n_members x n_frames x n_markers), zero where a
+                        marker was not imputed.
+    :param batch_size: Maximum number of gaps advanced in a single model call.
+    :param checkpoint: Optional Checkpoint from which to resume, and to which
+                       the rollout is periodically saved.
+    :return: preds, bad_frames(, member data)
+    """
+    return predict_passes(model, [X], [bad_frames],
+                          markers_to_fix=markers_to_fix,
+                          error_diff_thresh=error_diff_thresh,
+                          outlier_thresh=outlier_thresh,
+                          member_data=member_data, batch_size=batch_size,
+                          checkpoint=checkpoint)[0]
+
+
+def predict_passes(model, Xs, bad_frames, markers_to_fix=None,
+                   error_diff_thresh=.25, outlier_thresh=3, member_data=None,
+                   batch_size=1000, checkpoint=None):
+    """Imputes several recordings together, sharing each model call.
+
+    Typically the forward and reversed recording, so that both passes move
+    through the same model calls. Each result matches predict_gaps on the
+    recording alone, up to the rounding differences of the model across batch
+    compositions.
+    :param model: model to use for prediction
+    :param Xs: List of marker data (n_frames x n_markers)
+    :param bad_frames: List of logical matrices of shape (n_frames,
+                       n_markers/3), one per recording.
+    :param markers_to_fix: boolean vector of length n_markers.
+    :param error_diff_thresh: z-scored distance at which predictions override
+                              marker measurements.
+    :param outlier_thresh: Threshold at which to ignore model predictions.
+    :param member_data: None, 'stds' or 'preds' (see predict_gaps).
+    :param batch_size: Maximum number of gaps of each recording advanced in a
+                       single model call.
+    :param checkpoint: Optional Checkpoint from which to resume, and to which
+                       the rollouts are periodically saved.
+    :return: List of (preds, bad_frames(, member data)), one per recording.
+    """
+    input_length = model.input.shape.as_list()[1]
+    n_members = None
+    if member_data == 'preds':
+        n_members = model.output_shape[1][1]
+    rollouts = [GapRollout(X, bad, input_length,
+                           markers_to_fix=markers_to_fix,
+                           error_diff_thresh=error_diff_thresh,
+                           outlier_thresh=outlier_thresh,
+                           member_data=member_data, n_members=n_members,
+                           batch_size=batch_size)
+                for X, bad in zip(Xs, bad_frames)]
+    run_rollouts(model, rollouts, batch_size, checkpoint=checkpoint)
+    return [rollout.results() for rollout in rollouts]
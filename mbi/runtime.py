@@ -0,0 +1,83 @@
+"""Low overhead inference with keras models."""
+from keras import backend as K
+import numpy as np
+import time
+
+
+class InferenceRuntime(object):
+    """Call the forward function of a keras model directly.
+
+    Model.predict validates its inputs and sets up batching and callbacks on
+    every call, which dominates the cost of the small batches of a rollout.
+    The runtime compiles the forward function of the model once and calls it
+    on the same batches as Model.predict, so predictions are unchanged. It
+    has the input, output_shape and predict of the model, and can be used in
+    its place.
+    """
+
+    def __init__(self, model):
+        """Compile the forward function.
+
+        :param model: Keras model
+        """
+        self.model = model
+        self.input = model.input
+        self.output_shape = model.output_shape
+        inputs = list(model.inputs)
+        self.learning_phase = []
+        if model.uses_learning_phase and \
+                not isinstance(K.learning_phase(), int):
+            inputs.append(K.learning_phase())
+            self.learning_phase = [0]
+        self.function = K.function(inputs, model.outputs)
+        self.n_calls = 0
+        self.n_batches = 0
+        self.total_time = 0.
+        self.compute_time = 0.
+
+    def predict(self, x, batch_size=32):
+        """Generate predictions, as Model.predict.
+
+        :param x: Input data
+        :param batch_size: Number of samples per run of the forward function.
+        :return: Prediction array, or list of arrays for models with several
+                 outputs.
+        """
+        start = time.time()
+        batches = []
+        for i in range(0, max(x.shape[0], 1), batch_size):
+            batch_start = time.time()
+            batches.append(self.function([x[i:(i + batch_size)]] +
+                                         self.learning_phase))
+            self.compute_time += time.time() - batch_start
+            self.n_batches += 1
+        outputs = batches[0]
+        if len(batches) > 1:
+            outputs = [np.concatenate(output, axis=0)
+                       for output in zip(*batches)]
+        self.n_calls += 1
+        self.total_time += time.time() - start
+        if len(outputs) == 1:
+            return outputs[0]
+        return outputs
+
+    def report(self):
+        """Print the time per call spent in and around the forward function."""
+        if self.n_calls == 0:
+            return
+        overhead = self.total_time - self.compute_time
+        print('Inference: %d calls, %.3f ms/call (%.3f ms compute, '
+              '%.3f ms overhead)' %
+              (self.n_calls, 1e3 * self.total_time / self.n_calls,
+               1e3 * self.compute_time / self.n_calls,
+               1e3 * overhead / self.n_calls), flush=True)
+
+
+def as_runtime(model):
+    """Wrap a keras model in an InferenceRuntime, unless it already is one.
+
+    :param model: Keras model or InferenceRuntime
+    """
+    if isinstance(model, InferenceRuntime):
+        return model
+    return InferenceRuntime(model)
@@ -0,0 +1,215 @@
+"""Chunked HDF5 store of predictions, readable by MATLAB as a v7.3 .mat."""
+import h5py
+import numpy as np
+import platform
+import time
+from dataset import FrameView
+
+# MATLAB class of each numpy dtype.
+MATLAB_CLASSES = {'float64': 'double', 'float32': 'single',
+                  'uint8': 'uint8', 'int8': 'int8', 'uint16': 'uint16',
+                  'int16': 'int16', 'uint32': 'uint32', 'int32': 'int32',
+                  'uint64': 'uint64', 'int64': 'int64'}
+
+
+def matlab_header():
+    """First 128 bytes of the userblock of a MATLAB v7.3 .mat file."""
+    text = 'MATLAB 7.3 MAT-file, Platform: %s, Created on: %s ' \
+        'HDF5 schema 1.00 .' % (platform.system(),
+                               time.strftime('%a %b %d %H:%M:%S %Y'))
+    return text.ljust(116).encode('ascii') + bytes(8) + b'\x00\x02IM'
+
+
+def is_store(path):
+    """True if the file is a prediction store rather than a MATLAB v5 file.
+
+    :param path: Path to .mat file.
+    """
+    return h5py.is_hdf5(path)
+
+
+class PredictionStore(object):
+    """Chunked, compressed HDF5 file of predictions.
+
+    Variables are stored as MATLAB v7.3 stores them: transposed, so that
+    frames are along the last axis of the HDF5 datasets, and tagged with
+    their MATLAB class. Stores can be opened with load in MATLAB, and frames
+    can be read without reading the whole variable, as with MarkerDataset.
+    Large variables can be created first and written a block of frames at a
+    time.
+
+    Usage:
+    with PredictionStore(save_path, 'w') as store:
+        store.create('preds', (n_frames, n_markers))
+        store.write_frames('preds', start, preds_block)
+        store.write('pass_direction', 'forward')
+    with PredictionStore(save_path) as store:
+        preds = store['preds'][start_frame:end_frame]
+    """
+
+    def __init__(self, path, mode='r', *, dtype='float32',
+                 compression='gzip', chunk_size=1000):
+        """Open the store.
+
+        :param path: Path to .mat or .h5 file.
+        :param mode: 'r' to read, 'r+' to modify and 'w' to create the file.
+        :param dtype: Dtype of the floating point frames written with
+                      store_dtype=True.
+        :param compression: HDF5 compression filter of frame variables, or
+                            None or 'none' to write them uncompressed.
+        :param chunk_size: Number of frames per chunk.
+        """
+        if mode == 'w':
+            # Reserve the userblock in which MATLAB looks for its header.
+            h5py.File(path, 'w', userblock_size=512).close()
+            with open(path, 'r+b') as f:
+                f.write(matlab_header())
+            mode = 'r+'
+        if compression == 'none':
+            compression = None
+        self.file = h5py.File(path, mode)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.chunk_size = int(chunk_size)
+
+    def __getitem__(self, name):
+        return FrameView(self.file[name])
+
+    def __contains__(self, name):
+        return name in self.file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the underlying file."""
+        self.file.close()
+
+    def keys(self):
+        """Names of the variables in the store."""
+        return list(self.file.keys())
+
+    def shape(self, name):
+        """Shape of a variable, frames first."""
+        return self.file[name].shape[::-1]
+
+    def create(self, name, shape, dtype=None):
+        """Create a chunked variable to be filled with write_frames.
+
+        :param name: Name of the variable.
+        :param shape: Shape of the variable, with frames along axis -2, e.g.
+                      (n_frames, n_markers) or (n_members, n_frames,
+                      n_markers).
+        :param dtype: Dtype of the variable. Defaults to the store dtype.
+        """
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        is_logical = dtype == bool
+        if is_logical:
+            dtype = np.dtype('uint8')
+        shape = tuple(shape)[::-1]
+        chunks = None
+        if len(shape) >= 2 and shape[1] > 1:
+            chunks = list(shape)
+            chunks[1] = min(self.chunk_size, shape[1])
+            chunks = tuple(chunks)
+        dset = self.file.create_dataset(
+            name, shape, dtype, chunks=chunks,
+            compression=self.compression if chunks else None,
+            shuffle=bool(chunks and self.compression))
+        self.set_class(dset, dtype, is_logical)
+
+    def write_frames(self, name, start, frames):
+        """Write a block of frames of a variable.
+
+        :param name: Name of a variable made with create.
+        :param start: First frame of the block.
+        :param frames: Block of frames, frames along axis -2.
+        """
+        frames = np.asarray(frames)
+        stop = start + frames.shape[-2]
+        self.file[name][:, start:stop] = frames.T
+
+    def write(self, name, value, store_dtype=False):
+        """Write a whole variable.
+
+        None has no MATLAB equivalent and is not written.
+        :param name: Name of the variable.
+        :param value: Array, number or string.
+        :param store_dtype: If True, write floating point arrays in the store
+                            dtype.
+        """
+        if value is None:
+            return
+        if isinstance(value, str):
+            dset = self.file.create_dataset(
+                name, data=np.array([[ord(c)] for c in value], 'uint16'))
+            dset.attrs['MATLAB_class'] = np.bytes_('char')
+            dset.attrs['MATLAB_int_decode'] = np.int32(2)
+            return
+        value = np.atleast_2d(np.asarray(value))
+        dtype = value.dtype
+        if store_dtype and np.issubdtype(dtype, np.floating):
+            dtype = self.dtype
+        self.create(name, value.shape, dtype)
+        self.write_frames(name, 0, value)
+
+    def read(self, name):
+        """Read a whole variable.
+
+        :param name: Name of the variable.
+        :return: String or array, frames first.
+        """
+        dset = self.file[name]
+        matlab_class = dset.attrs.get('MATLAB_class', b'')
+        if isinstance(matlab_class, bytes):
+            matlab_class = matlab_class.decode('ascii')
+        value = np.array(dset[:]).T
+        if matlab_class == 'char':
+            return ''.join(chr(c) for c in value.ravel())
+        if matlab_class == 'logical':
+            return value.astype(bool)
+        return value
+
+    def set_class(self, dset, dtype, is_logical=False):
+        """Tag a dataset with its MATLAB class."""
+        if is_logical:
+            dset.attrs['MATLAB_class'] = np.bytes_('logical')
+            dset.attrs['MATLAB_int_decode'] = np.int32(1)
+        else:
+            dset.attrs['MATLAB_class'] = np.bytes_(MATLAB_CLASSES[dtype.name])
+
+
+def load_store(path, variable_names=None):
+    """Read the variables of a store, as scipy.io.loadmat reads a .mat.
+
+    Strings are returned as one element arrays and other variables as arrays
+    of at least two dimensions.
+    :param path: Path to the store.
+    :param variable_names: Names of the variables to read. Defaults to all.
+    :return: Dictionary of variables
+    """
+    data = {}
+    with PredictionStore(path) as store:
+        if variable_names is None:
+            variable_names = store.keys()
+        for name in variable_names:
+            if name not in store:
+                continue
+            value = store.read(name)
+            if isinstance(value, str):
+                value = np.array([value])
+            data[name] = value
+    return data
+
+
+def store_shapes(path):
+    """Shapes of the variables of a store, as scipy.io.whosmat lists them.
+
+    :param path: Path to the store.
+    :return: Dictionary of shapes, frames first.
+    """
+    with PredictionStore(path) as store:
+        return {name: store.shape(name) for name in store.keys()}
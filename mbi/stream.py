@@ -0,0 +1,575 @@
+"""Impute markers live, frame by frame, and serve imputation over a socket."""
+import clize
+import collections
+from keras.models import load_model
+import numpy as np
+import socket
+import struct
+import time
+from blend import blend
+from dataset import open_session
+from incremental import incremental_model, is_exported, load_incremental
+from rollout import ContextWindow, GapRollout, run_rollouts
+from runtime import as_runtime
+from store import PredictionStore
+
+
+class StreamingImputer(object):
+    """Forward imputation of markers as frames arrive.
+
+    Each frame is imputed as soon as it is pushed, with the rule of the
+    forward pass of impute_markers: a marker is predicted from the last
+    input_length imputed frames when it is dropped, or when it jumps further
+    than error_diff_thresh from the previous frame, and the model is called
+    only on frames with such markers. Pushing a recording frame by frame
+    therefore gives the forward predictions of predict_markers. Incremental
+    models (see incremental.py) reuse the activations of the previous frame,
+    which keeps the latency per frame to one small model call.
+
+    Usage:
+    imputer = StreamingImputer(model, marker_means, marker_stds)
+    for frames, dropped in source:
+        imputed = imputer.push(frames, dropped)
+    imputer.report()
+    """
+
+    def __init__(self, model, marker_means, marker_stds, markers_to_fix=None,
+                 error_diff_thresh=.25, outlier_thresh=3,
+                 max_latencies=100000):
+        """Initialize the imputer.
+
+        :param model: Model to use for prediction, as returned by as_runtime
+                      or incremental_model.
+        :param marker_means: Mean of markers in real world coordinates
+        :param marker_stds: Std of markers in real world coordinates
+        :param markers_to_fix: Markers for which to override suspicious MoCap
+                               measurements
+        :param error_diff_thresh: Z-scored difference threshold marking
+                                  suspicious frames
+        :param outlier_thresh: Threshold at which to ignore model predictions.
+        :param max_latencies: Number of most recent frame latencies kept for
+                              report.
+        """
+        self.model = model
+        self.input_length, self.n_markers = \
+            model.input.shape.as_list()[1:]
+        self.marker_means = np.reshape(marker_means, (-1,))
+        self.marker_stds = np.reshape(marker_stds, (-1,))
+        if markers_to_fix is None:
+            markers_to_fix = np.zeros((self.n_markers)) > 1
+            # TODO(Skeleton): Automate this by including the skeleton.
+            markers_to_fix[30:36] = True
+            markers_to_fix[42:] = True
+        self.markers_to_fix = markers_to_fix
+        self.fix_errors = np.any(markers_to_fix)
+        self.error_diff_thresh = error_diff_thresh
+        self.outlier_thresh = outlier_thresh
+        self.incremental = hasattr(model, 'predict_windows')
+        self.max_latencies = max_latencies
+        self.reset()
+
+    def reset(self):
+        """Start a new recording."""
+        self.window = ContextWindow(1, self.input_length, self.n_markers)
+        # The first imputed frame is checked against zeros, as in
+        # predict_markers.
+        self.prev = np.zeros((self.n_markers,))
+        self.n_frames = 0
+        self.n_predicted = 0
+        self.latencies = collections.deque(maxlen=self.max_latencies)
+        if self.incremental:
+            self.model.reset(1)
+
+    def predict(self):
+        """Predict the next frame from the context window."""
+        x = self.window.view()
+        if self.incremental:
+            output = self.model.predict_windows(x, np.zeros((1,), 'int64'),
+                                                self.window.shift)
+            self.window.shift[:] = 0
+        else:
+            output = self.model.predict(x, batch_size=1)
+        if isinstance(output, list):
+            output = output[0]
+        self.n_predicted += 1
+        return output[0, 0, :]
+
+    def step(self, x, is_bad):
+        """Impute a single z-scored frame.
+
+        :param x: Z-scored frame (n_markers,)
+        :param is_bad: Logical vector (n_markers,) of dropped markers.
+        :return: Imputed frame, bad markers
+        """
+        pred = x
+        if self.n_frames >= self.input_length:
+            if self.fix_errors:
+                errors = np.abs(self.prev - x) > self.error_diff_thresh
+                errors[~self.markers_to_fix] = False
+                is_bad = is_bad | errors
+            if np.any(is_bad):
+                output = self.predict()
+                use_pred = is_bad & ~(np.abs(output) > self.outlier_thresh)
+                pred = np.where(use_pred, output, x)
+            self.prev = pred
+        self.window.append(pred, 0)
+        self.n_frames += 1
+        return pred, is_bad
+
+    def push(self, frames, dropped):
+        """Impute frames in the order they were recorded.
+
+        :param frames: Markers in real world coordinates (n x n_markers).
+                       Values of dropped markers are ignored once input_length
+                       frames have been pushed.
+        :param dropped: Logical matrix (n x n_markers/3) of dropped markers.
+        :return: Imputed markers in real world coordinates (n x n_markers),
+                 and a logical matrix (n x n_markers) of the imputed markers.
+        """
+        start = time.time()
+        frames = np.atleast_2d(frames)
+        dropped = np.repeat(np.atleast_2d(dropped), 3, axis=1) > .5
+        X = (frames - self.marker_means) / self.marker_stds
+        preds = np.zeros(X.shape)
+        bad_frames = np.zeros(X.shape, bool)
+        for i in range(X.shape[0]):
+            preds[i], bad_frames[i] = self.step(X[i], dropped[i])
+            self.latencies.append(time.time() - start)
+        return preds * self.marker_stds + self.marker_means, bad_frames
+
+    def finish(self):
+        """End the recording.
+
+        :return: Frames not yet returned by push, none for forward
+                 imputation.
+        """
+        return np.zeros((0, self.n_markers)), \
+            np.zeros((0, self.n_markers), bool)
+
+    def latency(self, percentiles=(50, 99)):
+        """Percentiles of the latency of the recent frames (s).
+
+        The latency of a frame runs from the push that delivered it to its
+        imputation.
+        :param percentiles: Percentiles to compute.
+        """
+        if len(self.latencies) == 0:
+            return [np.nan for p in percentiles]
+        return np.percentile(np.array(self.latencies), percentiles).tolist()
+
+    def report(self):
+        """Print the number of frames imputed and their latency."""
+        p50, p99 = self.latency()
+        print('Imputed %d frames, %d model calls. Latency per frame: '
+              '%.3f ms p50, %.3f ms p99' %
+              (self.n_frames, self.n_predicted, 1e3 * p50, 1e3 * p99),
+              flush=True)
+
+
+class OnlineImputer(StreamingImputer):
+    """Forward and reverse imputation of markers as frames arrive.
+
+    Frames are imputed forward as they are pushed, as by StreamingImputer.
+    Frames that the reverse pass would not impute are returned with the next
+    push, and the frames of a gap are held until it closes: once
+    input_length frames without dropped or suspicious markers have followed
+    it, the reverse rollout of the held frames is run from those frames, and
+    the passes are blended as in impute_markers. Frames are therefore
+    returned with a delay of at most the longest gap plus input_length + 1
+    frames, and memory does not grow with the length of the recording.
+
+    Without markers_to_fix, the result matches impute_markers. Otherwise, a
+    run of suspicious frames that the reverse pass of impute_markers carries
+    on past a tracked run is cut at it, as the reverse rollout of each gap
+    starts from the measured frames that follow it. Frames held for more
+    than max_delay frames are returned with their forward imputation alone.
+    """
+
+    def __init__(self, model, marker_means, marker_stds, markers_to_fix=None,
+                 error_diff_thresh=.25, outlier_thresh=3, k=1,
+                 max_delay=10000, batch_size=64, max_latencies=100000):
+        """Initialize the imputer.
+
+        :param model: Model to use for prediction, as returned by as_runtime
+                      or incremental_model.
+        :param marker_means: Mean of markers in real world coordinates
+        :param marker_stds: Std of markers in real world coordinates
+        :param markers_to_fix: Markers for which to override suspicious MoCap
+                               measurements
+        :param error_diff_thresh: Z-scored difference threshold marking
+                                  suspicious frames
+        :param outlier_thresh: Threshold at which to ignore model predictions.
+        :param k: Exponent constant of the blending sigmoid.
+        :param max_delay: Maximum number of frames held.
+        :param batch_size: Maximum number of gaps advanced in a single model
+                           call of the reverse rollout.
+        :param max_latencies: Number of most recent frame latencies kept for
+                              report.
+        """
+        self.k = k
+        self.max_delay = max(int(max_delay), 1)
+        self.batch_size = batch_size
+        super(OnlineImputer, self).__init__(
+            model, marker_means, marker_stds, markers_to_fix=markers_to_fix,
+            error_diff_thresh=error_diff_thresh,
+            outlier_thresh=outlier_thresh, max_latencies=max_latencies)
+
+    def reset(self):
+        """Start a new recording."""
+        super(OnlineImputer, self).reset()
+        size = self.max_delay + self.input_length + 1
+        self.X = np.zeros((size, self.n_markers))
+        self.dropped = np.zeros((size, self.n_markers // 3), bool)
+        self.predsF = np.zeros((size, self.n_markers))
+        self.bad_framesF = np.zeros((size, self.n_markers), bool)
+        self.arrivals = np.zeros((size,))
+        self.n_held = 0
+        # Number of frames at the end of the held frames that the reverse
+        # pass sees as tracked, and whether any held frame needs it.
+        self.n_tracked = 0
+        self.needs_reverse = False
+        self.n_emitted = 0
+
+    def hold(self, x, dropped, pred, is_bad, arrival):
+        """Append a frame imputed forward to the held frames."""
+        i = self.n_held
+        self.X[i], self.dropped[i] = x, dropped
+        self.predsF[i], self.bad_framesF[i] = pred, is_bad
+        self.arrivals[i] = arrival
+        self.n_held += 1
+        if i == 0:
+            return
+
+        # The reverse pass checks each frame against the next one.
+        tracked = not np.any(self.dropped[i - 1])
+        if tracked and self.fix_errors:
+            errors = np.abs(self.X[i] - self.X[i - 1]) > \
+                self.error_diff_thresh
+            tracked = not np.any(errors[self.markers_to_fix])
+        self.n_tracked = self.n_tracked + 1 if tracked else 0
+        self.needs_reverse |= not tracked
+
+    def reverse(self, n_frames, continued):
+        """Blend the held frames with their reverse imputation.
+
+        :param n_frames: Number of held frames to impute in reverse.
+        :param continued: If True, the recording continues after the frames.
+        :return: Blended frames (n_frames x n_markers)
+        """
+        rollout = GapRollout(self.X[(n_frames - 1)::-1],
+                             self.dropped[(n_frames - 1)::-1],
+                             self.input_length,
+                             markers_to_fix=self.markers_to_fix,
+                             error_diff_thresh=self.error_diff_thresh,
+                             outlier_thresh=self.outlier_thresh,
+                             batch_size=self.batch_size, continued=continued,
+                             verbose=False)
+        if rollout.n_gaps > 0:
+            run_rollouts(self.model, [rollout], self.batch_size)
+            # The rollout reset the cache of the forward pass.
+            self.window.shift[:] = self.input_length
+        predsR, bad_framesR = rollout.results()
+        predsF = self.predsF[:n_frames]
+        is_bad = self.bad_framesF[:n_frames] & bad_framesR[::-1]
+        bad_frames = np.any(np.reshape(is_bad, (n_frames, -1, 3)), axis=2)
+        return blend(predsF, predsR[::-1], bad_frames, k=self.k)
+
+    def emit(self, n_frames, preds=None):
+        """Return the first held frames and release them.
+
+        :param n_frames: Number of frames to return.
+        :param preds: Blended frames. Defaults to the forward imputation.
+        :return: Imputed frames, imputed markers
+        """
+        if preds is None:
+            preds = self.predsF[:n_frames]
+        preds = preds[:n_frames].copy()
+        bad_frames = self.bad_framesF[:n_frames].copy()
+        self.latencies.extend((time.time() - self.arrivals[:n_frames]))
+        n_kept = self.n_held - n_frames
+        for held in [self.X, self.dropped, self.predsF, self.bad_framesF,
+                     self.arrivals]:
+            held[:n_kept] = held[n_frames:self.n_held]
+        self.n_held = n_kept
+        self.n_emitted += n_frames
+        return preds, bad_frames
+
+    def release(self):
+        """Return the held frames whose imputation is final."""
+        outputs = []
+        # The last frame is held until the next one shows whether the reverse
+        # pass imputes it.
+        n_frames = self.n_held - 1
+        if n_frames > 0 and not self.needs_reverse:
+            outputs.append(self.emit(n_frames))
+        elif n_frames > 0 and self.n_tracked >= self.input_length:
+            # The gaps have closed: their reverse rollout starts from the
+            # tracked frames that followed them.
+            preds = self.reverse(n_frames, continued=True)
+            self.needs_reverse = False
+            outputs.append(self.emit(n_frames, preds))
+        if self.n_held > self.max_delay:
+            outputs.append(self.emit(self.n_held - self.max_delay))
+        return outputs
+
+    def push(self, frames, dropped):
+        """Impute frames in the order they were recorded.
+
+        :param frames: Markers in real world coordinates (n x n_markers).
+        :param dropped: Logical matrix (n x n_markers/3) of dropped markers.
+        :return: Imputed markers in real world coordinates, and a logical
+                 matrix of the imputed markers, for the frames whose
+                 imputation became final, in order. There may be fewer or
+                 more frames than were pushed.
+        """
+        arrival = time.time()
+        frames = np.atleast_2d(frames)
+        dropped = np.atleast_2d(dropped) > .5
+        X = (frames - self.marker_means) / self.marker_stds
+        outputs = []
+        for i in range(X.shape[0]):
+            pred, is_bad = self.step(X[i], np.repeat(dropped[i], 3))
+            self.hold(X[i], dropped[i], pred, is_bad, arrival)
+            outputs.extend(self.release())
+        return self.output(outputs)
+
+    def finish(self):
+        """End the recording and return the frames still held."""
+        outputs = []
+        if self.n_held > 0:
+            preds = None
+            if self.needs_reverse:
+                # As in the reverse pass of impute_markers, the rollout from
+                # the end of the recording checks its first frame against
+                # zeros.
+                preds = self.reverse(self.n_held, continued=False)
+            outputs.append(self.emit(self.n_held, preds))
+        self.needs_reverse = False
+        self.n_tracked = 0
+        return self.output(outputs)
+
+    def output(self, outputs):
+        """Concatenate released frames in real world coordinates."""
+        if not outputs:
+            return super(OnlineImputer, self).finish()
+        preds = np.concatenate([preds for preds, _ in outputs], axis=0)
+        bad_frames = np.concatenate([bad for _, bad in outputs], axis=0)
+        return preds * self.marker_stds + self.marker_means, bad_frames
+
+
+def recv_exact(connection, n_bytes):
+    """Receive exactly n_bytes, or None if the connection is closed."""
+    chunks = []
+    while n_bytes > 0:
+        chunk = connection.recv(n_bytes)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b''.join(chunks)
+
+
+def serve_connection(connection, imputer):
+    """Impute the frames sent over a connection until it closes.
+
+    The protocol is little-endian. The server first sends the number of
+    marker coordinates as a uint32. Each request is a uint32 number of
+    frames n, followed by n x n_markers float64 markers in real world
+    coordinates and n x n_markers/3 uint8 dropout flags, row by row. The
+    response is a uint32 number of frames, followed by that many frames of
+    n_markers float64 imputed markers: the frames sent for a StreamingImputer,
+    and the frames whose imputation became final for an OnlineImputer. A
+    request of zero frames ends the session, and is answered with the frames
+    still held.
+    :param connection: Connected socket.
+    :param imputer: StreamingImputer or OnlineImputer
+    """
+    n_markers = imputer.n_markers
+    n_bad = n_markers // 3
+    connection.sendall(struct.pack('<I', n_markers))
+    while True:
+        header = recv_exact(connection, 4)
+        if header is None:
+            break
+        n = struct.unpack('<I', header)[0]
+        if n == 0:
+            preds, _ = imputer.finish()
+            connection.sendall(struct.pack('<I', preds.shape[0]) +
+                               preds.astype('<f8').tobytes())
+            break
+        data = recv_exact(connection, n * (8 * n_markers + n_bad))
+        if data is None:
+            break
+        frames = np.frombuffer(data, '<f8', n * n_markers)
+        dropped = np.frombuffer(data, 'u1', n * n_bad, 8 * n * n_markers)
+        preds, _ = imputer.push(frames.reshape((n, n_markers)),
+                                dropped.reshape((n, n_bad)))
+        connection.sendall(struct.pack('<I', preds.shape[0]) +
+                           preds.astype('<f8').tobytes())
+
+
+def load_streaming_model(model_path, incremental=False):
+    """Load a model for streaming, as impute_markers does.
+
+    :param model_path: Path to model to use for prediction.
+    :param incremental: If True, evaluate the model incrementally.
+    """
+    if is_exported(model_path):
+        incremental = True
+    print('Loading model')
+    if incremental:
+        return incremental_model(load_incremental(model_path))
+    return as_runtime(load_model(model_path))
+
+
+def serve(model_path, data_path, *, host='127.0.0.1', port=5555,
+          markers_to_fix=None, error_diff_thresh=.25, incremental=False,
+          online=False, max_delay=10000):
+    """Serve streaming imputation on a local socket.
+
+    Clients connect one at a time, each streaming one recording (see
+    serve_connection for the protocol, and replay for a client). The latency
+    of each session is printed when it ends.
+    :param model_path: Path to model to use for prediction.
+    :param data_path: Path to a session from which to read the marker means
+                      and stds of the model. Can be hdf5 or mat -v7.3.
+    :param host: Address on which to listen.
+    :param port: Port on which to listen.
+    :param markers_to_fix: Markers for which to override suspicious MoCap
+                           measurements
+    :param error_diff_thresh: Z-scored difference threshold marking suspicious
+                              frames
+    :param incremental: If True, evaluate WaveNet models incrementally and
+                        step LSTM models one frame at a time (see
+                        incremental.py).
+    :param online: If True, blend the forward and reverse passes as
+                   impute_markers does, returning frames once the gap they
+                   belong to has ended (see OnlineImputer).
+    :param max_delay: Maximum number of frames held by an online server.
+    """
+    with open_session(data_path) as dataset:
+        marker_means = dataset.marker_means
+        marker_stds = dataset.marker_stds
+    model = load_streaming_model(model_path, incremental)
+    if online:
+        imputer = OnlineImputer(model, marker_means, marker_stds,
+                                markers_to_fix=markers_to_fix,
+                                error_diff_thresh=error_diff_thresh,
+                                max_delay=max_delay)
+    else:
+        imputer = StreamingImputer(model, marker_means, marker_stds,
+                                   markers_to_fix=markers_to_fix,
+                                   error_diff_thresh=error_diff_thresh)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    print('Listening on %s:%d' % (host, port), flush=True)
+    try:
+        while True:
+            connection, address = server.accept()
+            print('Streaming to %s:%d' % address, flush=True)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            imputer.reset()
+            with connection:
+                serve_connection(connection, imputer)
+            imputer.report()
+    finally:
+        server.close()
+
+
+def receive_frames(connection, preds, sent, latencies, n_received):
+    """Receive a response of the server into the frames received so far.
+
+    :param connection: Connected socket.
+    :param preds: Imputed markers of the streamed frames, filled in order.
+    :param sent: Time at which each frame was sent.
+    :param latencies: Latency of each frame, filled in order.
+    :param n_received: Number of frames received so far.
+    :return: Number of frames received
+    """
+    n = struct.unpack('<I', recv_exact(connection, 4))[0]
+    if n == 0:
+        return n_received
+    data = recv_exact(connection, n * 8 * preds.shape[1])
+    ids = slice(n_received, n_received + n)
+    latencies[ids] = time.time() - sent[ids]
+    preds[ids] = np.frombuffer(data, '<f8').reshape((n, preds.shape[1]))
+    return n_received + n
+
+
+def replay(data_path, *, host='127.0.0.1', port=5555, start_frame=0,
+           n_frames=None, frames_per_message=1, rate=None, save_path=None):
+    """Stream a recorded session to an imputation server.
+
+    Frames are read from the session, converted to real world coordinates,
+    and sent with their dropout flags. Reports the round trip latency per
+    frame, from sending a frame to receiving it imputed, which includes the
+    delay of an online server.
+    :param data_path: Path to marker and bad_frames data. Can be hdf5 or
+                      mat -v7.3.
+    :param host: Address of the server.
+    :param port: Port of the server.
+    :param start_frame: Frame at which to begin streaming.
+    :param n_frames: Number of frames to stream. Defaults to all frames.
+    :param frames_per_message: Number of frames sent together.
+    :param rate: Frames per second at which to send frames, as a live
+                 recording would. Defaults to as fast as possible.
+    :param save_path: Optional .mat file in which to save the imputed markers.
+    :return: p50 and p99 latency (s)
+    """
+    print('Loading data')
+    with open_session(data_path) as dataset:
+        if n_frames is None:
+            n_frames = dataset.n_frames - start_frame
+        frames = slice(start_frame, start_frame + n_frames)
+        markers = dataset.markers[frames] * dataset.marker_stds + \
+            dataset.marker_means
+        bad_frames = dataset.bad_frames[frames]
+
+    preds = np.zeros(markers.shape)
+    sent = np.zeros((n_frames,))
+    latencies = np.zeros((n_frames,))
+    n_received = 0
+    client = socket.create_connection((host, port))
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    with client:
+        n_markers = struct.unpack('<I', recv_exact(client, 4))[0]
+        if n_markers != markers.shape[1]:
+            raise ValueError('The server imputes %d markers, the session has '
+                             '%d.' % (n_markers, markers.shape[1]))
+        print('Streaming %d frames' % (n_frames), flush=True)
+        start = time.time()
+        for i in range(0, n_frames, frames_per_message):
+            ids = slice(i, min(i + frames_per_message, n_frames))
+            if rate is not None:
+                time.sleep(max(start + i / rate - time.time(), 0))
+            message = struct.pack('<I', ids.stop - ids.start) + \
+                markers[ids].astype('<f8').tobytes() + \
+                (bad_frames[ids] > .5).astype('u1').tobytes()
+            sent[ids] = time.time()
+            client.sendall(message)
+            n_received = receive_frames(client, preds, sent, latencies,
+                                        n_received)
+        client.sendall(struct.pack('<I', 0))
+        n_received = receive_frames(client, preds, sent, latencies,
+                                    n_received)
+        elapsed = time.time() - start
+    if n_received != n_frames:
+        raise ValueError('Received %d of %d frames.' % (n_received, n_frames))
+
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print('Streamed %d frames in %.1f s (%.1f frames/sec). Latency per '
+          'frame: %.3f ms p50, %.3f ms p99' %
+          (n_frames, elapsed, n_frames / elapsed, 1e3 * p50, 1e3 * p99),
+          flush=True)
+    if save_path is not None:
+        print('Saving to %s' % (save_path))
+        with PredictionStore(save_path, 'w') as store:
+            store.write('preds', preds, store_dtype=True)
+            store.write('latencies', latencies)
+    return p50, p99
+
+if __name__ == "__main__":
+    # Wrapper for running from commandline
+    clize.run(serve, replay)
@@ -7,23 +7,50 @@ import os
 from scipy.io import savemat
 from time import time
 from keras.callbacks import ReduceLROnPlateau, ModelCheckpoint
-from utils import load_dataset, get_ids, create_run_folders
+from keras.layers import Input
+from keras.models import Model, clone_model
+from keras.optimizers import Adam
+from build_ensemble import build_ensemble
+from utils import load_dataset, get_ids, create_run_folders, WindowSequence, \
+    MemberSequence
 import models
 
 
+def member_logs(logs, member_name):
+    """Logs of one member of a stacked model, named as for a single model.
+
+    :param logs: Logs of the stacked model (see stack_members).
+    :param member_name: Name of the member.
+    """
+    prefix = member_name + '_'
+    member_logs = {}
+    for key, value in logs.items():
+        if key.startswith(prefix):
+            member_logs[key[len(prefix):]] = value
+        elif key.startswith('val_' + prefix):
+            member_logs['val_' + key[len('val_' + prefix):]] = value
+        elif key == 'lr':
+            member_logs[key] = value
+    return member_logs
+
+
 class LossHistory(keras.callbacks.Callback):
     """Callback for history monitoring during training."""
 
-    def __init__(self, run_path):
+    def __init__(self, run_path, member_name=None):
         super().__init__()
         self.run_path = run_path
+        self.member_name = member_name
 
     def on_train_begin(self, logs={}):
         self.history = []
 
     def on_epoch_end(self, batch, logs={}):
         # Append to log list
-        self.history.append(logs.copy())
+        if self.member_name is None:
+            self.history.append(logs.copy())
+        else:
+            self.history.append(member_logs(logs, self.member_name))
 
         # Save history so far to MAT file
         savemat(os.path.join(self.run_path, "history.mat"),
@@ -31,6 +58,64 @@ class LossHistory(keras.callbacks.Callback):
                  for k in self.history[0].keys()})
 
 
+class MemberCheckpoint(keras.callbacks.Callback):
+    """Callback saving each member of a stacked model to its run folder.
+
+    Members are saved as ModelCheckpoint saves single models, on their own
+    validation loss.
+    """
+
+    def __init__(self, members, run_paths, save_every_epoch=False):
+        """Initialize the callback.
+
+        :param members: Member models of the stacked model.
+        :param run_paths: Run folder of each member.
+        :param save_every_epoch: Save weights at every epoch. If False, saves
+                                 only the best weights.
+        """
+        super().__init__()
+        self.members = members
+        self.run_paths = run_paths
+        self.save_every_epoch = save_every_epoch
+        self.best = [np.inf] * len(members)
+
+    def on_epoch_end(self, epoch, logs={}):
+        for i, (member, run_path) in enumerate(zip(self.members,
+                                                   self.run_paths)):
+            val_loss = member_logs(logs, member.name)['val_loss']
+            if self.save_every_epoch:
+                member.save(os.path.join(run_path, "weights",
+                                         "weights.%03d-%.9f.h5" %
+                                         (epoch + 1, val_loss)))
+            elif val_loss < self.best[i]:
+                print('Epoch %05d: %s improved from %0.5f to %0.5f, saving '
+                      'to %s' % (epoch + 1, member.name, self.best[i],
+                                 val_loss, run_path))
+                self.best[i] = val_loss
+                member.save(os.path.join(run_path, "best_model.h5"))
+
+
+def stack_members(members, lossfunc, lr):
+    """Stack ensemble members into a single model to train them together.
+
+    The stacked model has an input and an output per member, and its loss is
+    the sum of the losses of the members. As members share no weights, and
+    Adam scales the gradient of each weight separately, each member is
+    trained as it would be alone on the same batches, with the learning rate
+    shared by all members.
+    :param members: List of keras models with identical input shapes.
+    :param lossfunc: Loss function
+    :param lr: Learning rate
+    """
+    for i, member in enumerate(members):
+        member.name = 'model_%d' % (i)
+    inputs = [Input(batch_shape=member.input_shape) for member in members]
+    outputs = [member(x) for member, x in zip(members, inputs)]
+    model = Model(inputs, outputs, name='members')
+    model.compile(optimizer=Adam(lr=lr), loss=lossfunc, metrics=['mse'])
+    return model
+
+
 def create_model(net_name, **kwargs):
     """Initialize a network for training."""
     compile_model = dict(
@@ -53,7 +138,9 @@ def train(data_path, *, base_output_path="models", run_name=None,
           lossfunc='mean_squared_error', lr=1e-4, batches_per_epoch=0,
           val_batches_per_epoch=0, reduce_lr_factor=0.5, reduce_lr_patience=3,
           reduce_lr_min_delta=1e-5, reduce_lr_cooldown=0,
-          reduce_lr_min_lr=1e-10, save_every_epoch=False):
+          reduce_lr_min_lr=1e-10, save_every_epoch=False, workers=1,
+          use_multiprocessing=False, n_members=1, bootstrap=True, seed=None,
+          ensemble_name="model_ensemble", return_member_data=True):
     """Trains the network and saves the results to an output directory.
 
     :param data_path: Path to an HDF5 file with marker data.
@@ -95,6 +182,20 @@ def train(data_path, *, base_output_path="models", run_name=None,
                              ReduceLROnPlateau)
     :param save_every_epoch: Save weights at every epoch. If False, saves only
                              initial, final and best weights.
+    :param workers: Number of workers assembling training batches.
+    :param use_multiprocessing: If True, workers are processes rather than
+                                threads.
+    :param n_members: Number of ensemble members to train together. Members
+                      are saved to their own run folders, named as separate
+                      runs of run_name would be, and built into an ensemble
+                      with build_ensemble.
+    :param bootstrap: If True, train each member on its own resample of the
+                      training windows.
+    :param seed: Seed of the resampling and shuffling of member windows.
+    :param ensemble_name: Run name of the ensemble of the members.
+    :param return_member_data: If True, the ensemble will have two outputs:
+                               the ensemble prediction and all member
+                               predictions.
     """
     # Set the n_dilations param
     if n_dilations is None:
@@ -118,42 +219,68 @@ def train(data_path, *, base_output_path="models", run_name=None,
     [input_ids, target_ids] = get_ids(bad_frames, input_length,
                                       output_length, True, True)
 
-    # Get the training, testing, and validation trajectories by indexing into
-    # the marker arrays
+    # Get the training and validation trajectories. Windows are assembled
+    # batch by batch from a single copy of the markers.
     n_train = np.int32(np.round(input_ids.shape[0]*train_fraction))
     n_val = np.int32(np.round(input_ids.shape[0]*val_fraction))
-    X = markers[input_ids[:n_train, :], :]
-    Y = markers[target_ids[:n_train, :], :]
-    val_X = markers[input_ids[n_train:(n_train+n_val), :], :]
-    val_Y = markers[target_ids[n_train:(n_train+n_val), :], :]
-    test_X = markers[input_ids[(n_train+n_val):, :], :]
-    test_Y = markers[target_ids[(n_train+n_val):, :], :]
+    if n_members > 1:
+        train_data = MemberSequence(markers, input_ids[:n_train, :],
+                                    target_ids[:n_train, :], batch_size,
+                                    n_members, bootstrap=bootstrap,
+                                    seed=seed)
+        val_data = MemberSequence(markers,
+                                  input_ids[n_train:(n_train+n_val), :],
+                                  target_ids[n_train:(n_train+n_val), :],
+                                  batch_size, n_members, bootstrap=False,
+                                  shuffle=False)
+    else:
+        train_data = WindowSequence(markers, input_ids[:n_train, :],
+                                    target_ids[:n_train, :], batch_size)
+        val_data = WindowSequence(markers,
+                                  input_ids[n_train:(n_train+n_val), :],
+                                  target_ids[n_train:(n_train+n_val), :],
+                                  batch_size, shuffle=False)
 
     # Create network
     print('Compiling network')
-    if isinstance(net_name, keras.models.Model):
-        model = net_name
-        net_name = model.name
-    elif net_name == 'wave_net':
-        model = create_model(net_name, lossfunc=lossfunc, lr=lr,
-                             input_length=input_length,
-                             output_length=output_length, n_markers=n_markers,
-                             n_filters=n_filters, filter_width=filter_width,
-                             layers_per_level=layers_per_level,
-                             n_dilations=n_dilations, print_summary=False)
-    elif net_name == 'lstm_model':
-        model = create_model(net_name, lossfunc=lossfunc, lr=lr,
-                             input_length=input_length, n_markers=n_markers,
-                             latent_dim=latent_dim, print_summary=False)
-    elif net_name == 'wave_net_res_skip':
-        model = create_model(net_name, lossfunc=lossfunc, lr=lr,
-                             input_length=input_length, n_markers=n_markers,
-                             n_filters=n_filters, filter_width=filter_width,
-                             layers_per_level=layers_per_level,
-                             n_dilations=n_dilations, print_summary=True)
-    if model is None:
+    members = [None]*n_members
+    for i in range(n_members):
+        if isinstance(net_name, keras.models.Model):
+            members[i] = net_name if i == 0 else clone_model(net_name)
+        elif net_name == 'wave_net':
+            members[i] = create_model(net_name, lossfunc=lossfunc, lr=lr,
+                                      input_length=input_length,
+                                      output_length=output_length,
+                                      n_markers=n_markers,
+                                      n_filters=n_filters,
+                                      filter_width=filter_width,
+                                      layers_per_level=layers_per_level,
+                                      n_dilations=n_dilations,
+                                      print_summary=False)
+        elif net_name == 'lstm_model':
+            members[i] = create_model(net_name, lossfunc=lossfunc, lr=lr,
+                                      input_length=input_length,
+                                      n_markers=n_markers,
+                                      latent_dim=latent_dim,
+                                      print_summary=False)
+        elif net_name == 'wave_net_res_skip':
+            members[i] = create_model(net_name, lossfunc=lossfunc, lr=lr,
+                                      input_length=input_length,
+                                      n_markers=n_markers,
+                                      n_filters=n_filters,
+                                      filter_width=filter_width,
+                                      layers_per_level=layers_per_level,
+                                      n_dilations=n_dilations,
+                                      print_summary=i == 0)
+    if members[0] is None:
         print("Could not find model:", net_name)
         return
+    if isinstance(net_name, keras.models.Model):
+        net_name = net_name.name
+    if n_members > 1:
+        model = stack_members(members, lossfunc, lr)
+    else:
+        model = members[0]
 
     # Build run name if needed
     if data_name is None:
@@ -164,39 +291,62 @@ def train(data_path, *, base_output_path="models", run_name=None,
     print("data_name:", data_name)
     print("run_name:", run_name)
 
-    # Initialize run directories
+    # Initialize run directories. Members are named as separate runs would be.
     print('Building run folders')
-    run_path = create_run_folders(run_name, base_path=base_output_path,
-                                  clean=clean)
+    run_paths = [None]*n_members
+    for i in range(n_members):
+        member_name = run_name if i == 0 else "%s_%02d" % (run_name, i)
+        run_paths[i] = create_run_folders(member_name,
+                                          base_path=base_output_path,
+                                          clean=clean)
+    run_path = run_paths[0]
 
     # Save the training information in a mat file.
     print('Saving training info')
-    savemat(os.path.join(run_path, "training_info.mat"),
-            {"data_path": data_path, "base_output_path": base_output_path,
-             "run_name": run_name, "data_name": data_name,
-             "net_name": net_name, "clean": clean, "stride": stride,
-             "input_length": input_length, "output_length": output_length,
-             "n_filters": n_filters, "n_markers": n_markers, "epochs": epochs,
-             "batch_size": batch_size, "train_fraction": train_fraction,
-             "val_fraction": val_fraction,
-             "only_moving_frames": only_moving_frames,
-             "filter_width": filter_width,
-             "layers_per_level": layers_per_level, "n_dilations": n_dilations,
-             "batches_per_epoch": batches_per_epoch,
-             "val_batches_per_epoch": val_batches_per_epoch,
-             "reduce_lr_factor": reduce_lr_factor,
-             "reduce_lr_patience": reduce_lr_patience,
-             "reduce_lr_min_delta": reduce_lr_min_delta,
-             "reduce_lr_cooldown": reduce_lr_cooldown,
-             "reduce_lr_min_lr": reduce_lr_min_lr,
-             "save_every_epoch": save_every_epoch})
+    training_info = {"data_path": data_path,
+                     "base_output_path": base_output_path,
+                     "run_name": run_name, "data_name": data_name,
+                     "net_name": net_name, "clean": clean, "stride": stride,
+                     "input_length": input_length,
+                     "output_length": output_length,
+                     "n_filters": n_filters, "n_markers": n_markers,
+                     "epochs": epochs, "batch_size": batch_size,
+                     "train_fraction": train_fraction,
+                     "val_fraction": val_fraction,
+                     "only_moving_frames": only_moving_frames,
+                     "filter_width": filter_width,
+                     "layers_per_level": layers_per_level,
+                     "n_dilations": n_dilations,
+                     "batches_per_epoch": batches_per_epoch,
+                     "val_batches_per_epoch": val_batches_per_epoch,
+                     "reduce_lr_factor": reduce_lr_factor,
+                     "reduce_lr_patience": reduce_lr_patience,
+                     "reduce_lr_min_delta": reduce_lr_min_delta,
+                     "reduce_lr_cooldown": reduce_lr_cooldown,
+                     "reduce_lr_min_lr": reduce_lr_min_lr,
+                     "save_every_epoch": save_every_epoch}
+    if n_members > 1:
+        training_info.update({"n_members": n_members,
+                              "bootstrap": bootstrap})
+    for i in range(n_members):
+        if n_members > 1:
+            training_info["member"] = i
+        savemat(os.path.join(run_paths[i], "training_info.mat"),
+                training_info)
 
     # Save initial network
     print('Saving initial network')
-    model.save(os.path.join(run_path, "initial_model.h5"))
+    for member, member_path in zip(members, run_paths):
+        member.save(os.path.join(member_path, "initial_model.h5"))
 
     # Initialize training callbacks
-    history_callback = LossHistory(run_path=run_path)
+    if n_members > 1:
+        history_callbacks = [LossHistory(run_path=member_path,
+                                         member_name=member.name)
+                             for member, member_path in zip(members,
+                                                            run_paths)]
+    else:
+        history_callbacks = [LossHistory(run_path=run_path)]
     reduce_lr_callback = ReduceLROnPlateau(monitor="val_loss",
                                            factor=reduce_lr_factor,
                                            patience=reduce_lr_patience,
@@ -204,7 +354,10 @@ def train(data_path, *, base_output_path="models", run_name=None,
                                            epsilon=reduce_lr_min_delta,
                                            cooldown=reduce_lr_cooldown,
                                            min_lr=reduce_lr_min_lr)
-    if save_every_epoch:
+    if n_members > 1:
+        checkpointer = MemberCheckpoint(members, run_paths,
+                                        save_every_epoch=save_every_epoch)
+    elif save_every_epoch:
         save_string = "weights/weights.{epoch:03d}-{val_loss:.9f}.h5"
         checkpointer = ModelCheckpoint(filepath=os.path.join(run_path,
                                        save_string), verbose=1,
@@ -217,10 +370,13 @@ def train(data_path, *, base_output_path="models", run_name=None,
     # Train!
     print('Training')
     t0_train = time()
-    training = model.fit(X, Y, batch_size=batch_size, epochs=epochs,
-                         verbose=1, validation_data=(val_X, val_Y),
-                         callbacks=[history_callback, checkpointer,
-                                    reduce_lr_callback])
+    training = model.fit_generator(train_data, epochs=epochs, verbose=1,
+                                   validation_data=val_data,
+                                   callbacks=history_callbacks +
+                                   [checkpointer, reduce_lr_callback],
+                                   workers=workers,
+                                   use_multiprocessing=use_multiprocessing,
+                                   shuffle=False)
 
     # Compute total elapsed time for training
     elapsed_train = time() - t0_train
@@ -228,8 +384,22 @@ def train(data_path, *, base_output_path="models", run_name=None,
 
     # Save final model
     print('Saving final model')
-    model.history = history_callback.history
-    model.save(os.path.join(run_path, "final_model.h5"))
+    for member, member_path, history_callback in zip(members, run_paths,
+                                                      history_callbacks):
+        member.history = history_callback.history
+        member.save(os.path.join(member_path, "final_model.h5"))
+
+    # Build the ensemble of the members, from their best weights.
+    if n_members > 1:
+        model_name = "final_model.h5" if save_every_epoch else \
+            "best_model.h5"
+        model_paths = [os.path.join(os.path.relpath(member_path,
+                                                    base_output_path),
+                                    model_name)
+                       for member_path in run_paths]
+        build_ensemble(base_output_path, *model_paths,
+                       return_member_data=return_member_data,
+                       run_name=ensemble_name, clean=clean)
 
 
 if __name__ == "__main__":
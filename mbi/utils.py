@@ -1,18 +1,24 @@
 """Utitlity functions for mbi."""
-import h5py
 from keras import backend as K
 from keras.layers import Conv1D
+from keras.utils import Sequence
 from keras.utils.conv_utils import conv_output_length
 import numpy as np
 import os
+import resource
 import shutil
+import sys
 import tensorflow as tf
+import time
+from dataset import MarkerDataset
 
 
-def load_dataset(data_path):
+def load_dataset(data_path, frames=slice(None)):
     """Load marker, marker_means, marker_stds, and bad_frames from .h5 dataset.
 
     :param data_path: Path to .h5 file
+    :param frames: Slice of frames to read, e.g. slice(start, end, stride).
+                   Only these frames are read from disk.
     Outputs:
     markers - Z-scored marker trajectories over time.
     marker_means - Mean of markers in real world coordinates
@@ -21,12 +27,12 @@ def load_dataset(data_path):
                  marker errors. Same size as markers.
                  0 when marker j is a good recording at frame i, 1 otherwise.
     """
-    f = h5py.File(data_path, 'r')
-    markers = np.array(f['markers'][:]).T
-    marker_means = np.array(f['marker_means'][:]).T
-    marker_stds = np.array(f['marker_stds'][:]).T
-    bad_frames = np.array(f['bad_frames'][:]).T
-    move_frames = np.array(f['move_frames'][:]).T
+    with MarkerDataset(data_path) as dataset:
+        markers = dataset.markers[frames]
+        marker_means = dataset.marker_means
+        marker_stds = dataset.marker_stds
+        bad_frames = dataset.bad_frames[frames]
+        move_frames = dataset['move_frames'][frames]
 
     return markers, marker_means, marker_stds, bad_frames, move_frames
 
@@ -53,39 +59,151 @@ def get_ids(bad_frames, input_length, output_length, only_good_inputs=False,
     output_ids - N x output_length integer matrix of output ids.
     """
     # Find all of the good frames
-    n_bad_markers = np.sum(bad_frames, 1)
-    good_frames = np.where(n_bad_markers == 0)[0]
+    is_bad = np.sum(bad_frames, 1) != 0
+    good_frames = np.where(~is_bad)[0]
     good_frames = \
         good_frames[(good_frames > input_length) &
                     (good_frames < (bad_frames.shape[0]-output_length))]
 
-    # Save the preceding input_length ids before that frame
-    input_ids = np.zeros([good_frames.shape[0], input_length], 'int32')
-    output_ids = np.zeros([good_frames.shape[0], output_length], 'int32')
-
-    for i in range(input_ids.shape[0]):
-        input_ids[i, :] = range(good_frames[i]-input_length, good_frames[i])
-        output_ids[i, :] = range(good_frames[i], good_frames[i]+output_length)
+    # Count the bad frames preceding every frame, so the number of bad frames
+    # in any window is a difference of two counts.
+    n_bad_before = np.zeros(is_bad.shape[0] + 1, 'int64')
+    np.cumsum(is_bad, out=n_bad_before[1:])
 
-    # Remove all samples that have bad frames in the input
+    # Remove all samples that have bad frames in the input or output
+    is_good_sample = np.ones(good_frames.shape[0], bool)
     if only_good_inputs:
-        n_bad_markers_all = n_bad_markers[input_ids]
-        is_bad_input = n_bad_markers_all != 0
-        is_bad_sample = np.any(is_bad_input, axis=1)
-        input_ids = input_ids[~is_bad_sample, :]
-        output_ids = output_ids[~is_bad_sample, :]
-
-    # Remove all samples that have bad frames in the output
+        is_good_sample &= n_bad_before[good_frames] == \
+            n_bad_before[good_frames - input_length]
     if only_good_outputs:
-        n_bad_markers_all = n_bad_markers[output_ids]
-        is_bad_output = n_bad_markers_all != 0
-        is_bad_sample = np.any(is_bad_output, axis=1)
-        input_ids = input_ids[~is_bad_sample, :]
-        output_ids = output_ids[~is_bad_sample, :]
+        is_good_sample &= n_bad_before[good_frames + output_length] == \
+            n_bad_before[good_frames]
+    good_frames = good_frames[is_good_sample]
+
+    # Save the preceding input_length ids before that frame
+    input_ids = (good_frames[:, None] +
+                 np.arange(-input_length, 0)).astype('int32')
+    output_ids = (good_frames[:, None] +
+                  np.arange(output_length)).astype('int32')
 
     return input_ids, output_ids
 
 
+class WindowSequence(Sequence):
+    """Batches of training windows assembled on the fly.
+
+    Holds a single copy of the markers and the first frame of each window.
+    Windows are read from a strided view of the markers, so only the
+    windows of the current batch are copied into memory.
+    """
+
+    def __init__(self, markers, input_ids, output_ids, batch_size,
+                 shuffle=True, seed=None):
+        """Initialize the sequence.
+
+        :param markers: Marker data (n_frames x n_markers)
+        :param input_ids: N x input_length integer matrix of input ids of
+                          consecutive frames (see get_ids).
+        :param output_ids: N x output_length integer matrix of output ids.
+        :param batch_size: Number of samples per batch
+        :param shuffle: If True, shuffle the samples at the end of each epoch.
+        :param seed: Seed of the random number generator used for shuffling.
+        """
+        self.markers = markers
+        self.input_starts = input_ids[:, 0]
+        self.output_starts = output_ids[:, 0]
+        self.input_length = input_ids.shape[1]
+        self.output_length = output_ids.shape[1]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.order = np.arange(self.input_starts.shape[0])
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return int(np.ceil(self.order.shape[0] / self.batch_size))
+
+    def windows(self, window_length):
+        """View of every window of window_length frames, without copying."""
+        n_frames, n_markers = self.markers.shape
+        frame_stride, marker_stride = self.markers.strides
+        return np.lib.stride_tricks.as_strided(
+            self.markers,
+            shape=(n_frames - window_length + 1, window_length, n_markers),
+            strides=(frame_stride, frame_stride, marker_stride),
+            writeable=False)
+
+    def __getitem__(self, index):
+        batch = self.order[(index * self.batch_size):
+                           ((index + 1) * self.batch_size)]
+        X = self.windows(self.input_length)[self.input_starts[batch]]
+        Y = self.windows(self.output_length)[self.output_starts[batch]]
+        return X, Y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+
+class MemberSequence(WindowSequence):
+    """Batches of training windows for several ensemble members at once.
+
+    Every member reads its windows from the same copy of the markers. With
+    bootstrap, each member trains on its own resample of the windows, drawn
+    with replacement, as if each had been trained on its own dataset.
+    Batches are lists with the windows of each member, the inputs and
+    targets of a stacked model (see training.stack_members).
+    """
+
+    def __init__(self, markers, input_ids, output_ids, batch_size, n_members,
+                 bootstrap=True, shuffle=True, seed=None):
+        """Initialize the sequence.
+
+        :param markers: Marker data (n_frames x n_markers)
+        :param input_ids: N x input_length integer matrix of input ids of
+                          consecutive frames (see get_ids).
+        :param output_ids: N x output_length integer matrix of output ids.
+        :param batch_size: Number of samples per batch
+        :param n_members: Number of ensemble members.
+        :param bootstrap: If True, resample the windows of each member with
+                          replacement. Otherwise every member trains on all
+                          windows.
+        :param shuffle: If True, shuffle the samples of each member at the end
+                        of each epoch.
+        :param seed: Seed of the random number generator used for resampling
+                     and shuffling.
+        """
+        super().__init__(markers, input_ids, output_ids, batch_size,
+                         shuffle=False, seed=seed)
+        self.n_members = n_members
+        self.shuffle = shuffle
+        n_samples = self.order.shape[0]
+        if bootstrap:
+            self.orders = self.rng.randint(0, n_samples,
+                                           (n_members, n_samples))
+        else:
+            self.orders = np.tile(self.order, (n_members, 1))
+        # Without resampling or shuffling, all members share their windows.
+        self.shared = not bootstrap and not shuffle
+        self.on_epoch_end()
+
+    def __getitem__(self, index):
+        if self.shared:
+            X, Y = super().__getitem__(index)
+            return [X] * self.n_members, [Y] * self.n_members
+        batch = self.orders[:, (index * self.batch_size):
+                            ((index + 1) * self.batch_size)]
+        X = self.windows(self.input_length)[self.input_starts[batch]]
+        Y = self.windows(self.output_length)[self.output_starts[batch]]
+        return list(X), list(Y)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            for order in self.orders:
+                self.rng.shuffle(order)
+
+
 def create_run_folders(run_name, base_path="models", clean=False):
     """Create subfolders necessary for outputs of training.
 
@@ -118,6 +236,41 @@ def create_run_folders(run_name, base_path="models", clean=False):
     return run_path
 
 
+def peak_rss():
+    """Peak resident memory of the current process (bytes)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class StageTimer(object):
+    """Record the duration and peak resident memory of pipeline stages.
+
+    Usage:
+    timer = StageTimer()
+    markers = load()
+    timer.stop('load')
+    preds = predict(markers)
+    timer.stop('forward')
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.start = time.time()
+
+    def stop(self, name):
+        """End the current stage and start the next one.
+
+        :param name: Name of the stage that ended.
+        """
+        end = time.time()
+        self.stages.append({'name': name, 'seconds': end - self.start,
+                            'peak_rss': peak_rss()})
+        self.start = end
+
+
 def asymmetric_temporal_padding(x, left_pad=1, right_pad=1):
     """Pad the middle dimension of a 3D tensor.
 
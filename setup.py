@@ -11,7 +11,6 @@ setup(
         "h5py>=2.7.1",
         "matplotlib",
         "clize>=4.0.3",
-        "keras>=2.2.2",
-        "scikit-image"
+        "keras>=2.2.2"
     ]
 )
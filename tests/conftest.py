@@ -0,0 +1,147 @@
+"""Deterministic stand-ins for models and sessions shared by the tests."""
+import os
+import sys
+import numpy as np
+
+# Modules of mbi import each other by name, as when run from mbi/.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'mbi'))
+
+
+class Shape(object):
+    """Static shape, as keras tensors report them."""
+
+    def __init__(self, dims):
+        self.dims = dims
+
+    def as_list(self):
+        return list(self.dims)
+
+
+class Tensor(object):
+    """Placeholder for the input tensor of a keras model."""
+
+    def __init__(self, dims):
+        self.shape = Shape(dims)
+
+
+class LinearModel(object):
+    """Deterministic model predicting each window on its own.
+
+    Predictions do not depend on how windows are batched, as with keras
+    models, so batched and sequential rollouts can be compared exactly.
+    Predictions reach beyond the default outlier_thresh.
+    """
+
+    def __init__(self, input_length, n_markers, n_members=0, seed=0):
+        """Initialize the model.
+
+        :param input_length: Model input length (frames)
+        :param n_markers: Number of marker coordinates per frame
+        :param n_members: Number of ensemble members. If 0, the model has a
+                          single output. Otherwise it outputs the median
+                          and the predictions of every member, as ensembles
+                          built with build_ensemble do.
+        :param seed: Seed of the weights.
+        """
+        rng = np.random.RandomState(seed)
+        n_weights = input_length * n_markers
+        self.weights = rng.randn(max(n_members, 1), n_weights, n_markers) * \
+            2 / np.sqrt(n_weights)
+        self.n_members = n_members
+        self.input = Tensor([None, input_length, n_markers])
+        if n_members:
+            self.output_shape = [(None, 1, n_markers),
+                                 (None, n_members, n_markers)]
+        else:
+            self.output_shape = (None, 1, n_markers)
+        self.n_calls = 0
+
+    def predict(self, x, batch_size=None):
+        self.n_calls += 1
+        x = np.reshape(x, (x.shape[0], -1))
+        members = 4 * np.tanh(np.einsum('ij,kjl->ikl', x, self.weights))
+        if not self.n_members:
+            return members
+        return [np.median(members, axis=1, keepdims=True), members]
+
+    def report(self):
+        pass
+
+
+def synthetic_markers(n_frames, n_markers, gap_rate, mean_gap_length,
+                      seed=0):
+    """Smooth z-scored marker trajectories with dropped markers.
+
+    :param n_frames: Number of frames to generate.
+    :param n_markers: Number of marker coordinates per frame.
+    :param gap_rate: Probability that a gap begins on any frame of a marker.
+    :param mean_gap_length: Mean length of the gaps (frames).
+    :param seed: Seed of the random number generator.
+    :return: markers, bad_frames (n_frames x n_markers/3)
+    """
+    rng = np.random.RandomState(seed)
+    markers = np.cumsum(rng.randn(n_frames, n_markers) * .1, axis=0)
+    markers = (markers - np.mean(markers, axis=0)) / np.std(markers, axis=0)
+    bad_frames = np.zeros((n_frames, n_markers // 3), bool)
+    for i in range(bad_frames.shape[1]):
+        gap_starts = np.where(rng.rand(n_frames) < gap_rate)[0]
+        gap_lengths = rng.geometric(1 / mean_gap_length, gap_starts.shape)
+        for start, length in zip(gap_starts, gap_lengths):
+            bad_frames[start:(start + length), i] = True
+    return markers, bad_frames
+
+
+def sequential_predict_markers(model, X, bad_frames, markers_to_fix=None,
+                               error_diff_thresh=.25, outlier_thresh=3,
+                               return_member_data=False):
+    """Impute markers one frame at a time, as predict_markers originally did.
+
+    :param model: Model to use for prediction.
+    :param X: Marker data (n_frames x n_markers)
+    :param bad_frames: Logical matrix (n_frames x n_markers/3)
+    :param markers_to_fix: Boolean vector of length n_markers.
+    :param error_diff_thresh: Z-scored distance at which predictions override
+                              marker measurements.
+    :param outlier_thresh: Threshold at which to ignore model predictions.
+    :param return_member_data: If True, also return the member predictions.
+    :return: preds, bad_frames(, member_preds)
+    """
+    input_length = model.input.shape.as_list()[1]
+    bad_frames = np.repeat(bad_frames, 3, axis=1) > .5
+    fix_errors = np.any(markers_to_fix)
+
+    X = X[None, ...]
+    X_start = X[:, :input_length, :]
+    preds = np.zeros((X.shape))
+    preds[:, :input_length, :] = X_start
+    pred = np.zeros((1, 1, X.shape[2]))
+    if return_member_data:
+        n_members = model.output_shape[1][1]
+        member_preds = np.zeros((n_members, X.shape[1], X.shape[2]))
+        member_pred = np.zeros((1, n_members, X.shape[2]))
+    for i in range(X.shape[1] - input_length):
+        next_frame_id = input_length + i
+        if fix_errors:
+            diff = pred[:, 0, :] - X[:, next_frame_id, :]
+            errors = np.squeeze(np.abs(diff) > error_diff_thresh)
+            errors[~markers_to_fix] = False
+            bad_frames[next_frame_id, errors] = True
+        if np.any(bad_frames[next_frame_id, :]):
+            output = model.predict(X_start)
+            if isinstance(output, list):
+                pred, member_pred = output
+            else:
+                pred = output
+        outliers = np.squeeze(np.abs(pred) > outlier_thresh)
+        pred[:, 0, outliers] = X[:, next_frame_id, outliers]
+        pred[:, 0, ~bad_frames[next_frame_id, :]] = \
+            X[:, next_frame_id, ~bad_frames[next_frame_id, :]]
+        preds[:, next_frame_id, :] = np.squeeze(pred)
+        if return_member_data:
+            member_pred[:, :, ~bad_frames[next_frame_id, :]] = 0
+            member_preds[:, next_frame_id, :] = member_pred[0]
+        X_start = np.concatenate((X_start[:, 1:, :], pred), axis=1)
+    if return_member_data:
+        return np.squeeze(preds), bad_frames, member_preds
+    return np.squeeze(preds), bad_frames
@@ -0,0 +1,61 @@
+"""Compare blend to the per-gap weighted average of impute_markers."""
+import numpy as np
+from conftest import synthetic_markers
+from blend import blend, sigmoid
+
+
+def reference_blend(predsF, predsR, bad_frames, k=1):
+    """Blend each gap of each marker separately, one coordinate at a time."""
+    preds = predsF.copy()
+    for i in range(predsF.shape[1]):
+        is_bad = bad_frames[:, i // 3]
+        start = 0
+        while start < is_bad.shape[0]:
+            if not is_bad[start]:
+                start += 1
+                continue
+            stop = start
+            while stop < is_bad.shape[0] and is_bad[stop]:
+                stop += 1
+            length = stop - start
+            weightR = sigmoid(np.arange(length), np.round(length / 2), k)
+            preds[start:stop, i] = predsF[start:stop, i] * (1 - weightR) + \
+                predsR[start:stop, i] * weightR
+            start = stop
+    return preds
+
+
+def session(seed=0):
+    rng = np.random.RandomState(seed)
+    _, bad_frames = synthetic_markers(2000, 12, .01, 20, seed=seed)
+    # Gaps at the first and last frames.
+    bad_frames[:5, 0] = True
+    bad_frames[-5:, 1] = True
+    predsF = rng.randn(2000, 12)
+    predsR = rng.randn(2000, 12)
+    return predsF, predsR, bad_frames
+
+
+def test_blend_matches_per_gap_average():
+    predsF, predsR, bad_frames = session()
+    for k in [1, .5]:
+        np.testing.assert_allclose(
+            blend(predsF, predsR, bad_frames, k=k),
+            reference_blend(predsF, predsR, bad_frames, k=k),
+            rtol=0, atol=1e-12)
+
+
+def test_blend_member_stds_as_variances():
+    predsF, predsR, bad_frames = session(1)
+    rng = np.random.RandomState(2)
+    stdsF = rng.rand(*predsF.shape)
+    stdsR = rng.rand(*predsR.shape)
+    preds, member_stds = blend(predsF, predsR, bad_frames, k=1,
+                               member_stdsF=stdsF, member_stdsR=stdsR)
+    np.testing.assert_allclose(
+        preds, reference_blend(predsF, predsR, bad_frames), rtol=0,
+        atol=1e-12)
+    np.testing.assert_allclose(
+        member_stds**2,
+        reference_blend(stdsF**2, stdsR**2, bad_frames) *
+        np.repeat(bad_frames, 3, axis=1), rtol=0, atol=1e-12)
@@ -0,0 +1,92 @@
+"""Merge folds in memory and streaming, and compare to a single blend."""
+import h5py
+import numpy as np
+import pytest
+from conftest import synthetic_markers
+from blend import blend
+from merge import merge
+from store import PredictionStore
+
+N_FRAMES = 1200
+N_FOLDS = 4
+HALO = 7
+
+
+@pytest.fixture
+def folds(tmp_path):
+    """Write folds as predict_single_pass does, with context halos."""
+    rng = np.random.RandomState(0)
+    markers, bad = synthetic_markers(N_FRAMES, 12, .01, 20, seed=0)
+    marker_means = rng.randn(1, 12)
+    marker_stds = rng.rand(1, 12) + .5
+    passes = {}
+    for pass_direction in ['forward', 'reverse']:
+        passes[pass_direction] = dict(
+            preds=rng.randn(N_FRAMES, 12),
+            bad_frames=np.repeat(bad, 3, axis=1) & (rng.rand(N_FRAMES, 12) >
+                                                    .2),
+            member_stds=rng.rand(N_FRAMES, 12))
+
+    paths = []
+    bounds = np.linspace(0, N_FRAMES, N_FOLDS + 1).astype('int64')
+    for pass_direction, data in passes.items():
+        for fold_id in range(N_FOLDS):
+            halo_start = min(HALO, bounds[fold_id])
+            halo_end = min(HALO, N_FRAMES - bounds[fold_id + 1])
+            frames = slice(bounds[fold_id] - halo_start,
+                           bounds[fold_id + 1] + halo_end)
+            path = str(tmp_path / ('%s_fold_id_%d.mat' %
+                                   (pass_direction, fold_id)))
+            with PredictionStore(path, 'w', dtype='float64') as store:
+                store.write('preds', data['preds'][frames], store_dtype=True)
+                store.write('markers', markers[frames], store_dtype=True)
+                store.write('bad_frames', data['bad_frames'][frames])
+                store.write('member_stds', data['member_stds'][frames],
+                            store_dtype=True)
+                store.write('n_folds', N_FOLDS)
+                store.write('fold_id', fold_id)
+                store.write('pass_direction', pass_direction)
+                store.write('halo_start', halo_start)
+                store.write('halo_end', halo_end)
+                store.write('marker_means', marker_means)
+                store.write('marker_stds', marker_stds)
+            paths.append(path)
+
+    # Expected merge of the whole recording.
+    forward, reverse = passes['forward'], passes['reverse']
+    is_bad = forward['bad_frames'] & reverse['bad_frames']
+    bad_frames = np.any(is_bad.reshape((N_FRAMES, -1, 3)), axis=2)
+    preds, member_stds = blend(forward['preds'] * marker_stds + marker_means,
+                               reverse['preds'] * marker_stds + marker_means,
+                               bad_frames, member_stdsF=forward['member_stds'],
+                               member_stdsR=reverse['member_stds'])
+    expected = dict(preds=preds, member_stds=member_stds,
+                    badFrames=bad_frames,
+                    markers=markers * marker_stds + marker_means)
+    return paths, expected
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_merge_matches_single_blend(folds, tmp_path, stream):
+    paths, expected = folds
+    save_path = str(tmp_path / 'merged.h5')
+    # Small blocks split the streaming merge into many blocks.
+    merge(save_path, *paths[::-1], stream=stream, block_size=50)
+    with h5py.File(save_path, 'r') as f:
+        for name, value in expected.items():
+            np.testing.assert_allclose(f[name][:], value, rtol=0,
+                                       atol=1e-12)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_merge_single_model_folds(folds, tmp_path, stream):
+    paths, expected = folds
+    for path in paths:
+        with h5py.File(path, 'r+') as f:
+            del f['member_stds']
+    save_path = str(tmp_path / 'merged.h5')
+    merge(save_path, *paths, stream=stream, block_size=50)
+    with h5py.File(save_path, 'r') as f:
+        np.testing.assert_allclose(f['preds'][:], expected['preds'], rtol=0,
+                                   atol=1e-12)
+        np.testing.assert_array_equal(f['member_stds'][:], 0)
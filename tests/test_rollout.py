@@ -0,0 +1,158 @@
+"""Compare the batched gap rollout to the frame by frame rollout."""
+import numpy as np
+import pytest
+from conftest import LinearModel, sequential_predict_markers, \
+    synthetic_markers
+from rollout import Checkpoint, ContextWindow, GapRollout, RunIndex, \
+    find_runs, predict_gaps, predict_passes, run_rollouts
+
+N_MARKERS = 12
+
+
+def markers_to_fix(fix_errors):
+    fix = np.zeros((N_MARKERS)) > 1
+    if fix_errors:
+        fix[(N_MARKERS // 2):] = True
+    return fix
+
+
+@pytest.fixture(scope='module')
+def dense_session():
+    # Gaps overlap and chain into each other across markers.
+    return synthetic_markers(1500, N_MARKERS, .01, 20, seed=1)
+
+
+# Dense sessions in which a gap reaches the next gap in the same step as it
+# is reached by the gap before it.
+CHAINED_SESSIONS = [(.01, 20, 1), (.02, 5, 3), (.05, 3, 2)]
+
+
+@pytest.mark.parametrize('session', CHAINED_SESSIONS)
+@pytest.mark.parametrize('fix_errors', [False, True])
+@pytest.mark.parametrize('batch_size', [1, 3, 7, 1000])
+def test_predict_gaps_matches_sequential(session, batch_size, fix_errors):
+    gap_rate, mean_gap_length, seed = session
+    X, bad_frames = synthetic_markers(1000, N_MARKERS, gap_rate,
+                                      mean_gap_length, seed=seed)
+    model = LinearModel(4, N_MARKERS)
+    fix = markers_to_fix(fix_errors)
+    preds_seq, bad_seq = sequential_predict_markers(
+        model, X, bad_frames, markers_to_fix=fix)
+    preds, bad = predict_gaps(model, X, bad_frames, markers_to_fix=fix,
+                              batch_size=batch_size)
+    np.testing.assert_array_equal(bad, bad_seq)
+    np.testing.assert_allclose(preds, preds_seq, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('batch_size', [3, 5, 7, 20])
+def test_ensemble_matches_sequential(dense_session, batch_size):
+    X, bad_frames = dense_session
+    model = LinearModel(4, N_MARKERS, n_members=3)
+    fix = markers_to_fix(True)
+    preds_seq, bad_seq, members_seq = sequential_predict_markers(
+        model, X, bad_frames, markers_to_fix=fix, return_member_data=True)
+    preds, bad, members = predict_gaps(model, X, bad_frames,
+                                       markers_to_fix=fix,
+                                       member_data='preds',
+                                       batch_size=batch_size)
+    np.testing.assert_array_equal(bad, bad_seq)
+    np.testing.assert_allclose(preds, preds_seq, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(members, members_seq, rtol=0, atol=1e-12)
+
+
+def test_predict_passes_matches_predict_gaps(dense_session):
+    X, bad_frames = dense_session
+    model = LinearModel(4, N_MARKERS)
+    fix = markers_to_fix(True)
+    passes = predict_passes(model, [X, X[::-1]],
+                            [bad_frames, bad_frames[::-1]],
+                            markers_to_fix=fix, batch_size=7)
+    for (preds, bad), X_pass, bad_pass in zip(passes, [X, X[::-1]],
+                                              [bad_frames, bad_frames[::-1]]):
+        preds_ref, bad_ref = predict_gaps(model, X_pass, bad_pass,
+                                          markers_to_fix=fix, batch_size=7)
+        np.testing.assert_array_equal(bad, bad_ref)
+        np.testing.assert_allclose(preds, preds_ref, rtol=0, atol=1e-12)
+
+
+def test_context_window_matches_concatenation():
+    rng = np.random.RandomState(0)
+    X = rng.randn(100, 6)
+    window = ContextWindow(3, 5, 6)
+    starts = np.array([0, 10, 20])
+    window.fill(np.stack([X[s:(s + 5)] for s in starts]))
+    reference = [X[s:(s + 5)] for s in starts]
+    for step in range(40):
+        frame = rng.randn(3, 6)
+        window.append(frame)
+        reference = [np.concatenate((r[1:], f[None]), axis=0)
+                     for r, f in zip(reference, frame)]
+        if step % 7 == 0:
+            n_new = np.array([2, 0, 6])
+            cursor = np.array([30, 40, 50])
+            window.extend(X, cursor, n_new, np.arange(3))
+            reference = [np.concatenate((r, X[c:(c + n)]), axis=0)[-5:]
+                         for r, c, n in zip(reference, cursor, n_new)]
+        np.testing.assert_array_equal(window.view(), np.stack(reference))
+        np.testing.assert_array_equal(window.take(np.array([2, 0])),
+                                      np.stack([reference[2],
+                                                reference[0]]))
+
+
+def test_find_runs():
+    mask = np.array([0, 1, 1, 0, 0, 1, 0, 1, 1, 1], bool)
+    starts, lengths = find_runs(mask)
+    np.testing.assert_array_equal(starts, [1, 5, 7])
+    np.testing.assert_array_equal(lengths, [2, 1, 3])
+
+
+def test_run_index_next_bad(dense_session):
+    _, bad_frames = dense_session
+    is_bad = np.repeat(bad_frames, 3, axis=1)
+    index = RunIndex(is_bad)
+    any_bad = np.any(is_bad, axis=1)
+    frame_ids = np.arange(is_bad.shape[0])
+    expected = [np.argmax(any_bad[f:]) + f if np.any(any_bad[f:])
+                else is_bad.shape[0] for f in frame_ids]
+    np.testing.assert_array_equal(index.next_bad(frame_ids), expected)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedModel(LinearModel):
+    """Model failing after a number of calls, as a preempted job would."""
+
+    def __init__(self, n_calls_left, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_calls_left = n_calls_left
+
+    def predict(self, x, batch_size=None):
+        if self.n_calls_left == 0:
+            raise Interrupted()
+        self.n_calls_left -= 1
+        return super().predict(x, batch_size)
+
+
+def test_checkpoint_resumes_exactly(dense_session, tmp_path):
+    X, bad_frames = dense_session
+    fix = markers_to_fix(True)
+    path = str(tmp_path / 'checkpoint.npz')
+
+    def rollout():
+        return GapRollout(X, bad_frames, 4, markers_to_fix=fix,
+                          member_data='stds', n_members=3, batch_size=5)
+
+    reference = rollout()
+    run_rollouts(LinearModel(4, N_MARKERS, n_members=3), [reference], 5)
+
+    interrupted = rollout()
+    with pytest.raises(Interrupted):
+        run_rollouts(InterruptedModel(200, 4, N_MARKERS, n_members=3),
+                     [interrupted], 5, checkpoint=Checkpoint(path, 0))
+    resumed = rollout()
+    run_rollouts(LinearModel(4, N_MARKERS, n_members=3), [resumed], 5,
+                 checkpoint=Checkpoint(path, 0))
+    for result, expected in zip(resumed.results(), reference.results()):
+        np.testing.assert_array_equal(result, expected)
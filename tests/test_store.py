@@ -0,0 +1,50 @@
+"""Round trips through prediction stores."""
+import numpy as np
+from store import PredictionStore, is_store, load_store, store_shapes
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'fold.mat')
+    rng = np.random.RandomState(0)
+    preds = rng.randn(1000, 12)
+    bad_frames = rng.rand(1000, 12) > .5
+    member_stds = rng.rand(3, 1000, 12)
+    with PredictionStore(path, 'w', dtype='float64', chunk_size=64) as store:
+        store.write('preds', preds, store_dtype=True)
+        store.write('bad_frames', bad_frames)
+        store.write('member_stds', member_stds, store_dtype=True)
+        store.write('pass_direction', 'reverse')
+        store.write('fold_id', 3)
+        store.write('missing', None)
+
+    assert is_store(path)
+    with open(path, 'rb') as f:
+        assert f.read(19) == b'MATLAB 7.3 MAT-file'
+    with PredictionStore(path) as store:
+        assert 'missing' not in store
+        assert store.shape('member_stds') == (3, 1000, 12)
+        np.testing.assert_array_equal(store.read('preds'), preds)
+        np.testing.assert_array_equal(store['preds'][100:250], preds[100:250])
+        assert store.read('bad_frames').dtype == bool
+        np.testing.assert_array_equal(store.read('bad_frames'), bad_frames)
+        np.testing.assert_array_equal(store.read('member_stds'), member_stds)
+        assert store.read('pass_direction') == 'reverse'
+
+    data = load_store(path, ['pass_direction', 'fold_id', 'preds'])
+    assert data['pass_direction'][0] == 'reverse'
+    assert data['fold_id'].shape == (1, 1) and data['fold_id'][0, 0] == 3
+    np.testing.assert_array_equal(data['preds'], preds)
+    assert store_shapes(path)['preds'] == (1000, 12)
+
+
+def test_frames_written_in_blocks(tmp_path):
+    path = str(tmp_path / 'preds.mat')
+    preds = np.random.RandomState(1).randn(1000, 12)
+    with PredictionStore(path, 'w', chunk_size=100) as store:
+        store.create('preds', preds.shape)
+        for start in range(0, 1000, 300):
+            store.write_frames('preds', start, preds[start:(start + 300)])
+    with PredictionStore(path) as store:
+        stored = store.read('preds')
+    assert stored.dtype == np.float32
+    np.testing.assert_allclose(stored, preds, rtol=1e-6, atol=0)
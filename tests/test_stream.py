@@ -0,0 +1,77 @@
+"""Compare streaming imputation to the offline passes of impute_markers."""
+import numpy as np
+import pytest
+from conftest import LinearModel, synthetic_markers
+from blend import blend
+from rollout import find_runs, predict_gaps
+
+stream = pytest.importorskip('stream')
+
+INPUT_LENGTH = 4
+N_MARKERS = 12
+
+
+@pytest.fixture(scope='module')
+def session():
+    markers, bad_frames = synthetic_markers(1000, N_MARKERS, .01, 10, seed=2)
+    rng = np.random.RandomState(3)
+    marker_means = rng.randn(1, N_MARKERS)
+    marker_stds = rng.rand(1, N_MARKERS) + .5
+    return markers, bad_frames, marker_means, marker_stds
+
+
+@pytest.mark.parametrize('fix_errors', [False, True])
+def test_streaming_matches_forward_pass(session, fix_errors):
+    markers, bad_frames, marker_means, marker_stds = session
+    markers_to_fix = np.zeros((N_MARKERS)) > 1
+    if fix_errors:
+        markers_to_fix[(N_MARKERS // 2):] = True
+    model = LinearModel(INPUT_LENGTH, N_MARKERS)
+    predsF, bad_framesF = predict_gaps(model, markers, bad_frames,
+                                       markers_to_fix=markers_to_fix)
+
+    imputer = stream.StreamingImputer(model, marker_means, marker_stds,
+                                      markers_to_fix=markers_to_fix)
+    preds, bad = imputer.push(markers * marker_stds + marker_means,
+                              bad_frames)
+    np.testing.assert_allclose(preds, predsF * marker_stds + marker_means,
+                               rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(bad, bad_framesF)
+
+
+def test_online_matches_blended_passes(session):
+    markers, bad_frames, marker_means, marker_stds = session
+    markers_to_fix = np.zeros((N_MARKERS)) > 1
+    model = LinearModel(INPUT_LENGTH, N_MARKERS)
+    predsF, bad_framesF = predict_gaps(model, markers, bad_frames,
+                                       markers_to_fix=markers_to_fix)
+    predsR, bad_framesR = predict_gaps(model, markers[::-1], bad_frames[::-1],
+                                       markers_to_fix=markers_to_fix)
+    is_bad = bad_framesF & bad_framesR[::-1]
+    blended_bad = np.any(is_bad.reshape((markers.shape[0], -1, 3)), axis=2)
+    expected = blend(predsF * marker_stds + marker_means,
+                     predsR[::-1] * marker_stds + marker_means, blended_bad)
+
+    imputer = stream.OnlineImputer(model, marker_means, marker_stds,
+                                   markers_to_fix=markers_to_fix)
+    frames = markers * marker_stds + marker_means
+    outputs, delays = [], []
+    n_returned = 0
+    for i in range(frames.shape[0]):
+        preds, _ = imputer.push(frames[i], bad_frames[i])
+        delays.extend([i - n_returned - j for j in range(preds.shape[0])])
+        n_returned += preds.shape[0]
+        outputs.append(preds)
+    outputs.append(imputer.finish()[0])
+    preds = np.concatenate(outputs, axis=0)
+    np.testing.assert_allclose(preds, expected, rtol=0, atol=1e-9)
+
+    # Frames are held no longer than the longest gap and the context that
+    # closes it. Gaps less than input_length frames apart close together.
+    is_held = np.any(bad_frames, axis=1)
+    starts, lengths = find_runs(~is_held)
+    for start, length in zip(starts, lengths):
+        if start > 0 and length < INPUT_LENGTH:
+            is_held[start:(start + length)] = True
+    _, lengths = find_runs(is_held)
+    assert max(delays) <= np.max(lengths) + INPUT_LENGTH + 1
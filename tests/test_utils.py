@@ -0,0 +1,67 @@
+"""Compare training windows to the original sample selection loop."""
+import numpy as np
+import pytest
+from conftest import synthetic_markers
+
+utils = pytest.importorskip('utils')
+
+
+def reference_get_ids(bad_frames, input_length, output_length,
+                      only_good_inputs=False, only_good_outputs=False):
+    """Select samples one at a time, as get_ids originally did."""
+    is_bad = np.sum(bad_frames, 1) != 0
+    good_frames = np.where(~is_bad)[0]
+    good_frames = good_frames[(good_frames > input_length) &
+                              (good_frames < bad_frames.shape[0] -
+                               output_length)]
+    input_ids, output_ids = [], []
+    for frame in good_frames:
+        inputs = np.arange(frame - input_length, frame)
+        outputs = np.arange(frame, frame + output_length)
+        if only_good_inputs and np.any(is_bad[inputs]):
+            continue
+        if only_good_outputs and np.any(is_bad[outputs]):
+            continue
+        input_ids.append(inputs)
+        output_ids.append(outputs)
+    return np.array(input_ids), np.array(output_ids)
+
+
+@pytest.mark.parametrize('only_good_inputs', [False, True])
+@pytest.mark.parametrize('only_good_outputs', [False, True])
+def test_get_ids_matches_reference(only_good_inputs, only_good_outputs):
+    _, bad_frames = synthetic_markers(2000, 12, .005, 10, seed=4)
+    for input_length, output_length in [(9, 1), (16, 5)]:
+        ids = utils.get_ids(bad_frames, input_length, output_length,
+                            only_good_inputs=only_good_inputs,
+                            only_good_outputs=only_good_outputs)
+        expected = reference_get_ids(bad_frames, input_length, output_length,
+                                     only_good_inputs=only_good_inputs,
+                                     only_good_outputs=only_good_outputs)
+        for result, reference in zip(ids, expected):
+            np.testing.assert_array_equal(result, reference)
+
+
+def test_window_sequence_batches():
+    markers, bad_frames = synthetic_markers(500, 12, .005, 10, seed=5)
+    input_ids, output_ids = utils.get_ids(bad_frames, 9, 1)
+    sequence = utils.WindowSequence(markers, input_ids, output_ids, 32,
+                                    shuffle=False)
+    X = np.concatenate([sequence[i][0] for i in range(len(sequence))])
+    Y = np.concatenate([sequence[i][1] for i in range(len(sequence))])
+    np.testing.assert_array_equal(X, markers[input_ids])
+    np.testing.assert_array_equal(Y, markers[output_ids])
+
+
+@pytest.mark.parametrize('bootstrap', [False, True])
+def test_member_sequence_batches(bootstrap):
+    markers, bad_frames = synthetic_markers(500, 12, .005, 10, seed=6)
+    input_ids, output_ids = utils.get_ids(bad_frames, 9, 1)
+    sequence = utils.MemberSequence(markers, input_ids, output_ids, 32, 3,
+                                    bootstrap=bootstrap, seed=0)
+    X, Y = sequence[0]
+    assert len(X) == len(Y) == 3
+    for x, y, order in zip(X, Y, sequence.orders):
+        batch = order[:32]
+        np.testing.assert_array_equal(x, markers[input_ids[batch]])
+        np.testing.assert_array_equal(y, markers[output_ids[batch]])